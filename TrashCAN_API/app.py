@@ -1,145 +1,83 @@
-import sqlite3
 import json
-import datetime
-import logging
-import requests
-import uuid
-import RPi.GPIO as GPIO
-from time import sleep
-from threading import Thread
-from flask_apscheduler import APScheduler
-from flask import Flask, request, g, Response
+import os
+from threading import Thread, Lock
+from flask import Flask, request, Response, stream_with_context
 from flask_restful import Resource, Api
-from gpiozero import Button, OutputDevice
-from hx711 import HX711
 import config
-import bc_scanner
-import sch
-
-# Setup scale amp
-hx711 = HX711(
-    dout_pin=config.conf['SCALE_DATA_PIN'],
-    pd_sck_pin=config.conf['SCALE_CLOCK_PIN'],
-    channel=config.conf['SCALE_CHANNEL'],
-    gain=config.conf['SCALE_GAIN']
-)
-
-#Create objects for physical objects
-lid_switch = Button(config.conf['LID_SWITCH_PIN)'])
-lid_open_button = OutputDevice(config.conf['LID_OPEN_PIN'], active_high=False, initial_value=False)
-lid_close_button = OutputDevice(config.conf['LID_CLOSE_PIN'], active_high=False, initial_value=False)
-light = OutputDevice(config.conf['LIGHT_PIN'], active_high=False, initial_value=False)
-fan = OutputDevice(config.conf['FAN_PIN'], active_high=False, initial_value=False)
-led = OutputDevice(config.conf['LED_PIN'], active_high=False, initial_value=False)
-
-#Setup parser
-
-#Setup database
-DATABASE = '/srv/trashcan/venv/database/database.db'
+import hwipc
+import metrics
+import records
+import timeseries
 
 # Shared app context
 app = Flask(__name__)
-scheduler = APScheduler()
-
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
-
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
-
-def update_status():
-    payload = {
-        'lid' : lid_switch.value,
-        'light' : light.value,
-        'fan' : fan.value,
-        'led' : led.value
-    }
-    try:
-        requests.post(config.conf['HOME_SERVER_URL'] + '/update_status', params = payload,  timeout=0.2)
-    except requests.exceptions as e:
-        logging.warning('Update status failed')
 
-def start_api():
+_api = None
+_hardware = None
+_event_streams = 0 #Open /api/events streams in this process
+_event_streams_lock = Lock()
+
+# The device API. A web worker calls the hardware-owner process over hwipc when
+# TRASHCAN_HARDWARE_SOCKET is set (see wsgi.py); otherwise this process owns the hardware itself.
+def get_hardware():
+    global _hardware
+    if _hardware is None:
+        path = os.environ.get('TRASHCAN_HARDWARE_SOCKET')
+        if path:
+            _hardware = hwipc.Client(path)
+        else:
+            import owner
+            _hardware = owner.Hardware()
+    return _hardware
+
+def is_worker():
+    return isinstance(get_hardware(), hwipc.Client)
+
+# Register the resources. Safe to call more than once.
+def create_api():
+    global _api
+    if _api is not None:
+        return app
     # Config API
-    my_api = Api(app)
+    my_api = _api = Api(app)
     my_api.add_resource(Index, '/')
     my_api.add_resource(ApiRoot, '/api')
     my_api.add_resource(Lid, '/api/lid')
-    my_api.add_resource(Scale, '/api/scale')
+    my_api.add_resource(Scale, '/api/scale', '/api/scale/<int:index>')
     my_api.add_resource(Light, '/api/light')
     my_api.add_resource(Fan, '/api/fan')
+    my_api.add_resource(Events, '/api/events')
+    my_api.add_resource(Metrics, '/api/metrics')
+    my_api.add_resource(Profile, '/api/metrics/profile')
     my_api.add_resource(BarcodeList, '/api/barcode')
     my_api.add_resource(WeightList, '/api/weight')
+    my_api.add_resource(WeightHistory, '/api/weight/history')
     my_api.add_resource(Barcode, '/api/barcode/<barcode_id>')
     my_api.add_resource(Weight, '/api/weight/<weight_id>')
-    my_api.add_resource(ConfigList, 'api/config')
-    my_api.add_resource(ConfigItem, 'api/config/<option_name>')
-
-    # Config scheduler
-    app.config.from_object(sch.Config())
-    scheduler.init_app(app)
-    scheduler.start()
-
+    my_api.add_resource(ConfigList, '/api/config')
+    my_api.add_resource(ConfigItem, '/api/config/<option_name>')
+    # The scheduler lives in the hardware owner, which serves its REST API in-process
+    if is_worker():
+        methods = ['GET', 'POST', 'PATCH', 'DELETE']
+        app.add_url_rule('/scheduler', 'scheduler_api', scheduler_api, methods=methods)
+        app.add_url_rule('/scheduler/<path:path>', 'scheduler_api_path', scheduler_api, methods=methods)
+    return app
+
+# Relay a scheduler API request to the hardware owner
+def scheduler_api(path=None):
+    status, body, content_type = get_hardware().scheduler_api(
+        request.method, request.path, request.query_string.decode(), request.get_data(as_text=True))
+    return Response(body, status=status, content_type=content_type)
+
+# Development server with the hardware in the same process. The background threads start while the
+# server comes up; devices are built by whichever gets to them first.
+def start_api():
+    import owner
+    create_api()
+    owner.init_scheduler(app)
+    Thread(target=owner.start, name='owner-start', daemon=True).start()
     app.run()
 
-# Watchdog to monitor db config table for changes
-def start_change_monitor():
-    change_id = config.get_last_change_id()
-    while True:
-        new_conf_id = config.get_last_change_id()
-        if new_conf_id > change_id:
-            config.load_config()
-            change_id = new_conf_id
-            # Restart scheduler with new values
-            scheduler.shutdown()
-            scheduler.start()
-        sleep(config['WATCHDOG_SLEEP_TIMER'])
-
-# Pauses any jobs for lights and/or fan and starts up barcode scanner
-def start_lid_monitor():
-    state = False
-    while True:
-        #If lid is open, pause job processing, start the scanner and read
-        while lid_switch.value:
-            if not state:
-                state = True
-                logging.debug('Lid open')
-                update_status()
-                scheduler.pause()
-            upc = bc_scanner.read()
-            #Uploads return from read if not empty
-            if upc:
-                bc_scanner.upload(upc)
-            sleep(0.1)
-
-        #If lid was just closed, resume processing jobs, stop scanner, and upload a scale reading
-        if state:
-            state = False
-            logging.debug('Lid closed')
-            update_status()
-            scheduler.resume()
-            #Get weight from scale
-            r = requests.get('http://127.0.0.1/api/scale')
-            uuid.uuid1()
-            requests.post('http://127.0.0.1/api/weight/'+str(uuid.uuid1())+'?weight_raw='+r.text)
-        sleep(0.1)
-
-
-def toggle_led(action):
-    if config.conf['CLEANING_LED'] == 'true':
-        if action == 'off':
-            led.off()
-        elif action == 'on':
-            led.on()
-        else:
-            led.toggle()
-        update_status()
 
 class Index (Resource):
     def get(self):
@@ -153,157 +91,219 @@ class ApiRoot(Resource):
 
 class Lid(Resource):
     def get(self):
-        return lid_switch.value
+        return get_hardware().get_state()['lid']
+
     def put(self):
-        action = request.args.get('action')
-        if action == 'close':
-            lid_close_button.on()
-            logging.info('Lid closed')
-        elif action == 'open':
-            lid_open_button.on()
-            logging.info('Lid opened')
-        elif action == 'toggle':
-            if lid_switch.value:
-                lid_close_button.on()
-                logging.info('Lid closed')
-            else:
-                lid_open_button.on()
-                logging.info('Lid opened')
-        else:
-            return Response('Invalid action parameter',status=400)
-        update_status()
+        try:
+            get_hardware().set_lid(request.args.get('action'))
+        except ValueError as e:
+            return Response(str(e), status=400)
         return 'Success'
 
 class Light(Resource):
     def get(self):
-        return light.value
+        return get_hardware().get_state()['light']
 
     def put(self):
-        action = request.args.get('action')
-
-        if action == 'off':
-            light.off()
-            toggle_led('off')
-        elif action == 'on':
-            light.on()
-            toggle_led('on')
-        elif action == 'toggle':
-            light.toggle()
-            toggle_led()
-        else:
-            return Response('Invalid action parameter',status=400)
-        update_status()
+        try:
+            get_hardware().set_light(request.args.get('action'))
+        except ValueError as e:
+            return Response(str(e), status=400)
         return 'Success'
 
 class Fan(Resource):
     def get(self):
-        return fan.value
+        return get_hardware().get_state()['fan']
 
     def put(self):
-        action = request.args.get('action')
-
-        if action == 'off':
-            fan.off()
-            toggle_led('off')
-        elif action == 'on':
-            fan.on()
-            toggle_led('on')
-        elif action == 'toggle':
-            fan.toggle()
-            toggle_led()
-        else:
-            return 400
-        update_status()
+        try:
+            get_hardware().set_fan(request.args.get('action'))
+        except ValueError as e:
+            return Response(str(e), status=400)
         return 'Success'
 
-class Scale (Resource):
+# Holds one of this process's event stream slots until the response is closed. Werkzeug closes the
+# response even if the stream was never read, which a generator's finally would miss.
+class _EventStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.closed = False
+
+    def __iter__(self):
+        return self.stream
+
+    def close(self):
+        global _event_streams
+        if self.closed:
+            return
+        self.closed = True
+        with _event_streams_lock:
+            _event_streams -= 1
+        self.stream.close()
+
+# Server-Sent Events stream of lid, light, fan and LED changes and throttled weight readings.
+# Under gunicorn's gthread workers each open stream holds one of the worker's threads for as long
+# as the client stays connected, so a worker serves at most EVENT_STREAMS_MAX of them and answers
+# 503 beyond that, leaving the rest of its threads to the REST endpoints. The limit is per worker:
+# with -w 4 --threads 8 and the default of 4, up to 16 dashboards can listen at once.
+class Events(Resource):
+    def get(self):
+        global _event_streams
+        with _event_streams_lock:
+            if _event_streams >= config.conf['EVENT_STREAMS_MAX']:
+                return Response('Too many event streams, try again later', status=503, headers={'Retry-After': '30'})
+            _event_streams += 1
+        try:
+            stream = stream_with_context(get_hardware().event_stream())
+        except Exception:
+            with _event_streams_lock:
+                _event_streams -= 1
+            raise
+        return Response(_EventStream(stream), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class Metrics(Resource):
     def get(self):
-        GPIO.setwarnings(False)
-        offset = 30500
-        gain = 0.0095
-
-        hx711.reset() #Maybe not necessary
-        raw_measures = hx711.get_raw_data(config.conf['NUM_MEASUREMENTS'])
-        #Apply offset
-        measures = [x + offset for x in raw_measures]
-        measures.sort()
-        #Calculate median
-        median = measures[int(round((len(measures) / 2)))]
-        #Remove values outside +/- 25% from the median
-        results = [x for x in measures if median * 0.75 <= x <= median * 1.25]
-        #0 out and average values. Should be ~1000 after applying offset. Remove this before applying gain.
-        x = (sum(results)/len(results))- 1000
-        #Apply gain and remove tare value.
-        return (x*gain) - config.conf['TARE']
+        result = metrics.snapshot()
+        # Each worker has its own counters; the owner's are reported alongside
+        if is_worker():
+            result['hardware'] = get_hardware().metrics()
+        return result
 
-    def put(self):
-        hx711.reset()  # Maybe not necessary
-        config.set_config('TARE', hx711.get_raw_data(config.conf['NUM_MEASUREMENTS']))
+# Sample all thread stacks in the background: POST starts a profile of ?seconds= (default 5, at most
+# 30) and GET returns the last one with the hottest stacks. Under gunicorn the hot paths (sampling,
+# HID reads, uploads, jobs) run in the hardware owner, so that is the process profiled unless
+# ?process=worker asks for this web worker.
+class Profile(Resource):
+    def _target(self):
+        process = request.args.get('process', 'owner')
+        if process not in ('owner', 'worker'):
+            raise ValueError('process must be owner or worker')
+        return get_hardware() if is_worker() and process == 'owner' else metrics
+
+    def get(self):
+        try:
+            return self._target().last_profile()
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+    def post(self):
+        try:
+            seconds = min(float(request.args.get('seconds', 5)), 30.0)
+            target = self._target()
+        except ValueError as e:
+            return Response(str(e), status=400)
+        if not target.start_profile(seconds):
+            return Response('A profile is already running', status=409)
+        return target.last_profile(), 202
+
+# /api/scale is the first scale; /api/scale/<n> is scale n of SCALE_COUNT
+class Scale (Resource):
+    @metrics.timed('api.scale')
+    def get(self, index=0):
+        if not 0 <= index < config.conf['SCALE_COUNT']:
+            return Response('Scale not found', status=404)
+        reading = get_hardware().read_scale(index)
+        return {'weight': reading.weight, 'timestamp': reading.timestamp, 'settled': reading.settled}
+
+    def put(self, index=0):
+        if not 0 <= index < config.conf['SCALE_COUNT']:
+            return Response('Scale not found', status=404)
+        if get_hardware().tare_scale(index) is None:
+            return Response('Scale not ready', status=503)
         return 'Success'
 
+MAX_PAGE_SIZE = 1000
+
+# Shared GET for the list resources.
+#   ?after=<timestamp,id>  resume after the given row (the 'next' value of the previous page)
+#   ?since=<timestamp>     only rows newer than timestamp
+#   ?limit=<n>             page size, at most MAX_PAGE_SIZE
+#   ?format=ndjson         stream every matching row as newline-delimited JSON instead of paging
+def list_rows(table):
+    after = request.args.get('after')
+    since = request.args.get('since')
+    if after is not None:
+        if ',' not in after:
+            return Response('after must be <timestamp>,<id>', status=400)
+        after = tuple(after.rsplit(',', 1))
+
+    if request.args.get('format') == 'ndjson':
+        rows = records.iter_rows(table, after, since)
+        return Response(stream_with_context(json.dumps(row) + '\n' for row in rows), mimetype='application/x-ndjson')
+
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return Response('limit must be an integer', status=400)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return Response('limit must be between 1 and ' + str(MAX_PAGE_SIZE), status=400)
+    rows, next_cursor = records.list_page(table, after, since, limit)
+    return {'items': rows, 'next': ','.join(next_cursor) if next_cursor else None}
+
 class WeightList (Resource):
     def get(self):
-        conn = get_db()
-        conn.cursor().execute("SELECT * FROM[Weight]")
-        results = conn.cursor().fetchall()
-        return json.dumps(results)
+        return list_rows('Weight')
 
     def delete(self):
         return 501
 
+# Fill-level history from the rollups.
+#   ?resolution=minute|hour|day  bucket size, default hour
+#   ?since=<epoch seconds>       first bucket; without it, the latest buckets
+#   ?until=<epoch seconds>       end, exclusive
+#   ?limit=<n>                   number of buckets, at most MAX_PAGE_SIZE
+#   ?scale=<n>                   scale, default 0
+class WeightHistory (Resource):
+    def get(self):
+        try:
+            since = request.args.get('since')
+            until = request.args.get('until')
+            since = float(since) if since is not None else None
+            until = float(until) if until is not None else None
+            limit = int(request.args.get('limit', 100))
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                raise ValueError('limit must be between 1 and ' + str(MAX_PAGE_SIZE))
+            resolution = request.args.get('resolution', 'hour')
+            scale = int(request.args.get('scale', 0))
+            return {'resolution': resolution, 'scale': scale, 'items': timeseries.history(resolution, since, until, limit, scale)}
+        except ValueError as e:
+            return Response(str(e), status=400)
+
 class BarcodeList (Resource):
     def get(self):
-        conn = get_db()
-        conn.cursor().execute("SELECT * FROM[Barcode]")
-        results = conn.cursor().fetchall()
-        return json.dumps(results)
+        return list_rows('Barcode')
 
     def delete(self):
         return 501
 
 class Barcode (Resource):
     def post(self,barcode_id):
-        conn = get_db()
-        time = datetime.datetime.now()
-        barcode = request.args.get('barcode')
-        conn.cursor().execute("INSERT INTO Barcode ([barcode_id],[timestamp],[barcode]) VALUES(?, ?, ?)",(barcode_id,time,barcode,))
-        conn.commit()
-        return barcode_id
+        return records.add_barcode(barcode_id, request.args.get('barcode'))
 
     def delete(self, barcode_id):
-        conn = get_db()
-        result = conn.cursor().execute("DELETE FROM [Barcode] WHERE barcode_id = ?",(barcode_id,))
-        conn.commit()
-        return result
+        return records.delete_barcode(barcode_id)
 
     def get(self,barcode_id):
-        conn = get_db()
-        result = conn.cursor().execute("SELECT TOP 1 FROM [Barcode] WHERE barcode_id = ?", (barcode_id,))
+        result = records.get_barcode(barcode_id)
+        if result is None:
+            return Response('Barcode not found', status=404)
         return result
 
 class Weight (Resource):
     def post(self,weight_id):
-        conn = get_db()
-        time = datetime.datetime.now()
-        weight_raw = request.args.get('weight_raw')
-        if request.args.get('weight'):
-            weight = request.args.get('weight')
-        else:
-            weight = weight_raw * config.conf['CONVERSION_FACTOR']
-        conn.cursor().execute("INSERT INTO Weight ([weight_id],[timestamp],[weight],[weight_raw]) VALUES(?, ?, ?,?)",
-                              (weight_id,time,weight,weight_raw))
-        conn.commit()
-        return weight_id
+        try:
+            return records.add_weight(weight_id, request.args.get('weight_raw'), request.args.get('weight'))
+        except ValueError as e:
+            return Response(str(e), status=400)
 
     def delete(self, weight_id):
-        conn = get_db()
-        result = conn.cursor().execute("DELETE FROM[Weight] WHERE weight_id = ?",(weight_id,))
-        conn.commit()
-        return result
+        return records.delete_weight(weight_id)
 
     def get(self,weight_id):
-        conn = get_db()
-        result = conn.cursor().execute("SELECT TOP 1 FROM [Barcode] WHERE weight_id = ?", (weight_id,))
+        result = records.get_weight(weight_id)
+        if result is None:
+            return Response('Weight not found', status=404)
         return result
 
 class ConfigList (Resource):
@@ -328,11 +328,4 @@ class ConfigItem (Resource):
 
 
 if __name__ == '__main__':
-    t1 = Thread(target = start_api())
-    t2 = Thread(target = start_change_monitor())
-    t3 = Thread(target = start_lid_monitor())
-
-    t1.start()
-    t2.start()
-    t3.start()
-
+    start_api()
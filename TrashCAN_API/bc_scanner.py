@@ -1,11 +1,24 @@
 import logging
 import config
-import requests
-import uuid
-from gpiozero import OutputDevice
+import hardware
+import metrics
+import outbox
+import os
 import select
+import time
+import uuid
+from collections import OrderedDict
+import records
+import upc_cache
+
+# Scanner index's options. Each scanner has its own trigger pin and hidraw device.
+def scanner_conf(index):
+    return config.device_conf(index, ('BC_TRIGGER_PIN', 'BARCODE_SCANNER_PATH'))
 
-bc_trigger = OutputDevice(config.conf['BC_TRIGGER_PIN'], active_high=False, initial_value=False)
+def _trigger(index):
+    return hardware.OutputDevice(scanner_conf(index)['BC_TRIGGER_PIN'], active_high=False, initial_value=False)
+
+hardware.devices.register('bc_trigger', _trigger, indexed=True)
 
 hid = {4: 'a', 5: 'b', 6: 'c', 7: 'd', 8: 'e', 9: 'f', 10: 'g', 11: 'h', 12: 'i', 13: 'j', 14: 'k', 15: 'l',
        16: 'm', 17: 'n', 18: 'o', 19: 'p', 20: 'q', 21: 'r', 22: 's', 23: 't', 24: 'u', 25: 'v', 26: 'w', 27: 'x',
@@ -17,54 +30,172 @@ hid2 = {4: 'A', 5: 'B', 6: 'C', 7: 'D', 8: 'E', 9: 'F', 10: 'G', 11: 'H', 12: 'I
         28: 'Y', 29: 'Z', 30: '!', 31: '@', 32: '#', 33: '$', 34: '%', 35: '^', 36: '&', 37: '*', 38: '(', 39: ')',
         44: ' ', 45: '_', 46: '+', 47: '{', 48: '}', 49: '|', 51: ':', 52: '"', 53: '~', 54: '<', 55: '>', 56: '?'}
 
-def read():
-    fp = open(config.conf['BARCODE_SCANNER_PATH'], 'rb')
-    start_scanner()
-    bc = ''
-    shift = False
-    done = False
-
-    #Wait for 1 second on any input from /dev file. Returns barcode or empty string
-    r, w, e = select.select([fp], [], [], 1)
-    if fp in r:
-        while not done:
-            buffer = fp.read(8)
-            for c in buffer:
-                if c > 0:
-                    #40 is CR, means done
-                    if int(c) == 40:
-                        done = True
-                        break;
-                    if shift:
-                        #2 is shift key
-                        if int(c) == 2:
-                            shift = True
-                        #Use shift charset
-                        else:
-                            bc += hid2[int(c)]
-                            shift = False
-                    else:
-                        if int(c) == 2:
-                            shift = True
-                        #Use non-shifted charset
-                        else:
-                            bc += hid[int(c)]
-    stop_scanner()
-    fp.close()
-    return bc
-
-def start_scanner():
-    bc_trigger.on()
-
-def stop_scanner():
-    bc_trigger.off()
-
-# Attempt to upload barcode directly to server, otherwise store locally
-def upload(bc):
-    logging.debug('Starting upload: '+bc)
-    try:
-        r = requests.post(config.conf['HOME_SERVER_URL']+'/barcode-lookup?upc='+bc, timeout=0.2)
-        logging.debug(r.text)
-    except requests.exceptions.Timeout as e:
-        logging.warning('Upload failed')
-        requests.post('http://127.0.0.1/api/barcode/'+str(uuid.uuid1())+'?barcode='+bc)
\ No newline at end of file
+# 256 entry lookup tables indexed by HID keycode. Unmapped keycodes decode to ''.
+KEYMAP = tuple(hid.get(i, '') for i in range(256))
+SHIFT_KEYMAP = tuple(hid2.get(i, '') for i in range(256))
+
+REPORT_SIZE = 8
+ENTER = 40
+SHIFT_MASK = 0x22 #Left or right shift in the modifier byte
+REOPEN_INTERVAL = 1.0 #Seconds between attempts to reopen a scanner that went away
+
+# Keeps the hidraw device open and turns its report stream into barcodes
+class Reader:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.poller = select.epoll()
+        self.poller.register(self.fd, select.EPOLLIN)
+        self.reset()
+
+    # Drop a partly read report and barcode, e.g. one cut off when the last session ended
+    def reset(self):
+        self.pending = b''
+        self.chars = []
+
+    def close(self):
+        self.poller.close()
+        os.close(self.fd)
+
+    # Decode whatever complete reports are buffered. Returns the finished barcodes.
+    def feed(self, data):
+        data = self.pending + data
+        end = len(data) - len(data) % REPORT_SIZE
+        self.pending = data[end:]
+        barcodes = []
+        chars = self.chars
+        for i in range(0, end, REPORT_SIZE):
+            # Keycodes are packed from byte 2, so an empty byte 2 is a key up report
+            if not data[i + 2]:
+                continue
+            table = SHIFT_KEYMAP if data[i] & SHIFT_MASK else KEYMAP
+            for keycode in data[i + 2:i + REPORT_SIZE]:
+                if not keycode:
+                    break
+                if keycode == ENTER:
+                    barcodes.append(''.join(chars))
+                    chars = []
+                    break
+                chars.append(table[keycode])
+        self.chars = chars
+        return barcodes
+
+    # Yields each complete barcode as it arrives. Yields None whenever timeout seconds pass with no
+    # barcode so the caller can decide whether to keep reading.
+    def barcodes(self, timeout=None):
+        while True:
+            events = self.poller.poll(-1 if timeout is None else timeout)
+            if not events:
+                yield None
+                continue
+            try:
+                data = os.read(self.fd, REPORT_SIZE * 64)
+            except BlockingIOError:
+                continue
+            if not data:
+                # Writer went away (scanner unplugged or pipe closed)
+                return
+            with metrics.timer('hid.decode'):
+                barcodes = self.feed(data)
+            metrics.inc('hid.barcodes', len(barcodes))
+            for bc in barcodes:
+                yield bc
+
+# Collapses repeat reads of the same UPC, e.g. an item held under the scanner. A UPC seen again within
+# window seconds of its last read is a duplicate, and each duplicate read extends its window. Holds at
+# most max_entries UPCs, dropping the least recently read. One instance per lid-open session.
+class Dedupe:
+    def __init__(self, window=2.0, max_entries=256):
+        self.window = window
+        self.max_entries = max_entries
+        self.last_seen = OrderedDict() #upc -> time of last read, oldest first
+        self.unique = 0
+        self.duplicates = 0
+
+    # True if upc should be uploaded, False if it is a duplicate
+    def admit(self, upc, now=None):
+        now = time.monotonic() if now is None else now
+        expired = now - self.window
+        while self.last_seen:
+            oldest, seen = next(iter(self.last_seen.items()))
+            if seen >= expired:
+                break
+            del self.last_seen[oldest]
+        duplicate = upc in self.last_seen
+        self.last_seen[upc] = now
+        self.last_seen.move_to_end(upc)
+        if duplicate:
+            self.duplicates += 1
+            metrics.inc('hid.duplicates')
+            return False
+        if len(self.last_seen) > self.max_entries:
+            self.last_seen.popitem(last=False)
+        self.unique += 1
+        return True
+
+def scanner_count():
+    return config.conf['SCANNER_COUNT']
+
+# One reader per scanner, each read by its own thread
+_readers = {}
+
+def get_reader(index=0):
+    reader = _readers.get(index)
+    if reader is None:
+        reader = _readers[index] = Reader(hardware.scanner_path(scanner_conf(index)['BARCODE_SCANNER_PATH'], index))
+    return reader
+
+# Forget scanner index's reader, if it is still `reader`, and close it
+def drop_reader(index, reader):
+    if _readers.get(index) is reader:
+        del _readers[index]
+    reader.close()
+
+# Barcodes from scanner index, as Reader.barcodes yields them, for as long as the caller keeps reading.
+# A reader that fails or reaches end of file (the scanner was unplugged) is dropped, and the scanner
+# reopened every REOPEN_INTERVAL seconds until it is back. Yields None while it is missing. Nothing
+# partly read before the call or before a reopen carries over into the barcodes it yields.
+def barcodes(index=0, timeout=None):
+    retry_at = 0.0
+    while True:
+        now = time.monotonic()
+        if now < retry_at:
+            time.sleep(retry_at - now if timeout is None else min(timeout, retry_at - now))
+            yield None
+            continue
+        try:
+            reader = get_reader(index)
+        except OSError as e:
+            logging.debug('Scanner %d not back yet: %s', index, e)
+            retry_at = now + REOPEN_INTERVAL
+            continue
+        reader.reset()
+        try:
+            for bc in reader.barcodes(timeout=timeout):
+                yield bc
+            logging.warning('Scanner %d went away, reopening', index)
+        except OSError as e:
+            logging.warning('Scanner %d read failed, reopening: %s', index, e)
+        metrics.inc('hid.reopens')
+        drop_reader(index, reader)
+
+def start_scanner(index=0):
+    hardware.devices.get('bc_trigger', index).on()
+
+def stop_scanner(index=0):
+    hardware.devices.get('bc_trigger', index).off()
+
+# Queue barcodes read by one scanner for upload. The outbox looks each up on the home server in the
+# background and retries until it succeeds. A product already in the lookup cache needs no lookup,
+# so those scans are only recorded in the Barcode table, in one write, and phone_home syncs them in bulk.
+def upload_many(barcodes, scanner=0):
+    cached = []
+    for bc in barcodes:
+        if upc_cache.lookup(bc) is not None:
+            cached.append(bc)
+        else:
+            logging.debug('Queueing upload: '+bc)
+            outbox.enqueue('barcode', {'barcode': bc, 'timestamp': records.timestamp(), 'scanner': scanner})
+    if cached:
+        logging.debug('Cached lookups, recording %d scans', len(cached))
+        records.add_barcodes([(str(uuid.uuid1()), bc, scanner) for bc in cached])
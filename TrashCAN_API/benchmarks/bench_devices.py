@@ -0,0 +1,76 @@
+# Scaling with the number of compartments on the simulated hardware: aggregate HX711 sample rate with
+# 1..N scale samplers running at once, and barcodes written per second with 1..N scanners feeding
+# lid sessions at once (every product in the lookup cache, so each scan is a Barcode row).
+# Usage: python benchmarks/bench_devices.py [--devices N] [--seconds S] [--scans N]
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ['TRASHCAN_HARDWARE'] = 'sim'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
+def setup(devices):
+    db = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database', 'init_db.sql')) as f:
+        storage.connect(db).executescript(f.read())
+    storage.DATABASE = db
+    import config
+    config.set_config('HOME_SERVER_URL', 'http://127.0.0.1:9')
+    config.set_config('SCALE_COUNT', str(devices))
+    config.set_config('SCANNER_COUNT', str(devices))
+    for index in range(1, devices):
+        for option in ('SCALE_DATA_PIN', 'SCALE_CLOCK_PIN', 'BC_TRIGGER_PIN', 'BARCODE_SCANNER_PATH'):
+            config.set_config(config.indexed(option, index), str(100 + index))
+
+def samples():
+    import metrics
+    return metrics.snapshot()['histograms'].get('hx711.read', {}).get('count', 0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--scans', type=int, default=5000)
+    args = parser.parse_args()
+    setup(args.devices)
+    import hardware
+    import owner
+    import service
+    import upc_cache
+
+    print('%-10s %16s %20s' % ('devices', 'HX711 samples/s', 'scans written/s'))
+    started = 0
+    upcs = ['%012d' % i for i in range(args.scans)]
+    upc_cache.store_many([(upc, {'name': upc}) for upc in upcs])
+    for count in range(1, args.devices + 1):
+        while started < count:
+            service.devices.get('scale_sampler', started)
+            started += 1
+        before = samples()
+        time.sleep(args.seconds)
+        rate = (samples() - before) / args.seconds
+
+        storage.execute("DELETE FROM Barcode")
+        owner.lid_is_open.set()
+        threads = [threading.Thread(target=owner.scan_while_open, args=(index,)) for index in range(count)]
+        for t in threads:
+            t.start()
+        start = time.perf_counter()
+        for index in range(count):
+            scanner = hardware.get_scanner(index)
+            for upc in upcs:
+                scanner.scan(upc)
+        while storage.query("SELECT COUNT(*) FROM Barcode")[0][0] < count * args.scans:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        owner.lid_is_open.clear()
+        for t in threads:
+            t.join()
+        print('%-10d %16.0f %20.0f' % (count, rate, count * args.scans / elapsed))
+
+if __name__ == '__main__':
+    main()
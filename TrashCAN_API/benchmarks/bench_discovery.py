@@ -0,0 +1,58 @@
+# Time for a client to find the bin: a broadcast query answered by the discovery responder, against
+# waiting for the old periodic broadcast. Queries go to 127.0.0.1 so the numbers don't depend on the LAN.
+# Usage: python benchmarks/bench_discovery.py [--queries N]
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
+OLD_BROADCAST_SLEEP = 30 #Seconds between the old periodic broadcasts
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    db = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database', 'init_db.sql')) as f:
+        storage.connect(db).executescript(f.read())
+    storage.DATABASE = db
+    import config
+    import discovery
+    port = free_port()
+    config.set_config('PI_BROADCAST_PORT', str(port))
+    config.set_config('DISCOVERY_ANNOUNCE', 'false')
+    discovery.start()
+
+    found = discovery.find(port, timeout=0.2, target='127.0.0.1')
+    # find() waits out its timeout for more answers, so time the first answer directly
+    times = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1.0)
+    for _ in range(args.queries):
+        start = time.perf_counter()
+        sock.sendto(discovery.QUERY, ('127.0.0.1', port))
+        sock.recvfrom(512)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print('address found: %s' % found)
+    print('%-36s %10s %10s' % ('', 'p50', 'p99'))
+    print('%-36s %7.3f ms %7.3f ms' % ('query -> answer', times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000))
+    print('%-36s %7.0f ms %7.0f ms' % ('wait for periodic broadcast', OLD_BROADCAST_SLEEP / 2 * 1000, OLD_BROADCAST_SLEEP * 0.99 * 1000))
+    print()
+    print('idle packets per hour: %d periodic, 0 with the responder (one announcement per address change)' % (3600 // OLD_BROADCAST_SLEEP))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# Compare cost and accuracy of the scale filters over recorded raw HX711 traces.
+# Usage: python benchmarks/bench_filters.py [trace.csv ...]
+# Traces are one raw reading per line with a '# weight=<grams>' header giving the true load.
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import estimator
+
+WINDOW = 25
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+
+def load_trace(path):
+    weight = None
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('# weight='):
+                weight = float(line[len('# weight='):])
+            elif line and not line.startswith('#'):
+                samples.append(float(line))
+    return weight, samples
+
+# Slide a window over the trace like the sampler does and time every estimate
+def run(est, samples):
+    estimates = []
+    start = time.perf_counter()
+    for i in range(WINDOW, len(samples) + 1):
+        weight, spread = est.estimate(samples[i - WINDOW:i])
+        if weight is not None:
+            estimates.append(weight)
+    elapsed = time.perf_counter() - start
+    return estimates, elapsed / max(1, len(samples) - WINDOW + 1)
+
+def main(paths):
+    configs = []
+    for numpy_path in ([False, True] if estimator.numpy is not None else [False]):
+        for filter in estimator.FILTERS:
+            for smoothing in estimator.SMOOTHERS:
+                configs.append((filter, smoothing, numpy_path))
+
+    print('%-16s %-8s %-8s %-6s %10s %10s %10s' % ('trace', 'filter', 'smooth', 'numpy', 'us/est', 'mean err', 'max err'))
+    for path in paths:
+        weight, samples = load_trace(path)
+        for filter, smoothing, numpy_path in configs:
+            est = estimator.Estimator(filter=filter, smoothing=smoothing, use_numpy=numpy_path)
+            estimates, cost = run(est, samples)
+            errors = [abs(x - weight) for x in estimates] if weight is not None else [0]
+            print('%-16s %-8s %-8s %-6s %10.1f %10.2f %10.2f' % (
+                os.path.basename(path), filter, smoothing, numpy_path, cost * 1e6,
+                sum(errors) / len(errors), max(errors)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or sorted(glob.glob(os.path.join(TRACE_DIR, '*.csv'))))
@@ -0,0 +1,106 @@
+# Measure barcode decode throughput and latency against a recorded hidraw report stream.
+# Usage: python benchmarks/bench_scanner.py [reports.bin]
+# Without a recording, a stream of random UPC-A scans is synthesized with the scanner's report layout.
+import os
+import random
+import sys
+import tempfile
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bc_scanner
+from hardware import encode_reports as encode
+
+NUM_BARCODES = 2000
+
+def synthesize(n):
+    return [''.join(random.choice('0123456789') for _ in range(12)) for _ in range(n)]
+
+# The decoder this module replaced, kept here for comparison
+def legacy_decode(stream):
+    barcodes = []
+    bc = ''
+    shift = False
+    for i in range(0, len(stream), 8):
+        for c in stream[i:i + 8]:
+            if c > 0:
+                if c == 40:
+                    barcodes.append(bc)
+                    bc = ''
+                    break
+                if c == 2:
+                    shift = True
+                elif shift:
+                    bc += bc_scanner.hid2[c]
+                    shift = False
+                else:
+                    bc += bc_scanner.hid[c]
+    return barcodes
+
+def bench_decode(stream):
+    reports = len(stream) // bc_scanner.REPORT_SIZE
+    start = time.perf_counter()
+    legacy = legacy_decode(stream)
+    legacy_time = time.perf_counter() - start
+
+    reader = bc_scanner.Reader.__new__(bc_scanner.Reader)
+    reader.pending = b''
+    reader.chars = []
+    start = time.perf_counter()
+    decoded = reader.feed(stream)
+    table_time = time.perf_counter() - start
+
+    assert decoded == legacy, 'decoders disagree'
+    print('decode: %d reports, %d barcodes' % (reports, len(decoded)))
+    print('  legacy dict decoder  %10.0f reports/s' % (reports / legacy_time))
+    print('  table decoder        %10.0f reports/s' % (reports / table_time))
+
+# Feed scans one at a time through a FIFO and time from the last report written to the barcode yielded
+def bench_latency(barcodes):
+    path = os.path.join(tempfile.mkdtemp(), 'hidraw')
+    os.mkfifo(path)
+    sent = []
+
+    def writer():
+        fd = os.open(path, os.O_WRONLY)
+        for bc in barcodes:
+            sent.append(time.perf_counter())
+            os.write(fd, encode(bc))
+            time.sleep(0.001)
+        os.close(fd)
+
+    reader_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    reader = bc_scanner.Reader(path)
+    os.close(reader_fd)
+    t = Thread(target=writer)
+    t.start()
+    latencies = []
+    for bc in reader.barcodes(timeout=1):
+        if bc is None:
+            break
+        latencies.append(time.perf_counter() - sent[len(latencies)])
+        if len(latencies) == len(barcodes):
+            break
+    t.join()
+    reader.close()
+    os.unlink(path)
+
+    latencies.sort()
+    print('latency: %d barcodes through a fifo' % len(latencies))
+    print('  p50 %.3f ms  p99 %.3f ms  max %.3f ms' % (
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+
+def main(args):
+    if args:
+        with open(args[0], 'rb') as f:
+            stream = f.read()
+        barcodes = legacy_decode(stream)
+    else:
+        barcodes = synthesize(NUM_BARCODES)
+        stream = b''.join(encode(bc) for bc in barcodes)
+    bench_decode(stream)
+    bench_latency(barcodes[:500])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
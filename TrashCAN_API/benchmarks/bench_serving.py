@@ -0,0 +1,213 @@
+# Compare single-process serving (dev server with the hardware in-process) against the production layout
+# (hardware owner + several web worker processes talking to it over hwipc) on the simulated hardware.
+# Usage: python benchmarks/bench_serving.py [--workers N] [--concurrency C] [--seconds S]
+#
+# The workers here are werkzeug servers forked onto one listening socket, which is the same layout
+# gunicorn uses for wsgi:app in production.
+import argparse
+import http.client
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ['TRASHCAN_HARDWARE'] = 'sim'
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import storage
+
+PATHS = (
+    ('GET', '/api/scale'),
+    ('GET', '/api/lid'),
+    ('PUT', '/api/light?action=toggle'),
+    ('GET', '/api/weight?limit=100'),
+    ('GET', '/api/config/TARE')
+)
+
+# Roles, each run in its own process
+
+def init_role(db):
+    storage.DATABASE = db
+    logging.disable(logging.ERROR)
+    import sch
+    # In-memory job store and no built-in jobs so nothing fires during the run
+    sch.Config.SCHEDULER_JOBSTORES = {}
+    sch.Config.JOBS = []
+
+def run_single(db, port):
+    init_role(db)
+    from werkzeug.serving import make_server
+    import app as app_module
+    import owner
+    app = app_module.create_api()
+    owner.init_scheduler(app)
+    threading.Thread(target=owner.start, daemon=True).start()
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+def run_owner(db, path):
+    init_role(db)
+    import owner
+    owner.serve(path)
+    from flask import Flask
+    owner.init_scheduler(Flask('owner'))
+    owner.start()
+    threading.Event().wait()
+
+def run_workers(db, path, port, workers):
+    storage.DATABASE = db
+    logging.disable(logging.ERROR)
+    os.environ['TRASHCAN_HARDWARE_SOCKET'] = path
+    from werkzeug.serving import make_server
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(128)
+    for i in range(workers):
+        if os.fork() == 0:
+            import app as app_module
+            app = app_module.create_api()
+            make_server('127.0.0.1', port, app, threaded=True, fd=listener.fileno()).serve_forever()
+            os._exit(0)
+    threading.Event().wait()
+
+# Load generator
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for(predicate, timeout=20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if predicate():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError('server did not come up')
+
+def answers(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+    conn.request('GET', '/api/lid')
+    return conn.getresponse().status == 200
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+def load(port, concurrency, seconds):
+    results = dict((path, []) for path in PATHS)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        mine = dict((path, []) for path in PATHS)
+        i = offset
+        while time.perf_counter() < deadline:
+            method, url = PATHS[i % len(PATHS)]
+            i += 1
+            start = time.perf_counter()
+            conn.request(method, url)
+            conn.getresponse().read()
+            mine[(method, url)].append(time.perf_counter() - start)
+        with lock:
+            for path, latencies in mine.items():
+                results[path].extend(latencies)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = sum(len(v) for v in results.values())
+    print('  %-36s %7d %10.0f/s' % ('all', total, total / seconds))
+    for (method, url), latencies in results.items():
+        print('  %-36s %7d %10.0f/s %9.2f ms %9.2f ms' % (method + ' ' + url, len(latencies), len(latencies) / seconds,
+              percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+def spawn(*args):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--role'] + [str(a) for a in args],
+                            start_new_session=True)
+
+def stop(*procs):
+    for p in procs:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+
+# IPC round trip next to the same call made in-process
+def bench_ipc(db, calls=5000):
+    path = os.path.join(os.path.dirname(db), 'ipc-bench.sock')
+    owner_proc = spawn('owner', db, path)
+    import hwipc
+    client = hwipc.Client(path)
+    wait_for(client.get_state)
+    start = time.perf_counter()
+    for _ in range(calls):
+        client.read_scale()
+    elapsed = time.perf_counter() - start
+    stop(owner_proc)
+    print('hwipc read_scale round trip: %.1f us/call' % (elapsed / calls * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--role', nargs='+')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    if args.role:
+        role, rest = args.role[0], args.role[1:]
+        if role == 'single':
+            run_single(rest[0], int(rest[1]))
+        elif role == 'owner':
+            run_owner(rest[0], rest[1])
+        else:
+            run_workers(rest[0], rest[1], int(rest[2]), int(rest[3]))
+        return
+
+    directory = tempfile.mkdtemp()
+    db = os.path.join(directory, 'bench.db')
+    with open(os.path.join(ROOT, 'database', 'init_db.sql')) as f:
+        storage.connect(db).executescript(f.read())
+    storage.DATABASE = db
+    import config
+    # Nothing listens on the discard port, so background uploads fail fast
+    config.set_config('HOME_SERVER_URL', 'http://127.0.0.1:9')
+
+    bench_ipc(db)
+
+    print()
+    print('  %-36s %7s %12s %12s %12s' % ('request', 'count', 'throughput', 'p50', 'p99'))
+    port = free_port()
+    single = spawn('single', db, port)
+    try:
+        wait_for(lambda: answers(port))
+        print('single process (dev server, hardware in-process)')
+        load(port, args.concurrency, args.seconds)
+    finally:
+        stop(single)
+
+    path = os.path.join(directory, 'hardware.sock')
+    port = free_port()
+    owner_proc = spawn('owner', db, path)
+    workers = spawn('workers', db, path, port, args.workers)
+    try:
+        wait_for(lambda: answers(port))
+        print('hardware owner + %d workers over hwipc' % args.workers)
+        load(port, args.concurrency, args.seconds)
+    finally:
+        stop(workers, owner_proc)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Track startup cost on the simulated hardware: module import times in a fresh interpreter, and the time
+# from launching the process to the first successfully served request.
+# Usage: python benchmarks/bench_startup.py [--runs N]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ['TRASHCAN_HARDWARE'] = 'sim'
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+import bench_serving
+import storage
+
+MODULES = ('app', 'owner', 'service', 'sch', 'bc_scanner', 'outbox', 'sync', 'records', 'hwipc')
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, %r)
+import storage
+storage.DATABASE = %r
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+'''
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def import_time(module, db):
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % (ROOT, db, module)])
+    return float(out.decode().split()[-1])
+
+# Seconds from launching procs to the first 200 from path on port
+def first_request(procs, port, path, timeout=30.0):
+    start = time.perf_counter()
+    launched = [bench_serving.spawn(*args) for args in procs]
+    try:
+        deadline = start + timeout
+        while time.perf_counter() < deadline:
+            try:
+                conn = bench_serving.http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', path)
+                if conn.getresponse().status == 200:
+                    return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise RuntimeError('no response from ' + path)
+    finally:
+        bench_serving.stop(*launched)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    db = os.path.join(directory, 'bench.db')
+    with open(os.path.join(ROOT, 'database', 'init_db.sql')) as f:
+        storage.connect(db).executescript(f.read())
+    storage.DATABASE = db
+    import config
+    config.set_config('HOME_SERVER_URL', 'http://127.0.0.1:9')
+
+    print('%-44s %10s' % ('import (fresh interpreter)', 'median'))
+    for module in MODULES:
+        print('%-44s %7.1f ms' % (module, median([import_time(module, db) for _ in range(args.runs)]) * 1000))
+
+    print()
+    print('%-44s %10s' % ('launch -> first served request', 'median'))
+    path = os.path.join(directory, 'hardware.sock')
+    cases = (
+        ('single process, GET /api/config/TARE', lambda port: [('single', db, port)], '/api/config/TARE'),
+        ('single process, GET /api/lid', lambda port: [('single', db, port)], '/api/lid'),
+        ('worker, GET /api/config/TARE', lambda port: [('workers', db, path, port, 1)], '/api/config/TARE'),
+        ('owner + worker, GET /api/lid', lambda port: [('owner', db, path), ('workers', db, path, port, 1)], '/api/lid')
+    )
+    for name, procs, url in cases:
+        times = []
+        for _ in range(args.runs):
+            port = bench_serving.free_port()
+            times.append(first_request(procs(port), port, url))
+        print('%-44s %7.1f ms' % (name, median(times) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Micro-benchmark of SQLite insert and query rates through the storage module.
+# Usage: python benchmarks/bench_storage.py [rows]
+# Runs against a scratch database built from database/init_db.sql, never the live one.
+import datetime
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def report(name, count, elapsed):
+    print('%-36s %8d ops %9.3f s %12.0f ops/s' % (name, count, elapsed, count / elapsed))
+
+def timed(name, count, fn):
+    start = time.perf_counter()
+    fn()
+    report(name, count, time.perf_counter() - start)
+
+def make_rows(n):
+    start = datetime.datetime(2019, 4, 1)
+    return [(str(uuid.uuid4()), start + datetime.timedelta(seconds=i), i % 5000, str(i)) for i in range(n)]
+
+def main(n):
+    storage.DATABASE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    with open(os.path.join(ROOT, 'database', 'init_db.sql')) as f:
+        storage.connect().executescript(f.read())
+    conn = storage.get_db()
+    columns = ('weight_id', 'timestamp', 'weight', 'weight_raw')
+    rows = make_rows(n)
+    single = rows[:min(n, 2000)]
+
+    # Baseline: one statement and one commit per row, like the old Weight.post
+    def one_by_one():
+        for row in single:
+            conn.execute("INSERT INTO Weight (weight_id, timestamp, weight, weight_raw) VALUES(?, ?, ?, ?)", row)
+            conn.commit()
+    timed('insert, commit per row', len(single), one_by_one)
+    storage.execute("DELETE FROM Weight")
+
+    timed('insert_many, one transaction', n, lambda: storage.insert_many('Weight', columns, rows))
+
+    ids = [row[0] for row in rows[::max(1, n // 5000)]]
+    timed('select by weight_id', len(ids), lambda: [
+        storage.query("SELECT * FROM Weight WHERE weight_id = ?", (i,)) for i in ids])
+
+    ranges = [(rows[i][1], rows[i][1] + datetime.timedelta(seconds=60)) for i in range(0, n, max(1, n // 1000))]
+    timed('select 60 s timestamp range', len(ranges), lambda: [
+        storage.query("SELECT * FROM Weight WHERE timestamp >= ? AND timestamp < ?", r) for r in ranges])
+
+    # Same lookups without the indexes for comparison
+    conn.execute("DROP INDEX idx_Weight_weight_id")
+    conn.execute("DROP INDEX idx_Weight_timestamp")
+    few = ids[:50]
+    timed('select by weight_id (no index)', len(few), lambda: [
+        storage.query("SELECT * FROM Weight WHERE weight_id = ?", (i,)) for i in few])
+    conn.execute("CREATE INDEX idx_Weight_weight_id ON Weight (weight_id)")
+    conn.execute("CREATE INDEX idx_Weight_timestamp ON Weight (timestamp)")
+
+    def delete():
+        with conn:
+            storage.delete_many(conn, 'Weight', 'weight_id', ids)
+    timed('delete_many, one transaction', len(ids), delete)
+    storage.close_db()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
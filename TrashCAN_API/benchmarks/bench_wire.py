@@ -0,0 +1,87 @@
+# Bytes on the wire and encode cost of uploading a mix of weights, scans and status deltas, per-item
+# requests against one batch envelope in every available format.
+# Usage: python benchmarks/bench_wire.py [--records N]
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import requests
+import envelope
+
+URL = 'http://3.95.208.70:5000'
+
+def workload(n):
+    records = []
+    now = time.time()
+    for i in range(n):
+        choice = random.random()
+        if choice < 0.5:
+            records.append(('barcode', {'barcode': ''.join(random.choice('0123456789') for _ in range(12)), 'timestamp': now + i}))
+        elif choice < 0.8:
+            weight = round(random.uniform(0, 20000), 2)
+            records.append(('weight', {'weight_id': str(uuid.uuid1()), 'timestamp': now + i, 'weight': weight, 'weight_raw': weight}))
+        else:
+            records.append(('status', {random.choice(('lid', 'light', 'fan', 'led')): random.randint(0, 1)}))
+    return records
+
+# The request each record is sent as today, as outbox.UPLOADERS builds it
+def legacy_request(kind, data):
+    if kind == 'barcode':
+        return requests.Request('POST', URL + '/barcode-lookup', params={'upc': data['barcode']})
+    if kind == 'weight':
+        return requests.Request('POST', URL + '/sync/weight', json={'rows': [data]})
+    return requests.Request('POST', URL + '/update_status', params=data)
+
+# Request line, headers and body as sent by a requests session
+def wire_size(session, request):
+    prepared = session.prepare_request(request)
+    size = len('%s %s HTTP/1.1\r\n' % (prepared.method, prepared.path_url))
+    size += len('Host: 3.95.208.70:5000\r\n')
+    for name, value in prepared.headers.items():
+        size += len('%s: %s\r\n' % (name, value))
+    size += 2
+    body = prepared.body or b''
+    return size + len(body if isinstance(body, bytes) else body.encode())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    random.seed(1)
+    records = workload(args.records)
+    session = requests.Session()
+
+    print('%d records: %d scans, %d weights, %d status deltas' % (len(records),
+          sum(1 for r in records if r[0] == 'barcode'), sum(1 for r in records if r[0] == 'weight'),
+          sum(1 for r in records if r[0] == 'status')))
+    print()
+    print('%-24s %9s %12s %14s %14s' % ('', 'requests', 'bytes', 'bytes/record', 'encode/record'))
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        legacy = sum(wire_size(session, legacy_request(kind, data)) for kind, data in records)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    print('%-24s %9d %12d %14.1f %11.2f us' % ('per-item (current)', len(records), legacy, legacy / len(records),
+          elapsed / len(records) * 1e6))
+
+    for format in envelope.FORMATS:
+        for compress in (False, True):
+            envelope.encode(records, format, compress)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                body, headers = envelope.encode(records, format, compress)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            request = requests.Request('POST', URL + envelope.BATCH_ENDPOINT, data=body, headers=headers)
+            size = wire_size(session, request)
+            assert envelope.decode(body, headers['Content-Type'], compress)['records'] == [list(r) for r in records]
+            print('%-24s %9d %12d %14.1f %11.2f us   %4.1fx smaller' % (
+                'batch ' + format + (' + zlib' if compress else ''), 1, size, size / len(records),
+                elapsed / len(records) * 1e6, legacy / size))
+
+if __name__ == '__main__':
+    main()
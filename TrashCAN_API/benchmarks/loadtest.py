@@ -0,0 +1,225 @@
+# End-to-end load test on the simulated hardware backend.
+# Usage: python benchmarks/loadtest.py [--requests N] [--concurrency C] [--lid-cycles N] [--rows N] [--server-latency S] [--batch]
+#
+# Runs the whole app in-process against a scratch database, with a local stand-in for the home server,
+# and reports throughput and p50/p99 latency for every REST resource, the lid loop and phone_home sync.
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ['TRASHCAN_HARDWARE'] = 'sim'
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import envelope
+import storage
+
+# Home server stand-in
+
+class HomeServerHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    requests = 0
+    batch = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        HomeServerHandler.requests += 1
+        time.sleep(self.latency)
+        if self.path.startswith(envelope.BATCH_ENDPOINT):
+            if not self.batch:
+                self.send_error(404)
+                return
+            self.reply({'formats': list(envelope.FORMATS), 'encodings': ['deflate']})
+            return
+        self.reply([] if self.path.startswith('/jobs') else {})
+
+    def do_POST(self):
+        HomeServerHandler.requests += 1
+        time.sleep(self.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.path.startswith(envelope.BATCH_ENDPOINT):
+            body = envelope.decode(body, self.headers.get('Content-Type'), self.headers.get('Content-Encoding') == 'deflate')
+            self.reply({'results': [[True, {} if kind == 'barcode' else None] for kind, data in body['records']]})
+        elif self.path.startswith('/sync/'):
+            rows = json.loads(body.decode() or '{}').get('rows', [])
+            self.reply({'ack': [row.get('weight_id') or row.get('barcode_id') for row in rows]})
+        else:
+            self.reply({'ok': True})
+
+def start_home_server(latency, batch):
+    HomeServerHandler.latency = latency
+    HomeServerHandler.batch = batch
+    server = ThreadingHTTPServer(('127.0.0.1', 0), HomeServerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+# Reporting
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+def report(name, latencies, elapsed):
+    print('%-48s %7d %10.0f/s %9.2f ms %9.2f ms' % (
+        name, len(latencies), len(latencies) / elapsed if elapsed else 0,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+def header(title):
+    print()
+    print('%-48s %7s %12s %12s %12s' % (title, 'count', 'throughput', 'p50', 'p99'))
+
+# Benchmarks
+
+def bench_resource(app, method, path, count, concurrency):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(n):
+        client = app.test_client()
+        mine = []
+        for i in range(n):
+            url = path.replace('{id}', str(uuid.uuid4()))
+            start = time.perf_counter()
+            response = client.open(url, method=method)
+            response.get_data()
+            mine.append(time.perf_counter() - start)
+            if response.status_code >= 500:
+                print('  %s %s -> %d' % (method, url, response.status_code))
+                break
+        with lock:
+            latencies.extend(mine)
+
+    per_worker = max(1, count // concurrency)
+    threads = [threading.Thread(target=worker, args=(per_worker,)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report(method + ' ' + path, latencies, time.perf_counter() - start)
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise RuntimeError('timed out')
+        time.sleep(0.0002)
+
+def bench_lid(owner, service, cycles):
+    opens = []
+    closes = []
+    start = time.perf_counter()
+    for i in range(cycles):
+        t0 = time.perf_counter()
+        service.lid_switch.press()
+        wait_for(owner.lid_is_open.is_set)
+        opens.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        service.lid_switch.release()
+        wait_for(lambda: not owner.lid_is_open.is_set())
+        closes.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    report('lid open -> handled', opens, elapsed)
+    report('lid close -> handled', closes, elapsed)
+
+def bench_sync(sync, rows):
+    now = datetime.datetime.now()
+    storage.insert_many('Weight', ('weight_id', 'timestamp', 'weight', 'weight_raw'),
+                        [(str(uuid.uuid4()), now, i, str(i)) for i in range(rows)])
+    storage.insert_many('Barcode', ('barcode_id', 'timestamp', 'barcode'),
+                        [(str(uuid.uuid4()), now, '0123456789%02d' % (i % 100)) for i in range(rows)])
+    start = time.perf_counter()
+    sync.sync_all()
+    elapsed = time.perf_counter() - start
+    left = storage.query("SELECT (SELECT COUNT(*) FROM Weight) + (SELECT COUNT(*) FROM Barcode)")[0][0]
+    print('%-48s %7d %10.0f/s %9.2f s total, %d rows left' % ('phone_home bulk sync', 2 * rows, 2 * rows / elapsed, elapsed, left))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--lid-cycles', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--server-latency', type=float, default=0.0)
+    parser.add_argument('--batch', action='store_true', help='home server accepts batch envelopes')
+    args = parser.parse_args()
+
+    server, url = start_home_server(args.server_latency, args.batch)
+    storage.DATABASE = os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+    with open(os.path.join(ROOT, 'database', 'init_db.sql')) as f:
+        storage.connect().executescript(f.read())
+
+    import config
+    config.set_config('HOME_SERVER_URL', url)
+    import app as app_module
+    import outbox
+    import owner
+    import sch
+    import service
+    import sync
+
+    # In-memory job store and no built-in jobs so nothing fires during the run
+    sch.Config.SCHEDULER_JOBSTORES = {}
+    sch.Config.JOBS = []
+    app = app_module.create_api()
+    owner.init_scheduler(app)
+    service.get_scheduler().start()
+    service.scale_sampler
+    outbox.start()
+    threading.Thread(target=owner.start_lid_monitor, daemon=True).start()
+    service.hx711.set_weight(1500)
+    time.sleep(0.5)
+
+    header('REST resource')
+    for method, path in (
+            ('GET', '/api/lid'),
+            ('PUT', '/api/lid?action=toggle'),
+            ('GET', '/api/scale'),
+            ('PUT', '/api/scale'),
+            ('GET', '/api/light'),
+            ('PUT', '/api/light?action=toggle'),
+            ('GET', '/api/fan'),
+            ('PUT', '/api/fan?action=toggle'),
+            ('POST', '/api/weight/{id}?weight_raw=1500'),
+            ('GET', '/api/weight/{id}'),
+            ('DELETE', '/api/weight/{id}'),
+            ('GET', '/api/weight?limit=100'),
+            ('GET', '/api/weight?format=ndjson'),
+            ('POST', '/api/barcode/{id}?barcode=012345678905'),
+            ('GET', '/api/barcode/{id}'),
+            ('DELETE', '/api/barcode/{id}'),
+            ('GET', '/api/barcode?limit=100'),
+            ('GET', '/api/config'),
+            ('GET', '/api/config/TARE'),
+            ('PUT', '/api/config/LOADTEST?value=1'),
+            ('GET', '/api/metrics')):
+        bench_resource(app, method, path, args.requests, args.concurrency)
+
+    header('Lid loop')
+    bench_lid(owner, service, args.lid_cycles)
+
+    header('Sync')
+    bench_sync(sync, args.rows)
+    print()
+    print('home server requests: %d' % HomeServerHandler.requests)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
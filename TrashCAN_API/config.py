@@ -1,67 +1,292 @@
+import logging
 import sqlite3
-#import logging
-from flask import g
+from threading import Thread, Event, RLock
+from types import MappingProxyType
+import storage
 
-#Setup database
-DATABASE = '/srv/trashcan/venv/database/database.db'
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('true', '1', 'yes', 'on')
 
-# Dict to hold configurations
-conf = {}
+# Type and default of every System_Options key. Empty or unparseable values fall back to the default.
+SCHEMA = {
+    'SCALE_DATA_PIN': (int, 24),
+    'SCALE_CLOCK_PIN': (int, 25),
+    'SCALE_CHANNEL': (str, 'A'),
+    'SCALE_GAIN': (int, 64),
+    'LID_SWITCH_PIN': (int, 14),
+    'LID_OPEN_PIN': (int, 15),
+    'LID_CLOSE_PIN': (int, 18),
+    'LIGHT_PIN': (int, 8),
+    'FAN_PIN': (int, 7),
+    'LED_PIN': (int, 12),
+    'WATCHDOG_SLEEP_TIMER': (float, 15.0),
+    'LID_SLEEP_TIMER': (float, 5.0),
+    'CLEANING_LED': (_bool, True),
+    'NUM_MEASUREMENTS': (int, 25),
+    'TARE': (float, 0.0),
+    'BC_TRIGGER_PIN': (int, 23),
+    'BARCODE_SCANNER_PATH': (str, '/dev/hidraw0'),
+    'HOME_SERVER_URL': (str, 'http://3.95.208.70:5000'),
+    'LONG_CYCLE_BOTH_HOUR': (str, ''),
+    'LONG_CYCLE_BOTH_MINUTE': (str, ''),
+    'SHORT_CYCLE_BOTH_HOUR': (str, ''),
+    'SHORT_CYCLE_BOTH_MINUTE': (str, ''),
+    'LONG_CYCLE_SLEEP': (int, 600),
+    'SHORT_CYCLE_SLEEP': (int, 120),
+    'PHONE_HOME_SLEEP': (int, 30),
+    'PI_BROADCAST_PORT': (int, 10001),
+    'CONVERSION_FACTOR': (float, 1.0),
+    'UPLOAD_FAILURE_LIMIT': (int, 2),
+    'SYNC_BATCH_SIZE': (int, 200),
+    'SCALE_SETTLE_TOLERANCE': (float, 5.0),
+    'SCALE_OFFSET': (float, 30500.0),
+    'SCALE_CAL_GAIN': (float, 0.0095),
+    'SCALE_ZERO': (float, 1000.0),
+    'SCALE_FILTER': (str, 'band'),
+    'SCALE_SMOOTHING': (str, 'none'),
+    'SCALE_USE_NUMPY': (_bool, True),
+    'LID_DEBOUNCE_MS': (float, 50.0),
+    'OUTBOX_CONCURRENCY': (int, 2),
+    'STATUS_COALESCE_MS': (float, 100.0),
+    'WEIGHT_EVENT_INTERVAL': (float, 1.0),
+    'EVENT_STREAMS_MAX': (int, 4),
+    'CONFIG_POLL_MS': (float, 500.0),
+    'HARDWARE_SOCKET': (str, '/run/trashcan/hardware.sock'),
+    'UPC_CACHE_SIZE': (int, 1000),
+    'UPC_CACHE_MAX_ROWS': (int, 50000),
+    'UPC_CACHE_TTL': (float, 604800.0),
+    'SCAN_DEDUPE_WINDOW': (float, 2.0),
+    'SCAN_DEDUPE_MAX': (int, 256),
+    'UPLOAD_FORMAT': (str, 'auto'),
+    'UPLOAD_COMPRESS': (_bool, True),
+    'UPLOAD_BATCH_MAX': (int, 200),
+    'WEIGHT_DOWNSAMPLE_AFTER': (float, 86400.0),
+    'WEIGHT_RAW_RETENTION': (float, 2592000.0),
+    'WEIGHT_HOUR_RETENTION': (float, 31536000.0),
+    'PHONE_HOME_IDLE_SLEEP': (int, 300),
+    'PHONE_HOME_BACKOFF_MAX': (int, 1800),
+    'PHONE_HOME_BACKLOG': (int, 100),
+    'DISCOVERY_ANNOUNCE': (_bool, True),
+    'DISCOVERY_CHECK': (float, 30.0),
+    'SCALE_COUNT': (int, 1),
+    'SCANNER_COUNT': (int, 1),
+    'OUTBOX_MAX_ATTEMPTS': (int, 20)
+}
 
-def __init__():
-    nonlocal conf
-    load_config()
+DEFAULTS = dict((name, default) for name, (cast, default) in SCHEMA.items())
+
+# Scales and scanners after the first are configured with indexed options: OPTION_<n> sets OPTION for
+# device n, e.g. SCALE_DATA_PIN_1 or BARCODE_SCANNER_PATH_2. Device 0 uses the plain options.
+def indexed(option_name, index):
+    return option_name + '_' + str(index) if index else option_name
+
+# The SCHEMA entry an option name is typed by, or None
+def _schema_name(option_name):
+    if option_name in SCHEMA:
+        return option_name
+    base, sep, suffix = option_name.rpartition('_')
+    if sep and suffix.isdigit() and base in SCHEMA:
+        return base
+    return None
+
+def coerce(option_name, value):
+    schema_name = _schema_name(option_name)
+    if schema_name is None:
+        return value
+    cast, default = SCHEMA[schema_name]
+    if value is None or value == '':
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        logging.warning('Bad value %r for option %s, using %r', value, option_name, default)
+        return default
+
+# Immutable typed view of System_Options. Readers just take the current snapshot, so reads never
+# lock or touch SQLite. Writers build a new snapshot and swap the reference.
+_snapshot = None
+_change_id = 0
+_pending = set()
+_write_lock = RLock()
+
+def _current():
+    if _snapshot is None:
+        load_config()
+    return _snapshot
+
+class _Conf:
+    def __getitem__(self, option_name):
+        return _current()[option_name]
+
+    def __contains__(self, option_name):
+        return option_name in _current()
+
+    def get(self, option_name, default=None):
+        return _current().get(option_name, default)
+
+    def snapshot(self):
+        return _current()
+
+# Dict-like access to the current snapshot
+conf = _Conf()
 
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-    return db
-
-# Without an option_name, this reloads all options. With an option name this reload a specific option
-def load_config(option_name = ''):
-    nonlocal conf
-    conn = get_db()
-    if option_name == '':
-        conf.clear()
-        result = conn.cursor().execute("SELECT * FROM System_Options")
-    else:
-        conf.pop(option_name)
-        result = conn.cursor().execute("SELECT TOP 1 FROM System_Options WHERE option_name = ?",(option_name,))
+    return storage.get_db()
+
+def _swap(values, change_id):
+    global _snapshot, _change_id
+    _snapshot = MappingProxyType(values)
+    _change_id = change_id
 
-    for row in result:
-        conf[row[0]] = row
-    conn.close()
-    return
+# Reload every option from the database into a fresh snapshot
+def load_config():
+    with _write_lock:
+        conn = get_db()
+        change_id = get_last_change_id()
+        values = dict(DEFAULTS)
+        for option_name, option_value in conn.execute("SELECT option_name, option_value FROM System_Options"):
+            values[option_name] = coerce(option_name, option_value)
+        _swap(values, change_id)
 
 def get_last_change_id():
     conn = get_db()
-    result = conn.cursor().execute("SELECT CAST(MAX(change_id)) AS INT FROM System_Option_Changes")
-    conn.close()
-    return result
+    result = conn.execute("SELECT MAX(system_option_change_id) FROM System_Option_Changes").fetchone()
+    return result[0] or 0
 
-def get_config(option_name = ''):
+# Change log rows newer than change_id, oldest first
+def get_changes_since(change_id):
     conn = get_db()
+    return conn.execute("SELECT system_option_change_id, change_type, option_name, Old_option_name, option_value "
+                        "FROM System_Option_Changes WHERE system_option_change_id > ? "
+                        "ORDER BY system_option_change_id", (change_id,)).fetchall()
+
+# Apply change log rows to a copy of the snapshot and swap it in. Returns the set of option names that changed.
+def apply_changes(changes):
+    if not changes:
+        return set()
+    with _write_lock:
+        values = dict(_current())
+        changed = set()
+        for change_id, change_type, option_name, old_option_name, option_value in changes:
+            # Already in the snapshot, e.g. read before another thread applied a newer list
+            if change_id <= _change_id:
+                continue
+            if change_type == 'D' or (change_type == 'U' and old_option_name != option_name):
+                values.pop(old_option_name, None)
+                if old_option_name in DEFAULTS:
+                    values[old_option_name] = DEFAULTS[old_option_name]
+                changed.add(old_option_name)
+            if change_type in ('I', 'U'):
+                values[option_name] = coerce(option_name, option_value)
+                changed.add(option_name)
+        _swap(values, max(_change_id, changes[-1][0]))
+    return changed
+
+# Apply any changes logged since the current snapshot. Returns the set of option names that changed.
+# They are also queued for the watcher to pass on to listeners.
+def refresh():
+    _current()
+    # Read and apply under one lock so a stale change list can't be applied over a newer snapshot
+    with _write_lock:
+        changed = apply_changes(get_changes_since(_change_id))
+        _pending.update(changed)
+    return changed
+
+def _take_pending():
+    global _pending
+    with _write_lock:
+        changed, _pending = _pending, set()
+    return changed
+
+# Calibration belongs to one load cell, so a device after the first never borrows the plain option:
+# without OPTION_<index> it gets the SCHEMA default (no tare, the uncalibrated gain and offsets).
+DEVICE_ONLY = ('TARE', 'SCALE_OFFSET', 'SCALE_CAL_GAIN', 'SCALE_ZERO')
+
+# The options as device index sees them: OPTION_<index> in place of OPTION wherever it is set.
+# Anything a device doesn't set falls back to the plain option, except the required options (its
+# pins and paths), which every device after the first must set itself, and DEVICE_ONLY.
+def device_conf(index, required=()):
+    missing = [indexed(option_name, index) for option_name in required if index and indexed(option_name, index) not in conf]
+    if missing:
+        raise ValueError('Device %d needs %s' % (index, ', '.join(missing)))
+    values = dict(_current())
+    if index:
+        for option_name in DEVICE_ONLY:
+            values[option_name] = DEFAULTS[option_name]
+        suffix = '_' + str(index)
+        for option_name, value in _current().items():
+            if option_name.endswith(suffix) and option_name[:-len(suffix)] in SCHEMA:
+                values[option_name[:-len(suffix)]] = value
+    return values
+
+def get_config(option_name = ''):
     if option_name == '':
-        result = conn.cursor().execute("SELECT * FROM System_Options")
-    else:
-        result = conn.cursor().execute("SELECT TOP 1 FROM System_Options WHERE option_name = ?", (option_name,))
-    conn.close()
-    return result
+        return dict(_current())
+    return _current().get(option_name)
 
 def set_config(option_name, value):
+    option_name = option_name.upper()
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT TOP 1 FROM System_Options WHERE option_name = ?",(option_name,))
-    if cur.rowcount == 0:
-        conn.cursor().execute("INSERT INTO System_Options (option_name, option_value) VALUES(?, ?)",(option_name.uppper(), value,))
-    else:
-        conn.cursor().execute("UPDATE System_Options SET option_value = ? WHERE option_name = ?", (option_name.upper(),value,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cur = conn.execute("UPDATE System_Options SET option_value = ? WHERE option_name = ?", (value, option_name))
+        if cur.rowcount == 0:
+            conn.execute("INSERT INTO System_Options (option_name, option_value) VALUES(?, ?)", (option_name, value))
+    _notify()
 
 def delete_config(option_name):
     conn = get_db()
-    conn.cursor().execute("DELETE FROM System_Options WHERE option_name = ?",_(option_name,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with conn:
+        conn.execute("DELETE FROM System_Options WHERE option_name = ?", (option_name.upper(),))
+    _notify()
+
+# Watches for committed changes using PRAGMA data_version on its own connection. data_version only
+# moves when another connection commits, so the idle check never reads a table. Writes made through
+# set_config/delete_config wake the watcher immediately.
+_wake = Event()
+_listeners = []
+_watcher = None
+
+def _notify():
+    refresh()
+    _wake.set()
+
+# Call listener(changed_option_names) from the watcher thread whenever options change
+def add_listener(listener):
+    _listeners.append(listener)
+
+class Watcher(Thread):
+    def __init__(self, poll=0.5):
+        Thread.__init__(self, name='config-watcher', daemon=True)
+        self.poll = poll
+
+    def run(self):
+        conn = storage.connect()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        while True:
+            _wake.wait(self.poll)
+            _wake.clear()
+            new_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if new_version != version:
+                version = new_version
+                try:
+                    refresh()
+                except sqlite3.Error as e:
+                    logging.error('Config refresh failed: %s', e)
+                    continue
+            changed = _take_pending()
+            if changed:
+                logging.info('Options changed: %s', ', '.join(sorted(changed)))
+                for listener in _listeners:
+                    try:
+                        listener(changed)
+                    except Exception as e:
+                        logging.exception('Config listener failed: %s', e)
+
+def start_watcher():
+    global _watcher
+    if _watcher is None:
+        _watcher = Watcher(poll=conf['CONFIG_POLL_MS'] / 1000)
+        _watcher.start()
+    return _watcher
@@ -0,0 +1,120 @@
+import logging
+import time
+from threading import Thread, Condition
+import metrics
+import service
+
+# Cleaning cycles as a state machine driven by one timer thread. Starting a cycle switches the fan
+# and light on and records when they should go off; nothing sleeps in a scheduler worker.
+#
+#   IDLE    --start-->        RUNNING   fan and light on until `end`
+#   RUNNING --start-->        RUNNING   end extended to cover the new cycle (overlaps merge)
+#   RUNNING --lid opens-->    PAUSED    fan and light off, `remaining` kept
+#   PAUSED  --start-->        PAUSED    remaining extended
+#   PAUSED  --lid closes-->   RUNNING   fan and light back on for `remaining`
+#   RUNNING --end reached-->  IDLE      fan and light off
+
+IDLE = 'idle'
+RUNNING = 'running'
+PAUSED = 'paused'
+
+class CycleEngine(Thread):
+    def __init__(self, lid_is_open=lambda: service.lid_switch.value):
+        Thread.__init__(self, name='cleaning-cycles', daemon=True)
+        self.lid_is_open = lid_is_open
+        self.cond = Condition()
+        self.state = IDLE
+        self.end = None
+        self.remaining = 0.0
+
+    def status(self):
+        with self.cond:
+            remaining = self.remaining if self.state == PAUSED else max(0.0, (self.end or 0) - time.time())
+            return {'state': self.state, 'remaining': remaining if self.state != IDLE else 0.0}
+
+    # Request a cycle of length seconds. Returns the resulting state.
+    def add(self, length):
+        with self.cond:
+            now = time.time()
+            if self.state == IDLE:
+                if service.fan.value or service.light.value:
+                    logging.warning('Fan or light already on, skipping cleaning cycle')
+                    return self.state
+                if self.lid_is_open():
+                    self.state = PAUSED
+                    self.remaining = length
+                    logging.info('Lid open, cleaning cycle of %d s deferred', length)
+                    return self.state
+                self._on()
+                self.state = RUNNING
+                self.end = now + length
+            elif self.state == RUNNING:
+                self.end = max(self.end, now + length)
+                logging.info('Cleaning cycle extended to %d s', self.end - now)
+            else:
+                self.remaining = max(self.remaining, length)
+            self.cond.notify()
+            return self.state
+
+    def pause(self):
+        with self.cond:
+            if self.state != RUNNING:
+                return
+            self.remaining = max(0.0, self.end - time.time())
+            self.state = PAUSED
+            self.end = None
+            self._off()
+            logging.info('Cleaning cycle paused with %d s left', self.remaining)
+            self.cond.notify()
+
+    def resume(self):
+        with self.cond:
+            if self.state != PAUSED:
+                return
+            self._on()
+            self.state = RUNNING
+            self.end = time.time() + self.remaining
+            self.remaining = 0.0
+            self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            while True:
+                if self.state != RUNNING:
+                    self.cond.wait()
+                    continue
+                wait = self.end - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                self._off()
+                self.state = IDLE
+                self.end = None
+                logging.info('Cleaning cycle complete')
+
+    def _on(self):
+        service.set_fan('on')
+        service.set_light('on')
+
+    def _off(self):
+        service.set_fan('off')
+        service.set_light('off')
+
+_engine = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = CycleEngine()
+        _engine.start()
+        metrics.gauge('cycles', _engine.status)
+    return _engine
+
+def start(length):
+    return get_engine().add(length)
+
+def pause():
+    get_engine().pause()
+
+def resume():
+    get_engine().resume()
@@ -18,16 +18,81 @@ CREATE TABLE System_Option_Changes (
 CREATE TABLE Barcode (
 	barcode_id varchar,
 	timestamp datetime DEFAULT CURRENT_TIMESTAMP,
-	barcode varchar
+	barcode varchar,
+	scanner integer DEFAULT 0
 );
 
 CREATE TABLE Weight (
 	weight_id varchar,
 	timestamp datetime DEFAULT CURRENT_TIMESTAMP,
 	weight integer,
-	weight_raw varchar
+	weight_raw varchar,
+	scale integer DEFAULT 0
 );
 
+CREATE INDEX idx_Barcode_barcode_id ON Barcode (barcode_id);
+CREATE INDEX idx_Barcode_timestamp ON Barcode (timestamp);
+CREATE INDEX idx_Weight_weight_id ON Weight (weight_id);
+CREATE INDEX idx_Weight_timestamp ON Weight (timestamp);
+
+CREATE TABLE Sync_State (
+	table_name varchar PRIMARY KEY,
+	last_rowid integer
+);
+
+CREATE TABLE Outbox (
+	outbox_id varchar PRIMARY KEY,
+	kind varchar,
+	payload varchar,
+	created real,
+	attempts integer DEFAULT 0,
+	next_attempt real DEFAULT 0
+);
+
+CREATE INDEX idx_Outbox_next_attempt ON Outbox (next_attempt);
+
+CREATE TABLE Outbox_Dead (
+	outbox_id varchar PRIMARY KEY,
+	kind varchar,
+	payload varchar,
+	created real,
+	attempts integer,
+	failed real,
+	error varchar
+);
+
+CREATE TABLE Upc_Cache (
+	upc varchar PRIMARY KEY,
+	result varchar,
+	fetched real
+);
+
+CREATE INDEX idx_Upc_Cache_fetched ON Upc_Cache (fetched);
+
+CREATE TABLE State (
+	name varchar PRIMARY KEY,
+	value
+);
+
+CREATE TABLE Weight_Series (
+	timestamp real NOT NULL,
+	weight real NOT NULL,
+	scale integer NOT NULL DEFAULT 0
+);
+
+CREATE INDEX idx_Weight_Series_timestamp ON Weight_Series (timestamp);
+
+CREATE TABLE Weight_Rollup (
+	resolution integer NOT NULL,
+	scale integer NOT NULL DEFAULT 0,
+	bucket integer NOT NULL,
+	samples integer NOT NULL,
+	weight_min real,
+	weight_max real,
+	weight_sum real,
+	PRIMARY KEY (resolution, scale, bucket)
+) WITHOUT ROWID;
+
 CREATE TRIGGER trg_System_Options_Delete AFTER DELETE ON System_Options
 BEGIN
   INSERT INTO System_Option_Changes (system_option_id,change_type,Old_option_name,Old_option_value)
@@ -69,7 +134,42 @@ INSERT INTO System_Options (option_name, option_value) VALUES('LONG_CYCLE_BOTH_M
 INSERT INTO System_Options (option_name, option_value) VALUES('SHORT_CYCLE_BOTH_HOUR','');
 INSERT INTO System_Options (option_name, option_value) VALUES('SHORT_CYCLE_BOTH_MINUTE','');
 INSERT INTO System_Options (option_name, option_value) VALUES('PHONE_HOME_SLEEP','30');
-INSERT INTO System_Options (option_name, option_value) VALUES('BROADCAST_SLEEP','30');
 INSERT INTO System_Options (option_name, option_value) VALUES('PI_BROADCAST_PORT','10001');
 INSERT INTO System_Options (option_name, option_value) VALUES('CONVERSION_FACTOR','');
 INSERT INTO System_Options (option_name, option_value) VALUES('UPLOAD_FAILURE_LIMIT','2');
+INSERT INTO System_Options (option_name, option_value) VALUES('SYNC_BATCH_SIZE','200');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_SETTLE_TOLERANCE','5');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_OFFSET','30500');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_CAL_GAIN','0.0095');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_ZERO','1000');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_FILTER','band');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_SMOOTHING','none');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_USE_NUMPY','true');
+INSERT INTO System_Options (option_name, option_value) VALUES('LID_DEBOUNCE_MS','50');
+INSERT INTO System_Options (option_name, option_value) VALUES('OUTBOX_CONCURRENCY','2');
+INSERT INTO System_Options (option_name, option_value) VALUES('STATUS_COALESCE_MS','100');
+INSERT INTO System_Options (option_name, option_value) VALUES('WEIGHT_EVENT_INTERVAL','1');
+INSERT INTO System_Options (option_name, option_value) VALUES('EVENT_STREAMS_MAX','4');
+INSERT INTO System_Options (option_name, option_value) VALUES('LONG_CYCLE_SLEEP','600');
+INSERT INTO System_Options (option_name, option_value) VALUES('SHORT_CYCLE_SLEEP','120');
+INSERT INTO System_Options (option_name, option_value) VALUES('CONFIG_POLL_MS','500');
+INSERT INTO System_Options (option_name, option_value) VALUES('HARDWARE_SOCKET','/run/trashcan/hardware.sock');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPC_CACHE_SIZE','1000');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPC_CACHE_MAX_ROWS','50000');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPC_CACHE_TTL','604800');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCAN_DEDUPE_WINDOW','2');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCAN_DEDUPE_MAX','256');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPLOAD_FORMAT','auto');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPLOAD_COMPRESS','true');
+INSERT INTO System_Options (option_name, option_value) VALUES('UPLOAD_BATCH_MAX','200');
+INSERT INTO System_Options (option_name, option_value) VALUES('WEIGHT_DOWNSAMPLE_AFTER','86400');
+INSERT INTO System_Options (option_name, option_value) VALUES('WEIGHT_RAW_RETENTION','2592000');
+INSERT INTO System_Options (option_name, option_value) VALUES('WEIGHT_HOUR_RETENTION','31536000');
+INSERT INTO System_Options (option_name, option_value) VALUES('PHONE_HOME_IDLE_SLEEP','300');
+INSERT INTO System_Options (option_name, option_value) VALUES('PHONE_HOME_BACKOFF_MAX','1800');
+INSERT INTO System_Options (option_name, option_value) VALUES('PHONE_HOME_BACKLOG','100');
+INSERT INTO System_Options (option_name, option_value) VALUES('DISCOVERY_ANNOUNCE','true');
+INSERT INTO System_Options (option_name, option_value) VALUES('DISCOVERY_CHECK','30');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCALE_COUNT','1');
+INSERT INTO System_Options (option_name, option_value) VALUES('SCANNER_COUNT','1');
+INSERT INTO System_Options (option_name, option_value) VALUES('OUTBOX_MAX_ATTEMPTS','20');
@@ -0,0 +1,134 @@
+import logging
+import socket
+import time
+from threading import Thread
+import config
+import metrics
+
+# Finding the bin on the local network. One UDP socket bound to PI_BROADCAST_PORT answers every
+# QUERY packet with the bin's address, sent straight back to the asker, so a client that broadcasts
+# a query hears back in milliseconds and nothing is sent while nobody is asking.
+#
+# The address is the one the default route would use. Working it out only connects a UDP socket,
+# which sends nothing; it is cached and rechecked every DISCOVERY_CHECK seconds. With
+# DISCOVERY_ANNOUNCE on, the address is broadcast once at startup and again whenever it changes,
+# in the same plain-text form the periodic broadcast used.
+
+QUERY = b'TRASHCAN?'
+ROUTE_PROBE = ('10.255.255.255', 1) #Any address off the local host; nothing is sent to it
+
+# The address other hosts can reach this one at, or None without a network
+def local_address():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(ROUTE_PROBE)
+        return probe.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        probe.close()
+
+class Responder(Thread):
+    def __init__(self):
+        Thread.__init__(self, name='discovery', daemon=True)
+        self.sock = None
+        self.port = None
+        self.address = None
+        self.reply = None
+        self.checked = 0.0
+
+    def bind(self, port):
+        if self.sock is not None:
+            self.sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(('', port))
+        self.sock = sock
+        self.port = port
+        logging.info('Discovery listening on UDP port %d', port)
+
+    def announce(self):
+        try:
+            self.sock.sendto(self.reply, ('<broadcast>', self.port))
+            metrics.inc('discovery.announced')
+        except OSError as e:
+            logging.warning('Discovery announcement failed: %s', e)
+
+    # Pick up a changed port or address
+    def check(self):
+        self.checked = time.monotonic()
+        if config.conf['PI_BROADCAST_PORT'] != self.port:
+            self.bind(config.conf['PI_BROADCAST_PORT'])
+        address = local_address()
+        if address == self.address:
+            return
+        logging.info('Discovery address is %s', address)
+        self.address = address
+        self.reply = address.encode() if address else None
+        if self.reply and config.conf['DISCOVERY_ANNOUNCE']:
+            self.announce()
+
+    def run(self):
+        self.check()
+        while True:
+            interval = config.conf['DISCOVERY_CHECK']
+            remaining = self.checked + interval - time.monotonic()
+            if remaining <= 0:
+                try:
+                    self.check()
+                except OSError as e:
+                    logging.error('Discovery check failed: %s', e)
+                    time.sleep(interval)
+                continue
+            self.sock.settimeout(remaining)
+            try:
+                data, peer = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                logging.warning('Discovery receive failed: %s', e)
+                continue
+            # Our own announcements come back to this socket too
+            if data.strip() != QUERY:
+                continue
+            if self.reply is None:
+                metrics.inc('discovery.unanswered')
+                continue
+            try:
+                self.sock.sendto(self.reply, peer)
+                metrics.inc('discovery.answered')
+            except OSError as e:
+                logging.warning('Discovery reply to %s failed: %s', peer[0], e)
+
+_responder = None
+
+def start():
+    global _responder
+    if _responder is None:
+        _responder = Responder()
+        _responder.bind(config.conf['PI_BROADCAST_PORT'])
+        _responder.start()
+    return _responder
+
+# The client side: broadcast QUERY and collect the addresses that answer within timeout
+def find(port=None, timeout=1.0, target='<broadcast>'):
+    port = port or config.conf['PI_BROADCAST_PORT']
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    try:
+        sock.sendto(QUERY, (target, port))
+        found = []
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return found
+            sock.settimeout(remaining)
+            try:
+                data, peer = sock.recvfrom(512)
+            except socket.timeout:
+                return found
+            found.append(data.decode())
+    finally:
+        sock.close()
@@ -0,0 +1,125 @@
+import json
+import logging
+import time
+import zlib
+import config
+import metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Batched upload envelope. Many weights, scans and status deltas go to the home server in one POST to
+# BATCH_ENDPOINT instead of one request each:
+#   {"v": 1, "records": [[kind, data], ...]}
+# encoded as MessagePack, CBOR or JSON and optionally zlib-compressed (Content-Encoding: deflate).
+# The server answers {"results": [[ok, result], ...]}, one entry per record in the same order.
+#
+# GET BATCH_ENDPOINT returns the server's {"formats": [...], "encodings": [...]}. Until a server
+# answers that, or when UPLOAD_FORMAT is 'legacy', uploads use the per-item requests.
+
+VERSION = 1
+BATCH_ENDPOINT = '/batch'
+RENEGOTIATE = 600.0 #Seconds before asking the server again
+RETRY_NEGOTIATE = 60.0 #Seconds before retrying a negotiation that couldn't reach the server
+COMPRESS_LEVEL = 6
+
+def _json_dumps(body):
+    return json.dumps(body, separators=(',', ':')).encode()
+
+def _json_loads(data):
+    return json.loads(data.decode())
+
+# name -> (content type, dumps, loads), most compact first. Formats whose library isn't installed are left out.
+FORMATS = {}
+if msgpack is not None:
+    FORMATS['msgpack'] = ('application/msgpack', msgpack.packb, msgpack.unpackb)
+if cbor2 is not None:
+    FORMATS['cbor'] = ('application/cbor', cbor2.dumps, cbor2.loads)
+FORMATS['json'] = ('application/json', _json_dumps, _json_loads)
+
+CONTENT_TYPES = dict((content_type, name) for name, (content_type, dumps, loads) in FORMATS.items())
+
+# Encode records, [(kind, data), ...]. Returns (body bytes, headers).
+def encode(records, format='json', compress=False):
+    content_type, dumps, loads = FORMATS[format]
+    body = dumps({'v': VERSION, 'records': [[kind, data] for kind, data in records]})
+    headers = {'Content-Type': content_type}
+    if compress:
+        body = zlib.compress(body, COMPRESS_LEVEL)
+        headers['Content-Encoding'] = 'deflate'
+    return body, headers
+
+def decode(data, content_type='application/json', compressed=False):
+    if compressed:
+        data = zlib.decompress(data)
+    name = CONTENT_TYPES.get(content_type.split(';')[0].strip(), 'json')
+    return FORMATS[name][2](data)
+
+# (format, compress) agreed with the server, or None while uploads should use the per-item requests
+_negotiated = None
+_negotiated_at = None
+
+def _choose(offer):
+    wanted = config.conf['UPLOAD_FORMAT']
+    if wanted == 'legacy':
+        return None
+    formats = offer.get('formats', [])
+    for name in FORMATS:
+        if name in formats and wanted in ('auto', name):
+            return name, config.conf['UPLOAD_COMPRESS'] and 'deflate' in offer.get('encodings', [])
+    return None
+
+def negotiate(session, timeout=0.5):
+    import requests
+    global _negotiated, _negotiated_at
+    try:
+        r = session.get(config.conf['HOME_SERVER_URL'] + BATCH_ENDPOINT, timeout=timeout)
+        if r.status_code in (404, 405, 501):
+            _negotiated = None
+        else:
+            r.raise_for_status()
+            _negotiated = _choose(r.json())
+        _negotiated_at = time.monotonic()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.debug('Upload format negotiation failed: %s', e)
+        _negotiated = None
+        _negotiated_at = time.monotonic() - RENEGOTIATE + RETRY_NEGOTIATE
+    logging.debug('Upload format: %s', _negotiated or 'legacy')
+    return _negotiated
+
+# The agreed (format, compress), negotiating first if it is time to. None means per-item requests.
+def get_format(session):
+    if config.conf['UPLOAD_FORMAT'] == 'legacy':
+        return None
+    if _negotiated_at is None or time.monotonic() - _negotiated_at > RENEGOTIATE:
+        return negotiate(session)
+    return _negotiated
+
+# Forget the agreed format, e.g. after the server stopped accepting it
+def reset():
+    global _negotiated, _negotiated_at
+    _negotiated = None
+    _negotiated_at = None
+
+# POST records in one envelope. Returns [(ok, result), ...] in record order. Raises requests exceptions
+# and ValueError like the per-item uploads do.
+@metrics.timed('upload.batch')
+def post(session, records, format, compress=False, timeout=0.5):
+    body, headers = encode(records, format, compress)
+    metrics.inc('upload.batch.records', len(records))
+    metrics.inc('upload.batch.bytes', len(body))
+    r = session.post(config.conf['HOME_SERVER_URL'] + BATCH_ENDPOINT, data=body, headers=headers, timeout=timeout)
+    if r.status_code in (404, 415):
+        reset()
+    r.raise_for_status()
+    results = decode(r.content, r.headers.get('Content-Type', 'application/json')).get('results', [])
+    if len(results) != len(records):
+        raise ValueError('batch reply has %d results for %d records' % (len(results), len(records)))
+    return [(bool(ok), result) for ok, result in results]
@@ -0,0 +1,165 @@
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Median without a full sort. Expected O(n).
+def quickselect(values, k):
+    values = list(values)
+    while True:
+        if len(values) == 1:
+            return values[0]
+        pivot = values[random.randrange(len(values))]
+        lows = [x for x in values if x < pivot]
+        pivots = len(values) - len(lows) - sum(1 for x in values if x > pivot)
+        if k < len(lows):
+            values = lows
+        elif k < len(lows) + pivots:
+            return pivot
+        else:
+            k -= len(lows) + pivots
+            values = [x for x in values if x > pivot]
+
+def median(values):
+    return quickselect(values, len(values) // 2)
+
+# Outlier rejection. Each filter takes the samples and returns the ones to keep.
+
+# Keep values within +/- fraction of the median. This is the original Scale.get filter.
+def band_filter(values, fraction=0.25):
+    m = median(values)
+    lo, hi = sorted((m * (1 - fraction), m * (1 + fraction)))
+    return [x for x in values if lo <= x <= hi]
+
+# Keep values within k median absolute deviations of the median
+def mad_filter(values, k=3.0):
+    m = median(values)
+    mad = median([abs(x - m) for x in values])
+    if mad == 0:
+        return [x for x in values if x == m]
+    return [x for x in values if abs(x - m) <= k * mad]
+
+# Drop the lowest and highest fraction of the values
+def trimmed_filter(values, fraction=0.2):
+    values = sorted(values)
+    cut = int(len(values) * fraction)
+    return values[cut:len(values) - cut] or values
+
+def np_band_filter(values, fraction=0.25):
+    m = numpy.partition(values, len(values) // 2)[len(values) // 2]
+    lo, hi = sorted((m * (1 - fraction), m * (1 + fraction)))
+    return values[(values >= lo) & (values <= hi)]
+
+def np_mad_filter(values, k=3.0):
+    m = numpy.partition(values, len(values) // 2)[len(values) // 2]
+    dev = numpy.abs(values - m)
+    mad = numpy.partition(dev, len(dev) // 2)[len(dev) // 2]
+    if mad == 0:
+        return values[dev == 0]
+    return values[dev <= k * mad]
+
+def np_trimmed_filter(values, fraction=0.2):
+    cut = int(len(values) * fraction)
+    if cut == 0 or 2 * cut >= len(values):
+        return values
+    return numpy.partition(values, (cut, len(values) - cut - 1))[cut:len(values) - cut]
+
+FILTERS = {
+    'band': (band_filter, np_band_filter),
+    'mad': (mad_filter, np_mad_filter),
+    'trimmed': (trimmed_filter, np_trimmed_filter)
+}
+
+# Smoothing between successive estimates. Each smoother is called with the newest estimate.
+
+class NoSmoothing:
+    def __call__(self, x):
+        return x
+
+class ExponentialSmoothing:
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def __call__(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+# One dimensional Kalman filter for a constant weight with process noise q and measurement noise r
+class KalmanSmoothing:
+    def __init__(self, q=0.01, r=1.0):
+        self.q = q
+        self.r = r
+        self.reset()
+
+    def __call__(self, x):
+        if self.value is None:
+            self.value = x
+            return x
+        self.p += self.q
+        k = self.p / (self.p + self.r)
+        self.value += k * (x - self.value)
+        self.p *= 1 - k
+        return self.value
+
+    def reset(self):
+        self.value = None
+        self.p = 1.0
+
+SMOOTHERS = {
+    'none': NoSmoothing,
+    'ema': ExponentialSmoothing,
+    'kalman': KalmanSmoothing
+}
+
+# Turns a window of raw HX711 samples into a weight.
+# raw -> offset -> outlier rejection -> mean -> zero and gain -> smoothing
+class Estimator:
+    def __init__(self, offset=30500, gain=0.0095, zero=1000, filter='band', smoothing='none', use_numpy=True):
+        if filter not in FILTERS:
+            raise ValueError('Unknown scale filter: ' + str(filter))
+        if smoothing not in SMOOTHERS:
+            raise ValueError('Unknown scale smoothing: ' + str(smoothing))
+        self.offset = offset
+        self.gain = gain
+        self.zero = zero
+        self.use_numpy = use_numpy and numpy is not None
+        self.filter = FILTERS[filter][1 if self.use_numpy else 0]
+        self.smoother = SMOOTHERS[smoothing]()
+
+    # conf holds typed options, e.g. config.conf or config.device_conf(index)
+    @classmethod
+    def from_config(cls, conf):
+        return cls(
+            offset=conf['SCALE_OFFSET'],
+            gain=conf['SCALE_CAL_GAIN'],
+            zero=conf['SCALE_ZERO'],
+            filter=conf['SCALE_FILTER'],
+            smoothing=conf['SCALE_SMOOTHING'],
+            use_numpy=conf['SCALE_USE_NUMPY']
+        )
+
+    # Returns (weight, spread) where spread is the range of the kept samples in weight units,
+    # or (None, None) if every sample was rejected. Sample order does not matter.
+    def estimate(self, samples):
+        if self.use_numpy:
+            values = numpy.asarray(samples, dtype=float) + self.offset
+            kept = self.filter(values)
+            if len(kept) == 0:
+                return None, None
+            mean = float(kept.mean())
+            spread = float(kept.max() - kept.min())
+        else:
+            kept = self.filter([x + self.offset for x in samples])
+            if not kept:
+                return None, None
+            mean = math.fsum(kept) / len(kept)
+            spread = max(kept) - min(kept)
+        weight = (mean - self.zero) * self.gain
+        return self.smoother(weight), spread * abs(self.gain)
@@ -0,0 +1,115 @@
+import json
+import time
+from collections import deque
+from threading import Thread, Lock, Condition
+
+# Server-Sent Events fan-out. Each event is formatted once and the same string is appended to every
+# subscriber's bounded queue. A slow subscriber loses its oldest events instead of stalling the others.
+
+QUEUE_SIZE = 64
+KEEPALIVE = 15.0 #Seconds between comments that keep idle connections open
+
+class Subscriber:
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = deque(maxlen=size)
+        self.cond = Condition()
+        self.dropped = 0
+
+    def put(self, message):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(message)
+            self.cond.notify()
+
+    # Yields SSE messages until the client disconnects
+    def stream(self):
+        while True:
+            with self.cond:
+                if not self.queue:
+                    self.cond.wait(KEEPALIVE)
+                messages = list(self.queue)
+                self.queue.clear()
+            if not messages:
+                yield ': keepalive\n\n'
+            for message in messages:
+                yield message
+
+_subscribers = set()
+_lock = Lock()
+_last_state = {}
+
+def subscribe():
+    sub = Subscriber()
+    with _lock:
+        _subscribers.add(sub)
+    return sub
+
+def unsubscribe(sub):
+    with _lock:
+        _subscribers.discard(sub)
+
+def has_subscribers():
+    return bool(_subscribers)
+
+def format_event(event, data):
+    return 'event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+def publish(event, data):
+    if not _subscribers:
+        return
+    message = format_event(event, data)
+    with _lock:
+        subscribers = list(_subscribers)
+    for sub in subscribers:
+        sub.put(message)
+
+# Publish the device fields that changed since the last call
+def publish_state(state):
+    with _lock:
+        changed = dict((k, v) for k, v in state.items() if _last_state.get(k) != v)
+        _last_state.update(changed)
+    if changed:
+        publish('state', changed)
+
+# Everything a new subscriber should see first
+def initial_messages():
+    with _lock:
+        return [format_event('state', dict(_last_state))] if _last_state else []
+
+# A new subscriber's full message stream, starting with the current state
+def stream():
+    sub = subscribe()
+    try:
+        for message in initial_messages():
+            yield message
+        for message in sub.stream():
+            yield message
+    finally:
+        unsubscribe(sub)
+
+# Publishes one scale's readings at most every interval seconds, and only when the weight moved by more
+# than tolerance or the settled flag changed. Does nothing while nobody is subscribed.
+class WeightWatcher(Thread):
+    def __init__(self, read, interval=1.0, tolerance=1.0, scale=0):
+        Thread.__init__(self, name='weight-events-%d' % scale, daemon=True)
+        self.read = read
+        self.interval = interval
+        self.tolerance = tolerance
+        self.scale = scale
+        self.last = None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if not has_subscribers():
+                continue
+            reading = self.read()
+            if reading.weight is None:
+                continue
+            if self.last is not None and reading.settled == self.last.settled and \
+                    abs(reading.weight - self.last.weight) <= self.tolerance:
+                continue
+            self.last = reading
+            publish('weight', {'weight': reading.weight, 'timestamp': reading.timestamp, 'settled': reading.settled,
+                               'scale': self.scale})
@@ -0,0 +1,213 @@
+import os
+import random
+import threading
+import time
+import tty
+
+# Hardware backend. 'pi' uses the real HX711, gpiozero and RPi.GPIO; 'sim' uses the simulated devices
+# below so the API can run and be benchmarked on any Linux machine. Chosen with TRASHCAN_HARDWARE.
+BACKEND = os.environ.get('TRASHCAN_HARDWARE', 'pi')
+
+def simulated():
+    return BACKEND == 'sim'
+
+def HX711(**kwargs):
+    if simulated():
+        return SimHX711(**kwargs)
+    from hx711 import HX711
+    return HX711(**kwargs)
+
+def Button(pin, **kwargs):
+    if simulated():
+        return SimButton(pin, **kwargs)
+    from gpiozero import Button
+    return Button(pin, **kwargs)
+
+def OutputDevice(pin, **kwargs):
+    if simulated():
+        return SimOutputDevice(pin, **kwargs)
+    from gpiozero import OutputDevice
+    return OutputDevice(pin, **kwargs)
+
+def setwarnings(flag):
+    if not simulated():
+        import RPi.GPIO as GPIO
+        GPIO.setwarnings(flag)
+
+# Devices built on first use instead of at import, so importing a module never touches a pin and a
+# missing device only fails the calls that need it. A device whose factory raised is retried on next use.
+# An indexed factory builds one device per index, e.g. one scale per compartment; get(name) is index 0.
+class Registry:
+    def __init__(self):
+        self._factories = {}
+        self._devices = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, factory, indexed=False):
+        self._factories[name] = (factory, indexed)
+
+    def __contains__(self, name):
+        return name in self._factories
+
+    def get(self, name, index=0):
+        key = (name, index)
+        device = self._devices.get(key)
+        if device is None:
+            with self._lock:
+                device = self._devices.get(key)
+                if device is None:
+                    factory, indexed = self._factories[name]
+                    if indexed:
+                        device = factory(index)
+                    elif index:
+                        raise KeyError('%s has no device %d' % (name, index))
+                    else:
+                        device = factory()
+                    self._devices[key] = device
+        return device
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._factories:
+            raise AttributeError(name)
+        return self.get(name)
+
+    # The device if it has been built, else None. Never builds it.
+    def peek(self, name, index=0):
+        return self._devices.get((name, index))
+
+devices = Registry()
+
+# Path the barcode reader should open. In sim mode this is the slave side of the simulated scanner's pty.
+def scanner_path(configured, index=0):
+    if simulated():
+        return get_scanner(index).path
+    return configured
+
+# Simulated devices
+
+# Produces raw readings like the HX711. Replays a recorded trace (same format as benchmarks/traces)
+# when one is given, otherwise synthesizes readings around the weight set with set_weight().
+class SimHX711:
+    def __init__(self, dout_pin=None, pd_sck_pin=None, channel='A', gain=64, trace=None, rate=80.0,
+                 offset=30500, cal_gain=0.0095, zero=1000, noise=60.0, glitch_rate=0.01):
+        self.rate = float(os.environ.get('TRASHCAN_SIM_SCALE_RATE', rate))
+        self.offset = offset
+        self.cal_gain = cal_gain
+        self.zero = zero
+        self.noise = noise
+        self.glitch_rate = glitch_rate
+        self.weight = 0.0
+        self.trace = None
+        self.position = 0
+        trace = trace or os.environ.get('TRASHCAN_SIM_SCALE_TRACE')
+        if trace:
+            self.load_trace(trace)
+
+    def load_trace(self, path):
+        with open(path) as f:
+            self.trace = [float(line) for line in f if line.strip() and not line.startswith('#')]
+        self.position = 0
+
+    def set_weight(self, grams):
+        self.trace = None
+        self.weight = grams
+
+    def reset(self):
+        return False
+
+    def sample(self):
+        if self.trace:
+            value = self.trace[self.position]
+            self.position = (self.position + 1) % len(self.trace)
+            return value
+        value = self.weight / self.cal_gain + self.zero - self.offset + random.gauss(0, self.noise)
+        if random.random() < self.glitch_rate:
+            value += random.choice((-1, 1)) * random.uniform(5000, 60000)
+        return value
+
+    def get_raw_data(self, num_measures=1):
+        if self.rate:
+            time.sleep(num_measures / self.rate)
+        return [self.sample() for _ in range(num_measures)]
+
+class SimOutputDevice:
+    def __init__(self, pin=None, active_high=True, initial_value=False):
+        self.pin = pin
+        self.value = 1 if initial_value else 0
+
+    def on(self):
+        self.value = 1
+
+    def off(self):
+        self.value = 0
+
+    def toggle(self):
+        self.value = 1 - self.value
+
+# Button whose state is set by press()/release() or a script. Callbacks run on the calling thread,
+# like gpiozero's run on its pin thread.
+class SimButton:
+    def __init__(self, pin=None, bounce_time=None, pull_up=True):
+        self.pin = pin
+        self.bounce_time = bounce_time
+        self.value = 0
+        self.when_pressed = None
+        self.when_released = None
+
+    def press(self):
+        if not self.value:
+            self.value = 1
+            if self.when_pressed:
+                self.when_pressed()
+
+    def release(self):
+        if self.value:
+            self.value = 0
+            if self.when_released:
+                self.when_released()
+
+    # Run [(delay_seconds, 'press' | 'release'), ...] on a background thread
+    def script(self, steps):
+        def run():
+            for delay, action in steps:
+                time.sleep(delay)
+                getattr(self, action)()
+        t = threading.Thread(target=run, name='sim-button-%s' % self.pin, daemon=True)
+        t.start()
+        return t
+
+# Barcode scanner on a pty. scan() writes the same 8 byte keyboard reports a hidraw scanner produces.
+class SimScanner:
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+
+    def scan(self, barcode):
+        os.write(self.master, encode_reports(barcode))
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+_scanners = {}
+_scanners_lock = threading.Lock()
+
+def get_scanner(index=0):
+    with _scanners_lock:
+        if index not in _scanners:
+            _scanners[index] = SimScanner()
+        return _scanners[index]
+
+# Key down and key up report for every character followed by enter
+def encode_reports(barcode):
+    import bc_scanner
+    out = b''
+    for c in barcode:
+        if c in bc_scanner.KEYMAP:
+            modifier, keycode = 0, bc_scanner.KEYMAP.index(c)
+        else:
+            modifier, keycode = 0x02, bc_scanner.SHIFT_KEYMAP.index(c)
+        out += bytes([modifier, 0, keycode, 0, 0, 0, 0, 0]) + bytes(8)
+    out += bytes([0, 0, bc_scanner.ENTER, 0, 0, 0, 0, 0]) + bytes(8)
+    return out
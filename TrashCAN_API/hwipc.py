@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import metrics
+import sampler
+
+# Calls from the web workers to the hardware-owner process over a Unix socket.
+# Every message is a 4 byte big-endian length followed by that many bytes of JSON.
+#   request:  [method, args]
+#   reply:    [true, result] or [false, error type, message]
+# A streaming method replies with one [true, item] frame per item until either side hangs up.
+
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 1 << 20
+
+# Raised in a worker when the owner's handler failed with anything other than a ValueError
+class RemoteError(Exception):
+    pass
+
+def send_message(sock, message):
+    data = json.dumps(message, separators=(',', ':')).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('hardware socket closed')
+        buf += chunk
+    return buf
+
+def recv_message(sock):
+    length, = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ConnectionError('message too large: %d bytes' % length)
+    return json.loads(_recv_exact(sock, length).decode())
+
+# Runs in the owner. Serves handler's methods named in handler.METHODS, and the generators named in
+# handler.STREAMS, one thread per connection. Workers keep their connections open, so there is no
+# per-call connect.
+class Server(threading.Thread):
+    def __init__(self, path, handler):
+        threading.Thread.__init__(self, name='hardware-ipc', daemon=True)
+        self.path = path
+        self.handler = handler
+        self.closed = False
+        if os.path.exists(path):
+            os.unlink(path)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o660)
+        self.sock.listen(64)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            threading.Thread(target=self.serve, args=(conn,), name='hardware-ipc-conn', daemon=True).start()
+
+    # Stop accepting connections. Shutting the socket down wakes the accept loop so it can exit.
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def serve(self, conn):
+        try:
+            while True:
+                method, args = recv_message(conn)
+                if method in self.handler.STREAMS:
+                    self.stream(conn, method, args)
+                    return
+                send_message(conn, self.dispatch(method, args))
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logging.exception('Hardware IPC connection failed: %s', e)
+        finally:
+            conn.close()
+
+    def dispatch(self, method, args):
+        if method not in self.handler.METHODS:
+            return [False, 'RemoteError', 'unknown method ' + str(method)]
+        try:
+            with metrics.timer('ipc.' + method):
+                return [True, getattr(self.handler, method)(*args)]
+        except ValueError as e:
+            return [False, 'ValueError', str(e)]
+        except Exception as e:
+            logging.exception('Hardware IPC %s failed: %s', method, e)
+            return [False, 'RemoteError', str(e)]
+
+    def stream(self, conn, method, args):
+        items = getattr(self.handler, method)(*args)
+        try:
+            for item in items:
+                send_message(conn, [True, item])
+        finally:
+            items.close()
+
+# Used by the web workers in place of owner.Hardware. Each thread keeps its own connection and
+# reconnects once if the owner restarted since the last call.
+class Client:
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _sock(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = self._local.sock = self.connect()
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    # Only a request that could not be sent is retried. Once it has been written the owner may have
+    # acted on it, so a lost or late reply is raised rather than risk running e.g. a toggle twice.
+    def call(self, method, *args):
+        with metrics.timer('ipc.call'):
+            for attempt in (0, 1):
+                try:
+                    sock = self._sock()
+                    send_message(sock, [method, args])
+                    break
+                except OSError:
+                    self._drop()
+                    if attempt:
+                        raise
+            try:
+                reply = recv_message(sock)
+            except OSError:
+                self._drop()
+                raise
+        if reply[0]:
+            return reply[1]
+        if reply[1] == 'ValueError':
+            raise ValueError(reply[2])
+        raise RemoteError(reply[2])
+
+    def get_state(self):
+        return self.call('get_state')
+
+    def set_lid(self, action):
+        return self.call('set_lid', action)
+
+    def set_light(self, action):
+        return self.call('set_light', action)
+
+    def set_fan(self, action):
+        return self.call('set_fan', action)
+
+    def read_scale(self, index=0):
+        return sampler.Reading(*self.call('read_scale', index))
+
+    def tare_scale(self, index=0):
+        return self.call('tare_scale', index)
+
+    def metrics(self):
+        return self.call('metrics')
+
+    def start_profile(self, seconds=5.0):
+        return self.call('start_profile', seconds)
+
+    def last_profile(self):
+        return self.call('last_profile')
+
+    def scheduler_api(self, method, path, query='', body=''):
+        return self.call('scheduler_api', method, path, query, body)
+
+    # SSE messages from the owner on a connection of their own, for as long as the caller keeps reading
+    def event_stream(self):
+        sock = self.connect()
+        sock.settimeout(None)
+        try:
+            send_message(sock, ['event_stream', []])
+            while True:
+                yield recv_message(sock)[1]
+        finally:
+            sock.close()
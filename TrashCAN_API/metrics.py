@@ -0,0 +1,178 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+from functools import wraps
+
+# Counters and latency histograms kept in per-thread shards. A thread only ever writes its own shard,
+# so recording takes no lock; snapshot() sums the shards when someone asks. The shards of threads that
+# have ended are folded into one retired shard, so short-lived threads don't pile up.
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Shard:
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters = collections.defaultdict(int)
+        # name -> [bucket counts..., +inf count, sum, count]
+        self.histograms = {}
+
+    def merge(self, other):
+        for name, value in list(other.counters.items()):
+            self.counters[name] += value
+        for name, h in list(other.histograms.items()):
+            total = self.histograms.setdefault(name, [0] * len(h))
+            for i, value in enumerate(h):
+                total[i] += value
+
+_local = threading.local()
+_shards = []
+_retired = _Shard()
+_shards_lock = threading.Lock()
+_gauges = {}
+
+# Fold the shards of finished threads into _retired. A finished thread can't write again, so its
+# shard is complete. Call with _shards_lock held.
+def _retire():
+    live = []
+    for shard in _shards:
+        if shard.thread.is_alive():
+            live.append(shard)
+        else:
+            _retired.merge(shard)
+    _shards[:] = live
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = _Shard(threading.current_thread())
+        with _shards_lock:
+            _retire()
+            _shards.append(shard)
+    return shard
+
+def inc(name, n=1):
+    _shard().counters[name] += n
+
+def observe(name, seconds):
+    histograms = _shard().histograms
+    h = histograms.get(name)
+    if h is None:
+        h = histograms[name] = [0] * (len(BUCKETS) + 3)
+    h[bisect.bisect_left(BUCKETS, seconds)] += 1
+    h[-2] += seconds
+    h[-1] += 1
+
+class timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+# Decorator that records the duration of every call under name
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+# Register fn() to be evaluated whenever metrics are read
+def gauge(name, fn):
+    _gauges[name] = fn
+
+# Approximate quantile from the bucket counts
+def _quantile(h, q):
+    target = q * h[-1]
+    seen = 0
+    for i, count in enumerate(h[:-2]):
+        seen += count
+        if seen >= target and count:
+            return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+    return None
+
+def snapshot():
+    total = _Shard()
+    with _shards_lock:
+        _retire()
+        total.merge(_retired)
+        shards = list(_shards)
+    for shard in shards:
+        total.merge(shard)
+    result = {'counters': dict(total.counters), 'histograms': {}, 'gauges': {}}
+    for name, h in total.histograms.items():
+        result['histograms'][name] = {
+            'count': h[-1],
+            'sum': h[-2],
+            'mean': h[-2] / h[-1] if h[-1] else None,
+            'p50': _quantile(h, 0.5),
+            'p99': _quantile(h, 0.99),
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], h[:-2]))
+        }
+    for name, fn in list(_gauges.items()):
+        try:
+            result['gauges'][name] = fn()
+        except Exception as e:
+            result['gauges'][name] = None
+    return result
+
+# Sample every thread's stack for `seconds` and return the most common stacks, collapsed as
+# 'outer;inner' strings with sample counts. Only runs when asked for.
+def profile(seconds=5.0, interval=0.005, top=25):
+    me = threading.get_ident()
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    stacks = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+            stacks[names.get(ident, str(ident)) + ';' + ';'.join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return {'samples': samples, 'interval': interval,
+            'stacks': [{'stack': s, 'count': c} for s, c in stacks.most_common(top)]}
+
+_profiler = None
+_last_profile = None
+_profiler_lock = threading.Lock()
+
+# Take a profile on a thread of its own, so nobody waits for it. Returns False if one is already running.
+def start_profile(seconds=5.0):
+    global _profiler
+    with _profiler_lock:
+        if _profiler is not None and _profiler.is_alive():
+            return False
+        _profiler = threading.Thread(target=_run_profile, args=(seconds,), name='profiler', daemon=True)
+        _profiler.start()
+    return True
+
+def _run_profile(seconds):
+    global _last_profile
+    started = time.time()
+    result = profile(seconds)
+    result.update(started=started, seconds=seconds)
+    _last_profile = result
+
+# Whether a profile is being taken, and the last one finished, or None
+def last_profile():
+    return {'running': _profiler is not None and _profiler.is_alive(), 'profile': _last_profile}
@@ -0,0 +1,273 @@
+import sqlite3
+import json
+import logging
+import queue
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+import config
+import envelope
+import metrics
+import storage
+import sync
+import upc_cache
+
+# Scans and weights are written once to the Outbox table (see storage.SCHEMA) and uploaded in the
+# background, so the capture path never waits on the network. Status is only worth sending in its
+# latest form, so it is never stored: it is kept in one slot and goes with the next upload.
+# A record that can never be sent (the server refuses it, its payload is unreadable, or it has failed
+# OUTBOX_MAX_ATTEMPTS times) is moved to Outbox_Dead and counted in the outbox.dead metrics.
+
+COMMIT_INTERVAL = 0.05 #Seconds to gather records into one transaction
+COMMIT_MAX = 500
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 600.0
+WRITE_RETRY = 1.0 #Seconds between attempts to write a batch that failed
+ERROR_SLEEP = 5.0 #Seconds the uploader waits after an unexpected error
+REJECTED = 'rejected' #Upload result: the server refused the record itself, so sending it again can't help
+RETRYABLE_4XX = (401, 403, 404, 408, 415, 429) #Client errors that aren't the record's fault
+
+_records = queue.Queue()
+_wake_uploader = Event()
+_writer = None
+_uploader = None
+_status = None #Status fields waiting to be uploaded
+_status_lock = Lock()
+
+# Queue a record for upload. Returns its id. Records with an id that is already in the outbox are ignored.
+def enqueue(kind, payload, outbox_id=None):
+    outbox_id = outbox_id or str(uuid.uuid1())
+    _records.put((outbox_id, kind, json.dumps(payload), time.time()))
+    return outbox_id
+
+# Merge changed status fields into the pending status, newest value of each field wins
+def set_status(changed):
+    global _status
+    with _status_lock:
+        _status = dict(_status or {}, **changed)
+    _wake_uploader.set()
+
+def _take_status():
+    global _status
+    with _status_lock:
+        status, _status = _status, None
+    return status
+
+# Put back a status that failed to upload, under any fields set since it was taken
+def _restore_status(status):
+    global _status
+    with _status_lock:
+        _status = dict(status, **(_status or {}))
+
+# True if a failed response means the server refused the record itself
+def rejected(response):
+    return response is not None and 400 <= response.status_code < 500 and response.status_code not in RETRYABLE_4XX
+
+# Delay before the next attempt: exponential in the number of attempts with +/- 50% jitter
+def backoff(attempts):
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempts)
+    return delay * random.uniform(0.5, 1.5)
+
+# Group commit: everything queued within COMMIT_INTERVAL goes into one transaction. A batch that
+# can't be written is retried until it is, so queued records are never dropped.
+class Writer(Thread):
+    def __init__(self):
+        Thread.__init__(self, name='outbox-writer', daemon=True)
+
+    def run(self):
+        conn = storage.get_db()
+        while True:
+            batch = [_records.get()]
+            deadline = time.monotonic() + COMMIT_INTERVAL
+            while len(batch) < COMMIT_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(_records.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    with conn, metrics.timer('sqlite'):
+                        conn.executemany("INSERT OR IGNORE INTO Outbox (outbox_id, kind, payload, created) VALUES(?, ?, ?, ?)", batch)
+                    break
+                except sqlite3.Error as e:
+                    metrics.inc('outbox.write_errors')
+                    logging.error('Outbox write of %d records failed, retrying: %s', len(batch), e)
+                    time.sleep(WRITE_RETRY)
+            _wake_uploader.set()
+
+def upload_barcode(session, payload, timeout):
+    r = session.post(config.conf['HOME_SERVER_URL'] + '/barcode-lookup', params={'upc': payload['barcode']}, timeout=timeout)
+    if r.ok:
+        upc_cache.store_response(payload['barcode'], r)
+    return r
+
+def upload_weight(session, payload, timeout):
+    return session.post(config.conf['HOME_SERVER_URL'] + '/sync/weight', json={'rows': [payload]}, timeout=timeout)
+
+def upload_status(session, payload, timeout):
+    return session.post(config.conf['HOME_SERVER_URL'] + '/update_status', params=payload, timeout=timeout)
+
+UPLOADERS = {
+    'barcode': upload_barcode,
+    'weight': upload_weight,
+    'status': upload_status
+}
+
+# Drains due records and the pending status. When the server accepts batches (see envelope.py)
+# everything due goes in one request; otherwise each is its own request, with at most `concurrency`
+# in flight. Everything that fails in a pass is retried together after one backoff, so records are
+# retried in the order they were made.
+class Uploader(Thread):
+    def __init__(self, concurrency=2, timeout=0.5, idle=5.0, batch_timeout=2.0):
+        Thread.__init__(self, name='outbox-uploader', daemon=True)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.idle = idle
+        self.batch_timeout = batch_timeout
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.status_attempts = 0
+        self.status_due = 0.0
+
+    # Returns True once sent, False to try again later, or REJECTED
+    @metrics.timed('upload.outbox')
+    def upload(self, kind, data):
+        import requests
+        if kind not in UPLOADERS:
+            logging.error('No uploader for outbox records of kind %s', kind)
+            return REJECTED
+        try:
+            r = UPLOADERS[kind](sync.get_session(), data, self.timeout)
+            r.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            metrics.inc('upload.outbox.errors')
+            logging.debug('Outbox %s upload failed: %s', kind, e)
+            return REJECTED if rejected(e.response) else False
+
+    # Upload (kind, data) records in one envelope. Returns the result of each record, as upload() does.
+    def upload_batch(self, records, format):
+        import requests
+        try:
+            results = envelope.post(sync.get_session(), records, format[0], format[1], self.batch_timeout)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            metrics.inc('upload.outbox.errors')
+            logging.debug('Outbox batch of %d failed: %s', len(records), e)
+            if not rejected(getattr(e, 'response', None)):
+                return [False] * len(records)
+            if len(records) == 1:
+                return [REJECTED]
+            # One bad record fails the whole envelope. Split it to find that record and send the rest.
+            half = len(records) // 2
+            return self.upload_batch(records[:half], format) + self.upload_batch(records[half:], format)
+        lookups = [(data['barcode'], result) for (kind, data), (ok, result) in zip(records, results)
+                   if ok and kind == 'barcode' and result is not None]
+        if lookups:
+            upc_cache.store_many(lookups)
+        return [ok for ok, result in results]
+
+    def run(self):
+        while True:
+            try:
+                self.drain()
+            except Exception as e:
+                metrics.inc('outbox.uploader_errors')
+                logging.exception('Outbox upload failed: %s', e)
+                time.sleep(ERROR_SLEEP)
+
+    # Upload what is due, or wait until something is. One pass.
+    def drain(self):
+        conn = storage.get_db()
+        now = time.time()
+        format = envelope.get_format(sync.get_session())
+        rows = conn.execute("SELECT outbox_id, kind, payload, attempts, created FROM Outbox WHERE next_attempt <= ? ORDER BY created LIMIT ?",
+                            (now, config.conf['UPLOAD_BATCH_MAX'] if format else self.concurrency * 8)).fetchall()
+        status = _take_status() if self.status_due <= now else None
+        if not rows and status is None:
+            # Sleep until a new record is written or the next retry is due
+            row = conn.execute("SELECT MIN(next_attempt) FROM Outbox").fetchone()
+            due = [t for t in (row[0], self.status_due if _status is not None else None) if t is not None]
+            wait = min([self.idle] + [max(0.0, t - now) for t in due])
+            _wake_uploader.wait(wait)
+            _wake_uploader.clear()
+            return
+        dead = [] #(row, attempts, error)
+        parsed = []
+        for row in rows:
+            # Batches take any kind; the server answers for each record
+            if not format and row[1] not in UPLOADERS:
+                dead.append((row, row[3], 'no uploader for kind ' + str(row[1])))
+                continue
+            try:
+                parsed.append((row, json.loads(row[2])))
+            except ValueError:
+                dead.append((row, row[3], 'malformed payload'))
+        rows = [row for row, data in parsed]
+        records = [(row[1], data) for row, data in parsed]
+        if status is not None:
+            records.append(('status', status))
+        try:
+            if not records:
+                results = []
+            elif format:
+                results = self.upload_batch(records, format)
+            else:
+                results = list(self.pool.map(lambda record: self.upload(*record), records))
+        except Exception:
+            if status is not None:
+                _restore_status(status)
+            raise
+        status_result = results.pop() if status is not None else True
+        if status_result is REJECTED:
+            metrics.inc('outbox.dead')
+            logging.error('Status update %s refused by the server, dropped', status)
+        status_failed = status_result is False
+        if status is not None:
+            self.status_attempts = self.status_attempts + 1 if status_failed else 0
+        max_attempts = config.conf['OUTBOX_MAX_ATTEMPTS']
+        failed_rows = []
+        for row, result in zip(rows, results):
+            if result is REJECTED:
+                dead.append((row, row[3] + 1, 'refused by the server'))
+            elif not result and row[3] + 1 >= max_attempts:
+                dead.append((row, row[3] + 1, 'gave up after %d attempts' % (row[3] + 1)))
+            elif not result:
+                failed_rows.append(row)
+        retry = 0.0
+        if failed_rows or status_failed:
+            attempts = [row[3] for row in failed_rows] + ([self.status_attempts - 1] if status_failed else [])
+            retry = time.time() + backoff(max(attempts))
+            logging.warning('%d of %d outbox uploads failed', len(attempts), len(records))
+        if status_failed:
+            _restore_status(status)
+            self.status_due = retry
+        done = [row[0] for row, result in zip(rows, results) if result is True]
+        failed = [(row[3] + 1, retry, row[0]) for row in failed_rows]
+        now = time.time()
+        with conn:
+            storage.delete_many(conn, 'Outbox', 'outbox_id', done + [row[0] for row, attempts, error in dead])
+            conn.executemany("UPDATE Outbox SET attempts = ?, next_attempt = ? WHERE outbox_id = ?", failed)
+            conn.executemany("INSERT OR REPLACE INTO Outbox_Dead (outbox_id, kind, payload, created, attempts, failed, error) VALUES(?, ?, ?, ?, ?, ?, ?)",
+                             [(row[0], row[1], row[2], row[4], attempts, now, error) for row, attempts, error in dead])
+        if dead:
+            metrics.inc('outbox.dead', len(dead))
+            logging.error('%d outbox records moved to Outbox_Dead: %s', len(dead), ', '.join(sorted(set(error for row, attempts, error in dead))))
+
+# Records waiting to be uploaded
+def pending():
+    return storage.query("SELECT COUNT(*) FROM Outbox")[0][0]
+
+metrics.gauge('outbox.dead_rows', lambda: storage.query("SELECT COUNT(*) FROM Outbox_Dead")[0][0])
+
+def start():
+    global _writer, _uploader
+    if _writer is None:
+        _writer = Writer()
+        _writer.start()
+    if _uploader is None:
+        _uploader = Uploader(concurrency=config.conf['OUTBOX_CONCURRENCY'])
+        _uploader.start()
@@ -0,0 +1,234 @@
+import logging
+import queue
+import signal
+import uuid
+from time import time
+from threading import Thread, Event
+import config
+import cycles
+import bc_scanner
+import discovery
+import events
+import hwipc
+import metrics
+import outbox
+import pacing
+import records
+import service
+import sch
+import timeseries
+
+# Everything that has to run in exactly one process: the devices, the scale sampler, the lid monitor,
+# the scheduler, the outbox and the discovery responder. In production this process serves the web
+# workers over hwipc; `python app.py` runs it in the same process as the development server.
+#
+#   python owner.py                                   hardware owner, listening on HARDWARE_SOCKET
+#   gunicorn -w 4 -k gthread --threads 8 wsgi:app     web workers
+
+# The device calls the web resources make. Served as-is in single-process mode and over hwipc
+# to the web workers, so both see the same behaviour and errors.
+class Hardware:
+    METHODS = ('get_state', 'set_lid', 'set_light', 'set_fan', 'read_scale', 'tare_scale', 'metrics', 'start_profile',
+               'last_profile', 'scheduler_api')
+    STREAMS = ('event_stream',)
+
+    def get_state(self):
+        return service.get_state()
+
+    def set_lid(self, action):
+        return service.set_lid(action)
+
+    def set_light(self, action):
+        return service.set_light(action)
+
+    def set_fan(self, action):
+        return service.set_fan(action)
+
+    def read_scale(self, index=0):
+        return service.read_scale(index)
+
+    def tare_scale(self, index=0):
+        return service.tare_scale(index)
+
+    def metrics(self):
+        return metrics.snapshot()
+
+    def start_profile(self, seconds=5.0):
+        return metrics.start_profile(seconds)
+
+    def last_profile(self):
+        return metrics.last_profile()
+
+    # A request to the scheduler's REST API (/scheduler/...), answered by the app the scheduler
+    # was initialised on. Returns [status, body, content type].
+    def scheduler_api(self, method, path, query='', body=''):
+        if _scheduler_app is None:
+            raise ValueError('The scheduler is not running')
+        with _scheduler_app.test_client() as client:
+            response = client.open(path, method=method, query_string=query, data=body, content_type='application/json')
+            return [response.status_code, response.get_data(as_text=True), response.content_type]
+
+    def event_stream(self):
+        return events.stream()
+
+# Reschedule only the jobs that depend on options that changed
+def on_config_change(changed):
+    sch.reschedule_jobs(service.get_scheduler(), changed)
+
+# Lid transitions are queued by the GPIO callbacks and handled on the lid monitor thread,
+# so a slow handler never delays detection of the next transition
+lid_events = queue.Queue()
+lid_is_open = Event()
+
+def on_lid_pressed():
+    lid_events.put(('open', time()))
+
+def on_lid_released():
+    lid_events.put(('close', time()))
+
+SCAN_BATCH_MAX = 32 #Scans written in one go when a scanner doesn't pause
+
+_scanner_sessions = {} #index -> (thread, stop event) of that scanner's latest lid session
+
+# Reads one barcode scanner for as long as the lid is open, or until stop is set. Every scanner has
+# a thread of its own per lid session. Repeat reads of the same item are collapsed, and scans are
+# uploaded in batches whenever the scanner goes quiet.
+# After a quick close and reopen the last session's thread, `previous`, may still be reading or
+# flushing; the new session waits for it so the two never share the reader or the trigger.
+def scan_while_open(index=0, stop=None, previous=None):
+    if previous is not None:
+        previous.join()
+    if stop is not None and stop.is_set():
+        return
+    dedupe = bc_scanner.Dedupe(config.conf['SCAN_DEDUPE_WINDOW'], config.conf['SCAN_DEDUPE_MAX'])
+    batch = []
+    try:
+        bc_scanner.get_reader(index)
+        bc_scanner.start_scanner(index)
+    except (OSError, ValueError) as e:
+        logging.error('Scanner %d unavailable: %s', index, e)
+        return
+    try:
+        for upc in bc_scanner.barcodes(index, timeout=0.1):
+            if not lid_is_open.is_set() or stop is not None and stop.is_set():
+                break
+            if upc and dedupe.admit(upc):
+                batch.append(upc)
+            if batch and (upc is None or len(batch) >= SCAN_BATCH_MAX):
+                bc_scanner.upload_many(batch, index)
+                batch = []
+    finally:
+        if batch:
+            bc_scanner.upload_many(batch, index)
+        bc_scanner.stop_scanner(index)
+        logging.debug('Lid session: scanner %d uploaded %d barcodes, %d duplicate reads dropped', index, dedupe.unique, dedupe.duplicates)
+
+# Pause any jobs for lights and/or fan and start up the barcode scanners
+def on_lid_open():
+    logging.debug('Lid open')
+    lid_is_open.set()
+    service.update_status()
+    service.get_scheduler().pause()
+    cycles.pause()
+    for index in range(bc_scanner.scanner_count()):
+        previous, previous_stop = _scanner_sessions.get(index, (None, None))
+        if previous_stop is not None:
+            previous_stop.set()
+        stop = Event()
+        thread = Thread(target=scan_while_open, args=(index, stop, previous), name='lid-scanner-%d' % index, daemon=True)
+        _scanner_sessions[index] = (thread, stop)
+        thread.start()
+
+# Resume processing jobs, stop the scanners, and upload a reading from every scale
+def on_lid_close():
+    logging.debug('Lid closed')
+    lid_is_open.clear()
+    for thread, stop in _scanner_sessions.values():
+        stop.set()
+    service.update_status()
+    service.get_scheduler().resume()
+    cycles.resume()
+    #Get weight from scales
+    readings = [(index, reading) for index, reading in service.read_scales() if reading.weight is not None]
+    if readings:
+        timeseries.record_many([(reading.weight, reading.timestamp, index) for index, reading in readings])
+    for index, reading in readings:
+        outbox.enqueue('weight', {'weight_id': str(uuid.uuid1()), 'timestamp': records.timestamp(reading.timestamp), 'weight': reading.weight,
+                                  'weight_raw': reading.weight, 'scale': index})
+
+def start_lid_monitor():
+    service.lid_switch.when_pressed = on_lid_pressed
+    service.lid_switch.when_released = on_lid_released
+    # Pick up a lid that was already open at startup
+    if service.lid_switch.value:
+        lid_events.put(('open', time()))
+    while True:
+        event, timestamp = lid_events.get()
+        # Drop repeats of the current state that got past the debounce
+        if (event == 'open') == lid_is_open.is_set():
+            continue
+        logging.debug('Lid %s event after %.1f ms', event, (time() - timestamp) * 1000)
+        try:
+            if event == 'open':
+                on_lid_open()
+            else:
+                on_lid_close()
+        except Exception as e:
+            logging.exception('Lid %s handler failed: %s', event, e)
+
+_scheduler_app = None
+
+# Configure the scheduler on flask_app. The scheduler's own REST API is served from that app, and
+# relayed from the web workers through Hardware.scheduler_api.
+def init_scheduler(flask_app):
+    global _scheduler_app
+    _scheduler_app = flask_app
+    flask_app.config.from_object(sch.Config())
+    service.get_scheduler().init_app(flask_app)
+
+# Build the scale so its sampler and event watcher start now rather than on first use
+def _start_scale(index):
+    service.devices.get('scale_sampler', index)
+
+def _start_lid_monitor():
+    # Open the switch here so a missing one is reported like the other devices
+    service.devices.get('lid_switch')
+    Thread(target=start_lid_monitor, name='lid-monitor', daemon=True).start()
+
+# Start the scheduler and every background thread. A device that can't be opened is logged and
+# skipped so the rest of the bin keeps working.
+def start():
+    service.get_scheduler().start()
+    outbox.start()
+    config.add_listener(on_config_change)
+    config.add_listener(service.on_config_change)
+    config.start_watcher()
+    steps = [('scale %d' % index, _start_scale, index) for index in range(service.scale_count())]
+    steps += [('status', service.update_status), ('lid monitor', _start_lid_monitor), ('discovery', discovery.start),
+              ('backlog watcher', pacing.start_watcher)]
+    for name, fn, *args in steps:
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.exception('Could not start %s: %s', name, e)
+
+def serve(path):
+    server = hwipc.Server(path, Hardware())
+    server.start()
+    logging.info('Hardware owner listening on %s', path)
+    return server
+
+if __name__ == '__main__':
+    from flask import Flask
+    # Answer the workers first; devices are built as their first calls arrive
+    server = serve(config.conf['HARDWARE_SOCKET'])
+    # Never served itself; it answers the scheduler API requests the workers relay
+    init_scheduler(Flask(__name__))
+    start()
+    stop = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    server.close()
@@ -0,0 +1,144 @@
+import datetime
+import logging
+import random
+import sqlite3
+import time
+from threading import Lock, Thread
+import config
+import metrics
+import storage
+
+# Adaptive run times for the jobs that talk to the network. A job's interval trigger only sets its
+# base period; after every run the job reports how the run went and its next run is moved:
+#   busy     there was work, run again after the base period
+#   idle     nothing to do, double the delay on each idle run up to the idle limit
+#   backoff  the network was unreachable, double the delay on each failure up to the backoff limit,
+#            with +/- 50% jitter
+# phone_home is also pulled forward as soon as PHONE_HOME_BACKLOG rows are waiting to go out,
+# unless it is backing off. The owner counts them in SQLite (see BacklogWatcher), so rows written
+# by the web workers count too.
+
+STATES = ('busy', 'idle', 'backoff')
+BACKLOG_POLL = 1.0 #Seconds between checks for newly committed rows
+
+class Pacer:
+    def __init__(self, job_id, base_option, idle_option, backoff_option, backlog_option=None):
+        self.job_id = job_id
+        self.base_option = base_option
+        self.idle_option = idle_option
+        self.backoff_option = backoff_option
+        self.backlog_option = backlog_option
+        self.lock = Lock()
+        self.state = 'busy'
+        self.streak = 0 #Consecutive runs in the current state
+        self.delay = None
+        self.last_run = None
+        self.next_run = None
+        self.backlog = 0
+        # Only the process whose scheduler runs the job moves it. Set on the first reported run.
+        self.active = False
+
+    def _delay(self, state):
+        base = config.conf[self.base_option]
+        if state == 'busy':
+            return base
+        if state == 'idle':
+            return min(config.conf[self.idle_option], base * 2 ** self.streak)
+        return min(config.conf[self.backoff_option], base * 2 ** self.streak) * random.uniform(0.5, 1.5)
+
+    # Record the outcome of a run and move the job's next run. backlog is the work left over, if counted.
+    def done(self, state, backlog=None):
+        if state not in STATES:
+            raise ValueError('state must be one of ' + ', '.join(STATES))
+        now = time.time()
+        with self.lock:
+            self.streak = self.streak + 1 if state == self.state else 1
+            self.state = state
+            self.delay = self._delay(state)
+            self.last_run = now
+            self.next_run = now + self.delay
+            if backlog is not None:
+                self.backlog = backlog
+            first = not self.active
+            self.active = True
+        if first:
+            metrics.gauge('schedule.' + self.job_id, self.status)
+        metrics.inc('schedule.' + self.job_id + '.' + state)
+        _move(self.job_id, self.next_run)
+        return self.delay
+
+    # Set the number of rows waiting to go out, running the job now if that crosses the backlog limit
+    def set_backlog(self, n):
+        now = time.time()
+        with self.lock:
+            self.backlog = n
+            pull = (self.active and self.backlog_option is not None and self.state != 'backoff'
+                    and self.backlog >= config.conf[self.backlog_option] and self.next_run > now)
+            if pull:
+                self.next_run = now
+        if pull:
+            metrics.inc('schedule.' + self.job_id + '.early')
+            logging.debug('%d rows pending, running %s early', self.backlog, self.job_id)
+            _move(self.job_id, now)
+
+    def status(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'streak': self.streak,
+                'delay': self.delay,
+                'last_run': self.last_run,
+                'next_run': self.next_run,
+                'backlog': self.backlog
+            }
+
+PACERS = {
+    'phone_home': Pacer('phone_home', 'PHONE_HOME_SLEEP', 'PHONE_HOME_IDLE_SLEEP', 'PHONE_HOME_BACKOFF_MAX', 'PHONE_HOME_BACKLOG')
+}
+
+def get(job_id):
+    return PACERS[job_id]
+
+# Rows waiting to go out: the synced tables and the outbox
+def count_backlog():
+    import outbox
+    import sync
+    return sync.pending() + outbox.pending()
+
+# Recounts the backlog whenever any connection, in any process, commits. PRAGMA data_version on this
+# thread's connection only moves when another connection commits, so an idle check reads no table.
+class BacklogWatcher(Thread):
+    def __init__(self, pacer, poll=BACKLOG_POLL):
+        Thread.__init__(self, name='backlog-watcher', daemon=True)
+        self.pacer = pacer
+        self.poll = poll
+
+    def run(self):
+        conn = storage.get_db()
+        version = None
+        while True:
+            new_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if new_version != version:
+                version = new_version
+                try:
+                    self.pacer.set_backlog(count_backlog())
+                except sqlite3.Error as e:
+                    logging.error('Could not count pending rows: %s', e)
+            time.sleep(self.poll)
+
+_watcher = None
+
+def start_watcher():
+    global _watcher
+    if _watcher is None:
+        _watcher = BacklogWatcher(PACERS['phone_home'])
+        _watcher.start()
+    return _watcher
+
+# Set the job's next run time in the scheduler
+def _move(job_id, when):
+    import service
+    try:
+        service.get_scheduler().scheduler.modify_job(job_id, next_run_time=datetime.datetime.fromtimestamp(when, datetime.timezone.utc))
+    except Exception as e:
+        logging.error('Could not move %s: %s', job_id, e)
@@ -0,0 +1,82 @@
+import logging
+import time
+from threading import Thread, Condition
+import config
+import envelope
+import metrics
+import outbox
+import sync
+
+RETRY_BASE = 1.0 #Seconds before retrying a failed send, doubled on each failure in a row
+RETRY_MAX = 60.0
+
+# Sends device state changes to the home server in the background.
+# Bursts of changes within the coalesce window become one request carrying only the fields that
+# changed since the last successful send. While a send is in flight only the newest state is kept.
+# A failed send is retried after a backoff unless a newer state has arrived to replace it.
+class StatusPublisher(Thread):
+    def __init__(self, window=0.1, timeout=0.2):
+        Thread.__init__(self, name='status-publisher', daemon=True)
+        self.window = window
+        self.timeout = timeout
+        self._cond = Condition()
+        self._pending = None
+        self._sent = {}
+        self.failures = 0 #Failed sends in a row
+
+    # Record the latest state. Never blocks on the network.
+    def publish(self, state):
+        with self._cond:
+            self._pending = dict(state)
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+            # Let the rest of the burst arrive, then take whatever is newest
+            time.sleep(self.window)
+            with self._cond:
+                state = self._pending
+                self._pending = None
+            changed = dict((k, v) for k, v in state.items() if self._sent.get(k) != v)
+            if not changed:
+                continue
+            if self.send(changed):
+                self._sent.update(changed)
+                self.failures = 0
+                continue
+            with self._cond:
+                if self._pending is None:
+                    self._pending = state
+            self.failures += 1
+            time.sleep(min(RETRY_MAX, RETRY_BASE * 2 ** (self.failures - 1)))
+
+    @metrics.timed('upload.status')
+    def send(self, changed):
+        import requests
+        # When the server takes batches the delta rides along with the next outbox batch
+        if envelope.get_format(sync.get_session()):
+            outbox.set_status(changed)
+            return True
+        try:
+            r = sync.get_session().post(config.conf['HOME_SERVER_URL'] + '/update_status', params=changed, timeout=self.timeout)
+            r.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            metrics.inc('upload.status.errors')
+            logging.warning('Update status failed: %s', e)
+            return False
+
+_publisher = None
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = StatusPublisher(window=config.conf['STATUS_COALESCE_MS'] / 1000)
+        _publisher.start()
+    return _publisher
+
+def publish(state):
+    get_publisher().publish(state)
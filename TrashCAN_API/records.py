@@ -0,0 +1,118 @@
+import datetime
+import time
+import config
+import metrics
+import storage
+import timeseries
+
+# Weight and Barcode rows in local storage. Touches no hardware, so every web worker can use it directly;
+# SQLite in WAL mode handles the concurrent readers and writers.
+
+def _rows(cursor):
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+# A time as Weight and Barcode rows store it, and so as the server receives it, whether a row is
+# synced or a record goes through the outbox: local time, 'YYYY-MM-DD HH:MM:SS.ffffff'
+def timestamp(epoch=None):
+    return (datetime.datetime.now() if epoch is None else datetime.datetime.fromtimestamp(epoch)).isoformat(' ')
+
+# Rows waiting to be synced, counted whenever metrics are read
+for _table in ('Weight', 'Barcode', 'Outbox'):
+    metrics.gauge('pending.' + _table, lambda table=_table: storage.query("SELECT COUNT(*) FROM [" + table + "]")[0][0])
+
+# Listable tables. Maps table -> (id column, columns)
+LIST_TABLES = {
+    'Weight': ('weight_id', ('weight_id', 'timestamp', 'weight', 'weight_raw', 'scale')),
+    'Barcode': ('barcode_id', ('barcode_id', 'timestamp', 'barcode', 'scanner'))
+}
+
+# Rows are ordered by (timestamp, id). after is a (timestamp, id) cursor and since a timestamp;
+# both are exclusive.
+def _list_query(table, after=None, since=None, limit=None):
+    id_col, columns = LIST_TABLES[table]
+    sql = "SELECT " + ", ".join(columns) + " FROM [" + table + "]"
+    where = []
+    params = []
+    if after is not None:
+        where.append("(timestamp > ? OR (timestamp = ? AND " + id_col + " > ?))")
+        params += [after[0], after[0], after[1]]
+    if since is not None:
+        where.append("timestamp > ?")
+        params.append(since)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp, " + id_col
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+# One page of rows and the cursor for the next page, or None on the last page
+def list_page(table, after=None, since=None, limit=100):
+    id_col = LIST_TABLES[table][0]
+    # Fetch one extra row to know whether there is another page
+    with metrics.timer('sqlite'):
+        rows = _rows(storage.get_db().execute(*_list_query(table, after, since, limit + 1)))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]['timestamp'], rows[-1][id_col])
+
+# Yields every matching row from a server-side cursor without loading the table into memory
+def iter_rows(table, after=None, since=None):
+    columns = LIST_TABLES[table][1]
+    cursor = storage.get_db().execute(*_list_query(table, after, since))
+    try:
+        while True:
+            rows = cursor.fetchmany(256)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(columns, row))
+    finally:
+        cursor.close()
+
+def get_weight(weight_id):
+    conn = storage.get_db()
+    rows = _rows(conn.execute("SELECT weight_id, timestamp, weight, weight_raw, scale FROM [Weight] WHERE weight_id = ? LIMIT 1", (weight_id,)))
+    return rows[0] if rows else None
+
+# Store a Weight row and its reading in the time series, both or neither. Raises ValueError before
+# writing anything unless weight, or weight_raw when weight is not given, is a number.
+def add_weight(weight_id, weight_raw, weight=None, scale=0):
+    try:
+        weight = float(weight_raw) * config.conf['CONVERSION_FACTOR'] if weight is None else float(weight)
+    except (TypeError, ValueError):
+        raise ValueError(('weight_raw' if weight is None else 'weight') + ' must be a number')
+    conn = storage.get_db()
+    with conn, metrics.timer('sqlite'):
+        conn.execute("INSERT INTO Weight ([weight_id],[timestamp],[weight],[weight_raw],[scale]) VALUES(?, ?, ?, ?, ?)",
+                     (weight_id, datetime.datetime.now(), weight, weight_raw, scale))
+        timeseries.add_many(conn, [(weight, time.time(), scale)])
+    return weight_id
+
+def delete_weight(weight_id):
+    conn = storage.get_db()
+    with conn:
+        return conn.execute("DELETE FROM [Weight] WHERE weight_id = ?", (weight_id,)).rowcount
+
+def get_barcode(barcode_id):
+    conn = storage.get_db()
+    rows = _rows(conn.execute("SELECT barcode_id, timestamp, barcode, scanner FROM [Barcode] WHERE barcode_id = ? LIMIT 1", (barcode_id,)))
+    return rows[0] if rows else None
+
+def add_barcode(barcode_id, barcode, scanner=0):
+    add_barcodes([(barcode_id, barcode, scanner)])
+    return barcode_id
+
+# Insert [(barcode_id, barcode, scanner), ...] in one transaction
+def add_barcodes(rows):
+    now = datetime.datetime.now()
+    storage.insert_many('Barcode', ('barcode_id', 'timestamp', 'barcode', 'scanner'),
+                        [(barcode_id, now, barcode, scanner) for barcode_id, barcode, scanner in rows])
+
+def delete_barcode(barcode_id):
+    conn = storage.get_db()
+    with conn:
+        return conn.execute("DELETE FROM [Barcode] WHERE barcode_id = ?", (barcode_id,)).rowcount
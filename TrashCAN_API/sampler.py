@@ -0,0 +1,86 @@
+import logging
+import time
+from array import array
+from collections import namedtuple
+from threading import Thread, Event
+import estimator
+import metrics
+
+Reading = namedtuple('Reading', ['weight', 'timestamp', 'settled'])
+
+# Fixed-size ring buffer of raw samples backed by a double array
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.data = array('d', [0.0] * size)
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def full(self):
+        return self.count == self.size
+
+    # Samples in storage order, not arrival order. Estimates don't depend on the order.
+    def samples(self):
+        if self.count < self.size:
+            return self.data[:self.count]
+        return self.data
+
+# Reads the HX711 continuously on its own thread and keeps a filtered estimate of the weight.
+# read() only returns the last estimate, so callers never block on the sensor.
+class ScaleSampler(Thread):
+    def __init__(self, hx711, size=25, settle_tolerance=5.0, chunk=1, weight_estimator=None, name='scale-sampler'):
+        Thread.__init__(self, name=name, daemon=True)
+        self.hx711 = hx711
+        self.estimator = weight_estimator or estimator.Estimator()
+        self.buffer = RingBuffer(size)
+        self.settle_tolerance = settle_tolerance
+        self.chunk = chunk
+        self.tare = 0.0
+        self._gross = None
+        self._reading = Reading(None, None, False)
+        self._stop_event = Event()
+
+    def run(self):
+        self.hx711.reset()
+        while not self._stop_event.is_set():
+            with metrics.timer('hx711.read'):
+                raw = self.hx711.get_raw_data(self.chunk)
+            if not raw:
+                metrics.inc('hx711.errors')
+                logging.warning('Scale read failed')
+                time.sleep(0.1)
+                continue
+            for x in raw:
+                self.buffer.append(x)
+            with metrics.timer('scale.estimate'):
+                self.update()
+
+    def stop(self):
+        self._stop_event.set()
+
+    # Recompute the estimate from the buffer. Runs on the sampler thread after every chunk.
+    def update(self):
+        gross, spread = self.estimator.estimate(self.buffer.samples())
+        if gross is None:
+            return
+        settled = self.buffer.full() and spread <= self.settle_tolerance
+        self._gross = gross
+        # Swap in a new immutable reading so readers never see a partial update
+        self._reading = Reading(gross - self.tare, time.time(), settled)
+
+    def read(self):
+        return self._reading
+
+    # Zero the scale against the current estimate. Returns the new tare value.
+    def set_tare(self):
+        if self._gross is None:
+            return None
+        self.tare = self._gross
+        self._reading = self._reading._replace(weight=self._gross - self.tare)
+        return self.tare
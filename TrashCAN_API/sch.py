@@ -1,16 +1,25 @@
 import logging
-import requests
-import socket
-import json
-from time import sleep
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+import sqlite3
 import config
-
-prohibit_remove = ('phone_home','broadcast_location')
-
-# Scheduler
-class Config:
-    JOBS = [
+import cycles
+import metrics
+import pacing
+import service
+import storage
+import sync
+import timeseries
+import upc_cache
+
+prohibit_remove = ('phone_home','weight_retention')
+
+# Options each built-in job's trigger is built from. A change to one of these reschedules that job.
+JOB_DEPENDENCIES = {
+    'phone_home': ('PHONE_HOME_SLEEP',)
+}
+
+# Built-in jobs with triggers from the current config
+def job_definitions():
+    return [
         {'id': 'default_clean',
          'func': 'sch:custom_cycle',
          'args': (300,),
@@ -21,17 +30,41 @@ class Config:
         {'id' : 'phone_home',
          'func' : 'sch:phone_home',
          'trigger' : 'interval',
-         'seconds' : config.conf['phone_home_sleep']
+         'seconds' : config.conf['PHONE_HOME_SLEEP']
         },
-        {'id' : 'broadcast_location',
-         'func' : 'sch:broadcast',
+        {'id' : 'weight_retention',
+         'func' : 'sch:weight_retention',
          'trigger' : 'interval',
-         'seconds' : config.conf['broadcast_sleep']
+         'hours' : 1
         }
     ]
-    SCHEDULER_JOBSTORES = {
-        'default': SQLAlchemyJobStore(url='sqlite:////database/database.db')
-    }
+
+# Reschedule, in place, the jobs whose triggers depend on any of the changed options.
+# Jobs that are running keep running; only their next run times change.
+def reschedule_jobs(scheduler, changed):
+    for job in job_definitions():
+        if not changed.intersection(JOB_DEPENDENCIES.get(job['id'], ())):
+            continue
+        trigger_args = dict((k, v) for k, v in job.items() if k not in ('id', 'func', 'args', 'trigger'))
+        try:
+            scheduler.scheduler.reschedule_job(job['id'], trigger=job['trigger'], **trigger_args)
+            logging.info('Rescheduled %s', job['id'])
+        except Exception as e:
+            logging.error('Could not reschedule %s: %s', job['id'], e)
+
+# Scheduler. The jobs and job store are only built when the scheduler is configured, so importing
+# this module doesn't read the config or load SQLAlchemy.
+class Config:
+    @property
+    def JOBS(self):
+        return job_definitions()
+
+    # Jobs are kept in the main database
+    @property
+    def SCHEDULER_JOBSTORES(self):
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        return {'default': SQLAlchemyJobStore(url='sqlite:///' + storage.DATABASE)}
+
     SCHEDULER_EXECUTORS = {
         'default': {'type': 'threadpool', 'max_workers': 10}
     }
@@ -41,135 +74,97 @@ class Config:
     }
     SCHEDULER_API_ENABLED = True
 
-    # Long cycle both
-    def long_cycle(self):
-        if requests.get('http://127.0.0.1/api/fan').text == 'on':
-            logging.warning("Fan already on")
-            return
-        if requests.get('http://127.0.0.1/api/light').text == 'on':
-            logging.warning("Light already on")
-            return
-        responses = list()
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=on'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=on'))
-        sleep(config['LONG_CYCLE_SLEEP'])
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=off'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=off'))
-        for index, response in responses:
-            if response is not '200':
-                logging.warning("Error from API: %s", responses[index])
-
-    # Short cycle both
-    def short_cycle(self):
-        if requests.get('http://127.0.0.1/api/fan').text == 'on':
-            logging.warning("Fan already on")
-            return
-        if requests.get('http://127.0.0.1/api/light').text == 'on':
-            logging.warning("Light already on")
-            return
-        responses = list()
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=on'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=on'))
-        sleep(config['SHORT_CYCLE_SLEEP'])
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=off'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=off'))
-        for index, response in responses:
-            if response is not '200':
-                logging.warning("Error from API: %s", responses[index])
-
-    # Long cycle both
-    def custom_cycle(self, length):
-        if requests.get('http://127.0.0.1/api/fan').text == 'on':
-            logging.warning("Fan already on")
-            return
-        if requests.get('http://127.0.0.1/api/light').text == 'on':
-            logging.warning("Light already on")
-            return
-        responses = list()
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=on'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=on'))
-        sleep(length)
-        responses.append(requests.put('http://127.0.0.1/api/fan?action=off'))
-        responses.append(requests.put('http://127.0.0.1/api/light?action=off'))
-        for index, response in responses:
-            if response is not '200':
-                logging.warning("Error from API: %s", responses[index])
-
-    # Phone home to AWS server. Attempt to upload any stored barcodes and weight measurements.
-    def phone_home(self):
-        logging.debug('Phone home to server started')
-
-        #Upload pending weight
-        r = requests.get('http://127.0.0.1/api/weight')
-        rjson = r.json()
-        for line in rjson.items():
-            fails = 0
-            try:
-                requests.post(config.conf['HOME_SERVER_URL']+'/anotherurl?weight='+line['weight'], timeout = 0.5)
-                requests.delete('http://127.0.0.1/api/weight/'+line['weight_id'])
-            except requests.exceptions as e:
-                fails += 1
-                logging.warning('Weight upload failed')
-                if fails >= 3:
-                    logging.error('Three failed uploads. Aborting weight upload')
-                    break
-
-        #Upload pending barcodes
-        r = requests.get('http://127.0.0.1/api/barcode')
-        rjson = r.json()
-        for line in rjson.items():
-            fails = 0
+# Long cycle both
+@metrics.timed('job.long_cycle')
+def long_cycle():
+    cycles.start(config.conf['LONG_CYCLE_SLEEP'])
+
+# Short cycle both
+@metrics.timed('job.short_cycle')
+def short_cycle():
+    cycles.start(config.conf['SHORT_CYCLE_SLEEP'])
+
+# Custom length cycle both
+@metrics.timed('job.custom_cycle')
+def custom_cycle(length):
+    cycles.start(length)
+
+# Thin and expire the weight history
+@metrics.timed('job.weight_retention')
+def weight_retention():
+    try:
+        removed = timeseries.apply_retention()
+        logging.debug('Weight retention removed %d rows', removed)
+    except sqlite3.Error as e:
+        logging.error('Weight retention failed: %s', e)
+
+# Phone home to AWS server. Attempt to upload any stored barcodes and weight measurements.
+# The next run is paced by how this one went (see pacing.py).
+@metrics.timed('job.phone_home')
+def phone_home():
+    import requests
+    logging.debug('Phone home to server started')
+    pacer = pacing.get('phone_home')
+    try:
+        backlog = sync.pending()
+    except sqlite3.Error as e:
+        logging.error('Could not count pending rows: %s', e)
+        backlog = None
+
+    #Upload pending weight and barcodes in acknowledged batches. Done first so a broken job list
+    #on the server never holds back the data.
+    complete = True
+    idle = backlog == 0
+    if not idle:
+        try:
+            complete = sync.sync_all()
+            backlog = sync.pending()
+        except sqlite3.Error as e:
+            logging.error('Bulk sync failed: %s', e)
+
+    #Check for new job configs. Only failing to reach the server at all counts as unreachable;
+    #an error answer from /jobs is logged and the run carries on.
+    reachable = True
+    server_jobs = None
+    try:
+        r = sync.get_session().get(config.conf['HOME_SERVER_URL']+'/jobs', timeout=0.5)
+        r.raise_for_status()
+        server_jobs = r.json()
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        logging.error('Home server unreachable: %s', e)
+        reachable = False
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error('Error occurred in server request: %s', e)
+    if server_jobs is not None:
+        sync_jobs(server_jobs)
+
+    #Pre-seed the UPC lookup cache with anything new on the server
+    seeded = reachable and upc_cache.seed(sync.get_session())
+    logging.debug('Phone home to server complete')
+
+    if not complete or not reachable:
+        pacer.done('backoff', backlog)
+    elif idle and not seeded:
+        pacer.done('idle', backlog)
+    else:
+        pacer.done('busy', backlog)
+
+# Make the local jobs match the server's, leaving the locked jobs alone
+def sync_jobs(server_jobs):
+    scheduler = service.get_scheduler()
+    local_ids = [job.id for job in scheduler.get_jobs()]
+    server_ids = [job['id'] for job in server_jobs]
+
+    #If local job id not in locked jobs or server jobs remove
+    for job_id in local_ids:
+        if job_id not in prohibit_remove and job_id not in server_ids:
+            scheduler.remove_job(job_id)
+
+    #If server job id not in locked jobs or local jobs add
+    for job in server_jobs:
+        if job['id'] not in prohibit_remove and job['id'] not in local_ids:
+            options = dict((k, v) for k, v in job.items() if k not in ('id', 'func'))
             try:
-                requests.post(config.conf['HOME_SERVER_URL']+'/barcode-lookup?upc='+line['barcode'], timeout=0.5)
-                requests.delete('http://127.0.0.1/api/weight/' + line['barcode_id'])
-            except requests.exceptions as e:
-                fails += 1
-                logging.warning('Barcode upload failed')
-                if fails >= config.conf['UPLOAD_FAILURE_LIMIT']:
-                    logging.error(str(fails)+' failed uploads. Aborting barcode upload')
-                    break
-        logging.debug('Phone home to server complete')
-
-        #Check for new job configs
-        lock_jobs = ('phone_home', 'broadcast_location')
-        r1 = requests.get('http://127.0.0.1/scheduler/jobs', timeout=0.5)
-        r2 = requests.get(config.conf['HOME_SERVER_URL']+'/jobs',timeout=0.5)
-
-        local_jobs = json.loads(r1.text)
-        server_jobs = json.loads(r2.text)
-
-        #Create list of ids of local jobs
-        local_ids = [job['id'] for job in local_jobs]
-
-        #Create list of ids of server jobs
-        server_ids = [job['id'] for job in server_jobs]
-
-        #If local job id not in locked jobs or server jobs remove
-        for job in local_jobs:
-            if job['id'] not in (lock_jobs or server_ids):
-                r3 = requests.delete('http://127.0.0.1/scheduler/jobs/'+job['id'], timeout=0.5)
-
-        #If server job id not in locked jobs or local jobs add
-        for job in server_jobs:
-            if job['id'] not in (lock_jobs or local_ids):
-                r4 = requests.post('http://127.0.0.1/scheduler/jobs', timeout=0.5, json=job)
-
-        if not (r1.ok or r3.ok or r4.ok):
-            logging.error('Error occurred in local request')
-        if not r2.ok:
-            logging.error('Error occurred in server request')
-
-    # Broadcast location to wi-fi
-    def broadcast(self):
-        logging.debug('WiFi broadcast started.')
-        msg = socket.gethostbyname(socket.gethostname())
-
-        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        #Set timeout for blocking socket
-        server.settimeout(0.2)
-        server.bind("", 0) #0 binds to any available port
-
-        server.sendto(msg, ('<broadcast>', config.conf['PI_BROADCAST_PORT']))
-
-        logging.debug('WiFi broadcast location complete')
+                scheduler.add_job(job['id'], job['func'], **options)
+            except Exception as e:
+                logging.error('Could not add job %s: %s', job['id'], e)
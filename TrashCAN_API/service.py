@@ -0,0 +1,187 @@
+import logging
+from threading import RLock
+import config
+import estimator
+import events
+import hardware
+import publisher
+import sampler
+
+# In-process API for the devices. The Flask resources, the scheduler jobs and the lid monitor all go
+# through these functions instead of making HTTP calls to this process. Only the hardware-owner
+# process may use the devices (see owner.py); they are built on first use from hardware.devices.
+
+devices = hardware.devices
+
+# Setup scale amp
+def _scale(index):
+    conf = config.device_conf(index, ('SCALE_DATA_PIN', 'SCALE_CLOCK_PIN'))
+    hx711 = hardware.HX711(
+        dout_pin=conf['SCALE_DATA_PIN'],
+        pd_sck_pin=conf['SCALE_CLOCK_PIN'],
+        channel=conf['SCALE_CHANNEL'],
+        gain=conf['SCALE_GAIN']
+    )
+    hardware.setwarnings(False)
+    return hx711
+
+ESTIMATOR_OPTIONS = ('SCALE_OFFSET', 'SCALE_CAL_GAIN', 'SCALE_ZERO', 'SCALE_FILTER', 'SCALE_SMOOTHING', 'SCALE_USE_NUMPY')
+
+# A scale's weight estimator. A bad filter or smoothing name is logged and the default estimator
+# used, so the scale still reads.
+def _estimator(index, conf):
+    try:
+        return estimator.Estimator.from_config(conf)
+    except ValueError as e:
+        logging.error('Scale %d: %s, using the default estimator', index, e)
+        return estimator.Estimator()
+
+# Sample each scale continuously on a thread of its own. Built, and started with the watcher that
+# publishes its readings as events, the first time the scale is used, so a scale added by raising
+# SCALE_COUNT starts the same way as the ones there at boot.
+def _scale_sampler(index):
+    conf = config.device_conf(index)
+    scale_sampler = sampler.ScaleSampler(
+        devices.get('hx711', index),
+        size=conf['NUM_MEASUREMENTS'],
+        settle_tolerance=conf['SCALE_SETTLE_TOLERANCE'],
+        weight_estimator=_estimator(index, conf),
+        name='scale-sampler-%d' % index
+    )
+    scale_sampler.tare = conf['TARE']
+    scale_sampler.start()
+    events.WeightWatcher(scale_sampler.read, interval=config.conf['WEIGHT_EVENT_INTERVAL'], scale=index).start()
+    return scale_sampler
+
+# Config listener: give each running scale a new estimator when its calibration, filter or
+# smoothing options change. The sampler picks it up on its next estimate.
+def on_config_change(changed):
+    for index in range(scale_count()):
+        scale_sampler = devices.peek('scale_sampler', index)
+        if scale_sampler is None or not any(option in changed or config.indexed(option, index) in changed for option in ESTIMATOR_OPTIONS):
+            continue
+        scale_sampler.estimator = _estimator(index, config.device_conf(index))
+        logging.info('Scale %d estimator updated', index)
+
+def _output(pin_option):
+    return lambda: hardware.OutputDevice(config.conf[pin_option], active_high=False, initial_value=False)
+
+#Create objects for physical objects
+devices.register('hx711', _scale, indexed=True)
+devices.register('scale_sampler', _scale_sampler, indexed=True)
+devices.register('lid_switch', lambda: hardware.Button(config.conf['LID_SWITCH_PIN'], bounce_time=config.conf['LID_DEBOUNCE_MS'] / 1000))
+devices.register('lid_open_button', _output('LID_OPEN_PIN'))
+devices.register('lid_close_button', _output('LID_CLOSE_PIN'))
+devices.register('light', _output('LIGHT_PIN'))
+devices.register('fan', _output('FAN_PIN'))
+devices.register('led', _output('LED_PIN'))
+
+# service.light, service.scale_sampler and so on build the device on first access
+def __getattr__(name):
+    if name in devices:
+        return devices.get(name)
+    raise AttributeError("module 'service' has no attribute '" + name + "'")
+
+_scheduler = None
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        from flask_apscheduler import APScheduler
+        _scheduler = APScheduler()
+    return _scheduler
+
+# Serializes actuation so a read-modify-write like toggle can't interleave with another caller
+_lock = RLock()
+
+ACTIONS = ('on', 'off', 'toggle')
+LID_ACTIONS = ('open', 'close', 'toggle')
+
+def get_state():
+    return {
+        'lid' : devices.lid_switch.value,
+        'light' : devices.light.value,
+        'fan' : devices.fan.value,
+        'led' : devices.led.value
+    }
+
+# Push the current state to event subscribers and hand it to the background publisher,
+# which coalesces and uploads it
+def update_status():
+    state = get_state()
+    events.publish_state(state)
+    publisher.publish(state)
+
+def _switch(device, action):
+    if action == 'off':
+        device.off()
+    elif action == 'on':
+        device.on()
+    else:
+        device.toggle()
+
+def set_lid(action):
+    if action not in LID_ACTIONS:
+        raise ValueError('Invalid action parameter')
+    with _lock:
+        if action == 'toggle':
+            action = 'close' if devices.lid_switch.value else 'open'
+        if action == 'close':
+            devices.lid_close_button.on()
+        else:
+            devices.lid_open_button.on()
+    logging.info('Lid %s', 'closed' if action == 'close' else 'opened')
+    update_status()
+
+# Cleaning LED follows the light and fan when CLEANING_LED is enabled
+def set_led(action, notify=True):
+    if not config.conf['CLEANING_LED']:
+        return
+    with _lock:
+        _switch(devices.led, action)
+    if notify:
+        update_status()
+
+def set_light(action):
+    if action not in ACTIONS:
+        raise ValueError('Invalid action parameter')
+    with _lock:
+        _switch(devices.light, action)
+        set_led(action, notify=False)
+    update_status()
+
+def set_fan(action):
+    if action not in ACTIONS:
+        raise ValueError('Invalid action parameter')
+    with _lock:
+        _switch(devices.fan, action)
+        set_led(action, notify=False)
+    update_status()
+
+def scale_count():
+    return config.conf['SCALE_COUNT']
+
+def _scale_sampler_for(index):
+    if not 0 <= index < scale_count():
+        raise ValueError('No scale ' + str(index))
+    return devices.get('scale_sampler', index)
+
+def read_scale(index=0):
+    return _scale_sampler_for(index).read()
+
+# Latest reading of every scale that could be opened, [(index, reading), ...]
+def read_scales():
+    readings = []
+    for index in range(scale_count()):
+        try:
+            readings.append((index, read_scale(index)))
+        except Exception as e:
+            logging.error('Could not read scale %d: %s', index, e)
+    return readings
+
+# Zero the scale against the current reading and persist it. Returns None if the scale has no reading yet.
+def tare_scale(index=0):
+    tare = _scale_sampler_for(index).set_tare()
+    if tare is not None:
+        config.set_config(config.indexed('TARE', index), tare)
+    return tare
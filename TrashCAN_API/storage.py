@@ -0,0 +1,207 @@
+import sqlite3
+import threading
+import weakref
+import metrics
+
+#Setup database
+DATABASE = '/srv/trashcan/venv/database/database.db'
+
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-4000", #4 MB
+    "PRAGMA busy_timeout=10000"
+)
+
+# Tables and indexes added after init_db.sql was first deployed. Safe to run on every start.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Sync_State (
+    table_name varchar PRIMARY KEY,
+    last_rowid integer
+);
+CREATE TABLE IF NOT EXISTS Outbox (
+    outbox_id varchar PRIMARY KEY,
+    kind varchar,
+    payload varchar,
+    created real,
+    attempts integer DEFAULT 0,
+    next_attempt real DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_Outbox_next_attempt ON Outbox (next_attempt);
+CREATE TABLE IF NOT EXISTS Outbox_Dead (
+    outbox_id varchar PRIMARY KEY,
+    kind varchar,
+    payload varchar,
+    created real,
+    attempts integer,
+    failed real,
+    error varchar
+);
+CREATE TABLE IF NOT EXISTS Upc_Cache (
+    upc varchar PRIMARY KEY,
+    result varchar,
+    fetched real
+);
+CREATE INDEX IF NOT EXISTS idx_Upc_Cache_fetched ON Upc_Cache (fetched);
+CREATE TABLE IF NOT EXISTS Weight_Series (
+    timestamp real NOT NULL,
+    weight real NOT NULL,
+    scale integer NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_Weight_Series_timestamp ON Weight_Series (timestamp);
+CREATE TABLE IF NOT EXISTS Weight_Rollup (
+    resolution integer NOT NULL,
+    scale integer NOT NULL DEFAULT 0,
+    bucket integer NOT NULL,
+    samples integer NOT NULL,
+    weight_min real,
+    weight_max real,
+    weight_sum real,
+    PRIMARY KEY (resolution, scale, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_Barcode_barcode_id ON Barcode (barcode_id);
+CREATE INDEX IF NOT EXISTS idx_Barcode_timestamp ON Barcode (timestamp);
+CREATE INDEX IF NOT EXISTS idx_Weight_weight_id ON Weight (weight_id);
+CREATE INDEX IF NOT EXISTS idx_Weight_timestamp ON Weight (timestamp);
+CREATE TABLE IF NOT EXISTS State (
+    name varchar PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO State (name, value) SELECT 'timeseries.downsampled', last_rowid FROM Sync_State WHERE table_name = 'Weight_Series';
+DELETE FROM Sync_State WHERE table_name = 'Weight_Series';
+INSERT OR IGNORE INTO State (name, value) SELECT 'upc_cache.cursor', last_rowid FROM Sync_State WHERE table_name = 'Upc_Cache';
+DELETE FROM Sync_State WHERE table_name = 'Upc_Cache';
+"""
+
+# Columns added to existing tables. ALTER TABLE has no IF NOT EXISTS, so each is added only when missing.
+COLUMNS = (
+    ('Weight', 'scale', 'integer DEFAULT 0'),
+    ('Barcode', 'scanner', 'integer DEFAULT 0'),
+    ('Weight_Series', 'scale', 'integer NOT NULL DEFAULT 0')
+)
+
+# Weight_Rollup was first keyed by (resolution, bucket). The key can't be altered, so the table is
+# rebuilt with the existing rollups as scale 0.
+REKEY_ROLLUP = """
+ALTER TABLE Weight_Rollup RENAME TO Weight_Rollup_Old;
+CREATE TABLE Weight_Rollup (
+    resolution integer NOT NULL,
+    scale integer NOT NULL DEFAULT 0,
+    bucket integer NOT NULL,
+    samples integer NOT NULL,
+    weight_min real,
+    weight_max real,
+    weight_sum real,
+    PRIMARY KEY (resolution, scale, bucket)
+) WITHOUT ROWID;
+INSERT INTO Weight_Rollup (resolution, scale, bucket, samples, weight_min, weight_max, weight_sum)
+    SELECT resolution, 0, bucket, samples, weight_min, weight_max, weight_sum FROM Weight_Rollup_Old;
+DROP TABLE Weight_Rollup_Old;
+"""
+
+# One connection per thread. sqlite3 connections can't be shared between threads by default.
+_local = threading.local()
+_schema_ready = False
+
+def connect(path=None):
+    conn = sqlite3.connect(path or DATABASE, timeout=10, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def columns(conn, table):
+    return [row[1] for row in conn.execute("PRAGMA table_info([" + table + "])")]
+
+def _missing(conn):
+    missing = [(table, column, definition) for table, column, definition in COLUMNS if column not in columns(conn, table)]
+    return missing, 'scale' not in columns(conn, 'Weight_Rollup')
+
+# Add missing columns. The owner and the web workers start together, so the check is repeated
+# under the write lock and only one of them alters each table.
+def migrate(conn):
+    missing, rekey = _missing(conn)
+    if not missing and not rekey:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        missing, rekey = _missing(conn)
+        for table, column, definition in missing:
+            conn.execute("ALTER TABLE [" + table + "] ADD COLUMN " + column + " " + definition)
+        if rekey:
+            for statement in REKEY_ROLLUP.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+def init_schema(conn):
+    global _schema_ready
+    if not _schema_ready:
+        conn.executescript(SCHEMA)
+        migrate(conn)
+        _schema_ready = True
+
+# Holds one thread's connection. A thread's locals are dropped when it exits, and the finalizer then
+# closes the connection on that same thread, so short-lived threads like the dev server's per-request
+# ones don't leave connections and file descriptors behind.
+class _Holder:
+    def __init__(self, conn):
+        self.conn = conn
+        self.finalizer = weakref.finalize(self, conn.close)
+        # At exit the finalizer would run on the main thread, which sqlite3 refuses
+        self.finalizer.atexit = False
+
+_holders = weakref.WeakSet()
+
+# The calling thread's connection. Reused for the life of the thread and closed when it ends.
+def get_db():
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        conn = connect()
+        init_schema(conn)
+        holder = _local.holder = _Holder(conn)
+        _holders.add(holder)
+    return holder.conn
+
+# Close the calling thread's connection now. The next get_db() opens a new one.
+def close_db():
+    holder = _local.__dict__.pop('holder', None)
+    if holder is not None:
+        holder.finalizer()
+
+metrics.gauge('sqlite.connections', lambda: len(_holders))
+
+def query(sql, params=()):
+    with metrics.timer('sqlite'):
+        return get_db().execute(sql, params).fetchall()
+
+def execute(sql, params=()):
+    conn = get_db()
+    with conn, metrics.timer('sqlite'):
+        return conn.execute(sql, params).rowcount
+
+# Named values a background job keeps between runs, e.g. how far it got. Stored as given.
+def get_state(conn, name, default=None):
+    row = conn.execute("SELECT value FROM State WHERE name = ?", (name,)).fetchone()
+    return default if row is None else row[0]
+
+def set_state(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO State (name, value) VALUES(?, ?)", (name, value))
+
+# Insert many rows in one transaction with a single prepared statement
+def insert_many(table, columns, rows, conflict=''):
+    sql = "INSERT " + (conflict + " " if conflict else "") + "INTO [" + table + "] (" + ", ".join(columns) + \
+          ") VALUES(" + ", ".join("?" * len(columns)) + ")"
+    conn = get_db()
+    with conn, metrics.timer('sqlite'):
+        return conn.executemany(sql, rows).rowcount
+
+# Delete rows whose column matches any of values with a single prepared statement, in the caller's
+# transaction on conn
+def delete_many(conn, table, column, values):
+    with metrics.timer('sqlite'):
+        return conn.executemany("DELETE FROM [" + table + "] WHERE " + column + " = ?", [(v,) for v in values]).rowcount
@@ -0,0 +1,121 @@
+import logging
+import config
+import envelope
+import metrics
+import storage
+
+# Tables that are synced to the home server. Maps table -> (id column, server endpoint, row columns)
+SYNC_TABLES = {
+    'Weight': ('weight_id', '/sync/weight', ('weight_id', 'timestamp', 'weight', 'weight_raw', 'scale')),
+    'Barcode': ('barcode_id', '/sync/barcode', ('barcode_id', 'timestamp', 'barcode', 'scanner'))
+}
+
+# Record kind of each table's rows in a batch envelope
+BATCH_KINDS = {
+    'Weight': 'weight',
+    'Barcode': 'scan'
+}
+
+DEFAULT_BATCH_SIZE = 200
+
+# One pooled keep-alive session shared by every sync run. requests is imported on first use; it is
+# slow to import and nothing needs it until the first upload.
+_session = None
+
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+# Watermark is the rowid of the last row handed to the server. 0 means start from the beginning.
+def get_watermark(conn, table):
+    row = conn.execute("SELECT last_rowid FROM Sync_State WHERE table_name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+def set_watermark(conn, table, rowid):
+    conn.execute("INSERT OR REPLACE INTO Sync_State (table_name, last_rowid) VALUES(?, ?)", (table, rowid))
+
+def read_batch(conn, table, after, limit):
+    id_col, endpoint, columns = SYNC_TABLES[table]
+    sql = "SELECT rowid, " + ", ".join(columns) + " FROM [" + table + "] WHERE rowid > ? ORDER BY rowid LIMIT ?"
+    return conn.execute(sql, (after, limit)).fetchall()
+
+# Upload one batch. Returns the list of ids the server acknowledged.
+@metrics.timed('upload.sync')
+def upload_batch(table, rows, timeout=0.5):
+    id_col, endpoint, columns = SYNC_TABLES[table]
+    format = envelope.get_format(get_session())
+    if format:
+        records = [(BATCH_KINDS[table], dict(zip(columns, row[1:]))) for row in rows]
+        results = envelope.post(get_session(), records, format[0], format[1], timeout)
+        return [data[id_col] for (kind, data), (ok, result) in zip(records, results) if ok]
+    payload = {'rows': [dict(zip(columns, row[1:])) for row in rows]}
+    r = get_session().post(config.conf['HOME_SERVER_URL'] + endpoint, json=payload, timeout=timeout)
+    r.raise_for_status()
+    return r.json().get('ack', [])
+
+# Delete acknowledged rows and advance the watermark in a single transaction
+def commit_batch(conn, table, acked, last_rowid):
+    id_col = SYNC_TABLES[table][0]
+    with conn:
+        storage.delete_many(conn, table, id_col, acked)
+        set_watermark(conn, table, last_rowid)
+
+# Sync all pending rows of one table. Returns the number of rows acknowledged by the server and
+# whether the table was synced to the end rather than aborted after failed uploads.
+def sync_table(conn, table, batch_size=DEFAULT_BATCH_SIZE, failure_limit=2):
+    import requests
+    synced = 0
+    fails = 0
+    after = get_watermark(conn, table)
+    while True:
+        rows = read_batch(conn, table, after, batch_size)
+        if not rows:
+            # Reached the end. Reset the watermark so unacknowledged rows are retried on the next pass.
+            if after:
+                with conn:
+                    set_watermark(conn, table, 0)
+            break
+        try:
+            acked = upload_batch(table, rows)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            fails += 1
+            metrics.inc('upload.sync.errors')
+            logging.warning('%s batch upload failed: %s', table, e)
+            if fails >= failure_limit:
+                logging.error('%d failed uploads. Aborting %s sync at rowid %d', fails, table, after)
+                return synced, False
+            continue
+        # Only delete ids that were actually in this batch
+        sent = set(row[1] for row in rows)
+        acked = [i for i in acked if i in sent]
+        after = rows[-1][0]
+        commit_batch(conn, table, acked, after)
+        synced += len(acked)
+        if len(rows) < batch_size:
+            with conn:
+                set_watermark(conn, table, 0)
+            break
+    return synced, True
+
+# Sync every table. Returns False if any table's sync was aborted.
+def sync_all():
+    batch_size = config.conf['SYNC_BATCH_SIZE']
+    failure_limit = config.conf['UPLOAD_FAILURE_LIMIT']
+    conn = storage.get_db()
+    complete = True
+    for table in SYNC_TABLES:
+        synced, ok = sync_table(conn, table, batch_size, failure_limit)
+        complete = complete and ok
+        logging.debug('Synced %d %s rows', synced, table)
+    return complete
+
+# Rows waiting to be synced across every table
+def pending():
+    return sum(storage.query("SELECT COUNT(*) FROM [" + table + "]")[0][0] for table in SYNC_TABLES)
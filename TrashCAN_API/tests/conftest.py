@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault('TRASHCAN_HARDWARE', 'sim')
+
+import config
+import storage
+
+# A fresh database from init_db.sql for each test, with the config snapshot reloaded from it
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    storage.close_db()
+    monkeypatch.setattr(storage, 'DATABASE', str(tmp_path / 'database.db'))
+    monkeypatch.setattr(storage, '_schema_ready', False)
+    with open(os.path.join(os.path.dirname(HERE), 'database', 'init_db.sql')) as f:
+        storage.connect().executescript(f.read())
+    monkeypatch.setattr(config, '_snapshot', None)
+    monkeypatch.setattr(config, '_change_id', 0)
+    monkeypatch.setattr(config, '_pending', set())
+    conn = storage.get_db()
+    yield conn
+    storage.close_db()
@@ -0,0 +1,67 @@
+import pytest
+import config
+
+def test_values_are_typed(db):
+    assert config.conf['SCALE_DATA_PIN'] == 24
+    assert config.conf['SCALE_USE_NUMPY'] is True
+    assert isinstance(config.conf['WEIGHT_EVENT_INTERVAL'], float)
+
+def test_bad_value_falls_back_to_default(db):
+    assert config.coerce('SCALE_DATA_PIN', 'twelve') == 24
+    assert config.coerce('SCALE_DATA_PIN', '') == 24
+    assert config.coerce('SCALE_DATA_PIN_2', '7') == 7
+    assert config.coerce('NOT_AN_OPTION', 'x') == 'x'
+
+def test_snapshot_is_read_only(db):
+    snapshot = config.conf.snapshot()
+    with pytest.raises(TypeError):
+        snapshot['SCALE_DATA_PIN'] = 1
+
+def test_set_config_swaps_snapshot(db):
+    before = config.conf.snapshot()
+    config.set_config('scale_data_pin', '5')
+    assert config.conf['SCALE_DATA_PIN'] == 5
+    assert before['SCALE_DATA_PIN'] == 24
+    assert 'SCALE_DATA_PIN' in config._take_pending()
+    assert config._take_pending() == set()
+
+def test_delete_config_restores_default(db):
+    config.set_config('SCALE_DATA_PIN', '5')
+    config.delete_config('SCALE_DATA_PIN')
+    assert config.conf['SCALE_DATA_PIN'] == 24
+
+def test_refresh_applies_changes_from_other_connections(db):
+    assert config.conf['SCALE_CLOCK_PIN'] == 25
+    other = config.storage.connect(config.storage.DATABASE)
+    with other:
+        other.execute("UPDATE System_Options SET option_value = '9' WHERE option_name = 'SCALE_CLOCK_PIN'")
+    other.close()
+    assert config.conf['SCALE_CLOCK_PIN'] == 25
+    assert config.refresh() == {'SCALE_CLOCK_PIN'}
+    assert config.conf['SCALE_CLOCK_PIN'] == 9
+    assert config.refresh() == set()
+
+def test_device_zero_uses_plain_options(db):
+    assert config.device_conf(0, ('SCALE_DATA_PIN',))['SCALE_DATA_PIN'] == 24
+
+def test_device_needs_its_required_options(db):
+    with pytest.raises(ValueError, match='SCALE_DATA_PIN_1'):
+        config.device_conf(1, ('SCALE_DATA_PIN',))
+
+def test_device_overrides_and_fallback(db):
+    config.set_config('SCALE_DATA_PIN_1', '12')
+    config.set_config('LID_DEBOUNCE_MS', '80')
+    values = config.device_conf(1, ('SCALE_DATA_PIN',))
+    assert values['SCALE_DATA_PIN'] == 12
+    assert values['LID_DEBOUNCE_MS'] == 80.0
+    assert config.conf['SCALE_DATA_PIN'] == 24
+
+def test_calibration_never_falls_back(db):
+    config.set_config('TARE', '123')
+    config.set_config('SCALE_CAL_GAIN', '0.5')
+    config.set_config('SCALE_OFFSET_1', '100')
+    values = config.device_conf(1)
+    assert values['TARE'] == config.DEFAULTS['TARE']
+    assert values['SCALE_CAL_GAIN'] == config.DEFAULTS['SCALE_CAL_GAIN']
+    assert values['SCALE_OFFSET'] == 100.0
+    assert config.device_conf(0)['TARE'] == 123.0
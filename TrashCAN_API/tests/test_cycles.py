@@ -0,0 +1,81 @@
+import time
+import pytest
+import cycles
+import service
+
+class Switch:
+    value = False
+
+@pytest.fixture
+def switches(db, monkeypatch):
+    fan, light = Switch(), Switch()
+    monkeypatch.setattr(service, 'fan', fan, raising=False)
+    monkeypatch.setattr(service, 'light', light, raising=False)
+    monkeypatch.setattr(service, 'set_fan', lambda action: setattr(fan, 'value', action == 'on'))
+    monkeypatch.setattr(service, 'set_light', lambda action: setattr(light, 'value', action == 'on'))
+    return fan, light
+
+def engine(lid_open=False):
+    lid = {'open': lid_open}
+    e = cycles.CycleEngine(lid_is_open=lambda: lid['open'])
+    e.lid = lid
+    return e
+
+def test_start_switches_on(switches):
+    e = engine()
+    assert e.add(60) == cycles.RUNNING
+    assert switches[0].value and switches[1].value
+    assert 59 < e.status()['remaining'] <= 60
+
+def test_overlapping_cycles_merge(switches):
+    e = engine()
+    e.add(60)
+    end = e.end
+    assert e.add(10) == cycles.RUNNING
+    assert e.end == end
+    e.add(120)
+    assert e.end > end + 50
+
+def test_skipped_when_already_on(switches):
+    switches[0].value = True
+    e = engine()
+    assert e.add(60) == cycles.IDLE
+    assert e.status() == {'state': cycles.IDLE, 'remaining': 0.0}
+
+def test_deferred_while_lid_open(switches):
+    e = engine(lid_open=True)
+    assert e.add(60) == cycles.PAUSED
+    assert not switches[0].value
+    assert e.add(30) == cycles.PAUSED
+    assert e.status() == {'state': cycles.PAUSED, 'remaining': 60}
+    e.resume()
+    assert e.state == cycles.RUNNING
+    assert switches[0].value and switches[1].value
+
+def test_pause_keeps_remaining_time(switches):
+    e = engine()
+    e.add(60)
+    e.pause()
+    assert e.state == cycles.PAUSED
+    assert not switches[0].value and not switches[1].value
+    assert 59 < e.status()['remaining'] <= 60
+    e.resume()
+    assert 59 < e.status()['remaining'] <= 60
+    assert switches[0].value
+
+def test_pause_and_resume_do_nothing_when_idle(switches):
+    e = engine()
+    e.pause()
+    e.resume()
+    assert e.state == cycles.IDLE
+    assert not switches[0].value
+
+def test_cycle_ends_on_the_timer(switches):
+    e = engine()
+    e.start()
+    e.add(0.05)
+    deadline = time.monotonic() + 2
+    while e.status()['state'] != cycles.IDLE and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert e.state == cycles.IDLE
+    assert not switches[0].value and not switches[1].value
@@ -0,0 +1,31 @@
+import bc_scanner
+
+def test_repeat_within_window_is_dropped():
+    d = bc_scanner.Dedupe(window=2.0)
+    assert d.admit('0001', now=0.0)
+    assert not d.admit('0001', now=1.0)
+    assert d.admit('0002', now=1.5)
+    assert (d.unique, d.duplicates) == (2, 1)
+
+def test_repeat_after_window_is_admitted():
+    d = bc_scanner.Dedupe(window=2.0)
+    assert d.admit('0001', now=0.0)
+    assert d.admit('0001', now=2.5)
+
+def test_duplicates_extend_the_window():
+    d = bc_scanner.Dedupe(window=2.0)
+    assert d.admit('0001', now=0.0)
+    # An item held under the scanner keeps being read
+    for now in (1.5, 3.0, 4.5):
+        assert not d.admit('0001', now=now)
+    assert d.admit('0001', now=7.0)
+
+def test_holds_at_most_max_entries():
+    d = bc_scanner.Dedupe(window=60.0, max_entries=2)
+    assert d.admit('a', now=0.0)
+    assert d.admit('b', now=1.0)
+    assert d.admit('c', now=2.0)
+    assert len(d.last_seen) == 2
+    # 'a' was the least recently read and was dropped
+    assert d.admit('a', now=3.0)
+    assert not d.admit('c', now=4.0)
@@ -0,0 +1,124 @@
+import itertools
+import os
+import shutil
+import socket
+import tempfile
+import time
+import pytest
+import hwipc
+
+class Handler:
+    METHODS = ('add', 'fail', 'bad_value', 'slow')
+    STREAMS = ('event_stream',)
+
+    def __init__(self):
+        self.calls = []
+
+    def add(self, a, b):
+        self.calls.append('add')
+        return a + b
+
+    def fail(self):
+        raise RuntimeError('broken')
+
+    def bad_value(self):
+        raise ValueError('Invalid action parameter')
+
+    def slow(self):
+        self.calls.append('slow')
+        time.sleep(0.5)
+        return 'late'
+
+    def event_stream(self):
+        for i in itertools.count():
+            yield 'data: %d\n\n' % i
+
+@pytest.fixture
+def server():
+    # Unix socket paths are limited to about 100 bytes, so not under pytest's tmp_path
+    directory = tempfile.mkdtemp()
+    server = hwipc.Server(os.path.join(directory, 'hw.sock'), Handler())
+    server.start()
+    yield server
+    server.close()
+    shutil.rmtree(directory)
+
+def test_framing_round_trip():
+    a, b = socket.socketpair()
+    message = ['read_scale', [1, {'x': 'é' * 1000}]]
+    hwipc.send_message(a, message)
+    assert hwipc.recv_message(b) == message
+    a.close()
+    b.close()
+
+def test_frames_split_across_reads():
+    a, b = socket.socketpair()
+    data = b'"' + b'x' * 100000 + b'"'
+    # The reader has to gather the frame from many recv calls
+    a.sendall(hwipc.HEADER.pack(len(data)) + data[:10])
+    a.sendall(data[10:])
+    assert hwipc.recv_message(b) == 'x' * 100000
+    a.close()
+    b.close()
+
+def test_oversized_frame_is_refused():
+    a, b = socket.socketpair()
+    a.sendall(hwipc.HEADER.pack(hwipc.MAX_MESSAGE + 1))
+    with pytest.raises(ConnectionError):
+        hwipc.recv_message(b)
+    a.close()
+    b.close()
+
+def test_closed_mid_frame():
+    a, b = socket.socketpair()
+    a.sendall(hwipc.HEADER.pack(10) + b'"abc')
+    a.close()
+    with pytest.raises(ConnectionError):
+        hwipc.recv_message(b)
+    b.close()
+
+def test_calls_and_errors(server):
+    client = hwipc.Client(server.path)
+    assert client.call('add', 2, 3) == 5
+    with pytest.raises(ValueError, match='Invalid action'):
+        client.call('bad_value')
+    with pytest.raises(hwipc.RemoteError, match='broken'):
+        client.call('fail')
+    with pytest.raises(hwipc.RemoteError, match='unknown method'):
+        client.call('shutdown')
+    # The connection survives errors and is reused
+    sock = client._local.sock
+    assert client.call('add', 'a', 'b') == 'ab'
+    assert client._local.sock is sock
+
+def test_send_failure_reconnects_once(server):
+    client = hwipc.Client(server.path)
+    # A connection the owner closed, e.g. before it restarted
+    stale, peer = socket.socketpair()
+    peer.close()
+    client._local.sock = stale
+    assert client.call('add', 1, 1) == 2
+    assert server.handler.calls == ['add']
+
+def test_send_failure_on_both_attempts_is_raised(server):
+    client = hwipc.Client(server.path)
+    server.close()
+    server.join(1)
+    assert not server.is_alive()
+    with pytest.raises(OSError):
+        client.call('add', 1, 1)
+    assert server.handler.calls == []
+
+def test_lost_reply_is_not_retried(server):
+    client = hwipc.Client(server.path, timeout=0.1)
+    with pytest.raises(OSError):
+        client.call('slow')
+    assert client._local.sock is None
+    time.sleep(0.5)
+    assert server.handler.calls == ['slow']
+
+def test_stream(server):
+    client = hwipc.Client(server.path)
+    stream = client.event_stream()
+    assert list(itertools.islice(stream, 3)) == ['data: 0\n\n', 'data: 1\n\n', 'data: 2\n\n']
+    stream.close()
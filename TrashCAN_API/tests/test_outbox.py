@@ -0,0 +1,120 @@
+import json
+import time
+import pytest
+import requests
+import config
+import envelope
+import outbox
+
+def response(status_code):
+    r = requests.Response()
+    r.status_code = status_code
+    r.url = 'http://server/'
+    return r
+
+def add(db, outbox_id, payload, kind='weight', attempts=0):
+    with db:
+        db.execute("INSERT INTO Outbox (outbox_id, kind, payload, created, attempts) VALUES(?, ?, ?, ?, ?)",
+                   (outbox_id, kind, json.dumps(payload) if not isinstance(payload, str) else payload, time.time(), attempts))
+
+def outbox_rows(db):
+    return db.execute("SELECT outbox_id, attempts, next_attempt FROM Outbox ORDER BY outbox_id").fetchall()
+
+def dead_rows(db):
+    return db.execute("SELECT outbox_id, attempts, error FROM Outbox_Dead ORDER BY outbox_id").fetchall()
+
+# Per-item uploads answered with each weight payload's 'code'; sent statuses are collected
+@pytest.fixture
+def uploader(db, monkeypatch):
+    monkeypatch.setattr(envelope, 'get_format', lambda session: None)
+    monkeypatch.setattr(outbox, '_status', None)
+    sent = []
+    def upload_weight(session, payload, timeout):
+        return response(payload['code'])
+    def upload_status(session, payload, timeout):
+        sent.append(payload)
+        return response(uploader.status_code)
+    monkeypatch.setitem(outbox.UPLOADERS, 'weight', upload_weight)
+    monkeypatch.setitem(outbox.UPLOADERS, 'status', upload_status)
+    uploader = outbox.Uploader(idle=0.01)
+    uploader.status_code = 200
+    uploader.sent = sent
+    return uploader
+
+def test_backoff_grows_with_jitter_up_to_the_cap():
+    for attempts in range(12):
+        delay = outbox.backoff(attempts)
+        base = min(outbox.BACKOFF_CAP, outbox.BACKOFF_BASE * 2 ** attempts)
+        assert base * 0.5 <= delay <= base * 1.5
+    assert outbox.backoff(100) <= outbox.BACKOFF_CAP * 1.5
+
+def test_rejected_only_for_the_records_own_4xx():
+    assert outbox.rejected(response(400))
+    assert outbox.rejected(response(422))
+    assert not outbox.rejected(response(429))
+    assert not outbox.rejected(response(404))
+    assert not outbox.rejected(response(503))
+    assert not outbox.rejected(None)
+
+def test_sent_records_are_deleted(db, uploader):
+    add(db, 'a', {'code': 200})
+    uploader.drain()
+    assert outbox_rows(db) == []
+    assert dead_rows(db) == []
+
+def test_failed_records_back_off(db, uploader):
+    add(db, 'a', {'code': 503}, attempts=2)
+    before = time.time()
+    uploader.drain()
+    [(outbox_id, attempts, next_attempt)] = outbox_rows(db)
+    assert attempts == 3
+    assert before + outbox.BACKOFF_BASE * 4 * 0.5 <= next_attempt
+    # Not due yet, so the next pass leaves it alone
+    uploader.drain()
+    assert outbox_rows(db)[0][1] == 3
+
+def test_refused_records_are_dead_lettered(db, uploader):
+    add(db, 'a', {'code': 400})
+    add(db, 'b', '{not json')
+    add(db, 'c', {}, kind='mystery')
+    uploader.drain()
+    assert outbox_rows(db) == []
+    assert dead_rows(db) == [('a', 1, 'refused by the server'), ('b', 0, 'malformed payload'), ('c', 0, 'no uploader for kind mystery')]
+
+def test_records_are_dead_lettered_after_max_attempts(db, uploader):
+    config.set_config('OUTBOX_MAX_ATTEMPTS', '3')
+    add(db, 'a', {'code': 503}, attempts=2)
+    uploader.drain()
+    assert outbox_rows(db) == []
+    assert dead_rows(db) == [('a', 3, 'gave up after 3 attempts')]
+
+def test_status_fields_are_merged(uploader):
+    outbox.set_status({'lid': 'open', 'fan': 'off'})
+    outbox.set_status({'lid': 'closed'})
+    uploader.drain()
+    assert uploader.sent == [{'lid': 'closed', 'fan': 'off'}]
+    assert outbox._status is None
+
+def test_failed_status_is_restored_under_newer_fields(uploader):
+    uploader.status_code = 503
+    outbox.set_status({'lid': 'open', 'fan': 'off'})
+    uploader.drain()
+    assert uploader.status_attempts == 1
+    assert uploader.status_due > time.time()
+    outbox.set_status({'lid': 'closed'})
+    assert outbox._status == {'lid': 'closed', 'fan': 'off'}
+    # Not due yet: the status waits for its backoff
+    uploader.drain()
+    assert len(uploader.sent) == 1
+    uploader.status_due = 0.0
+    uploader.status_code = 200
+    uploader.drain()
+    assert uploader.sent[-1] == {'lid': 'closed', 'fan': 'off'}
+    assert uploader.status_attempts == 0
+
+def test_refused_status_is_dropped(uploader):
+    uploader.status_code = 400
+    outbox.set_status({'lid': 'open'})
+    uploader.drain()
+    assert outbox._status is None
+    assert uploader.status_attempts == 0
@@ -0,0 +1,84 @@
+import time
+import pytest
+import pacing
+import records
+import storage
+
+@pytest.fixture
+def moves(monkeypatch):
+    moved = []
+    monkeypatch.setattr(pacing, '_move', lambda job_id, when: moved.append((job_id, when)))
+    return moved
+
+def pacer():
+    return pacing.Pacer('test_job', 'PHONE_HOME_SLEEP', 'PHONE_HOME_IDLE_SLEEP', 'PHONE_HOME_BACKOFF_MAX', 'PHONE_HOME_BACKLOG')
+
+def test_busy_runs_after_the_base_period(db, moves):
+    p = pacer()
+    assert p.done('busy') == 30
+    assert p.done('busy') == 30
+    assert moves[-1] == ('test_job', p.next_run)
+
+def test_idle_doubles_up_to_the_limit(db, moves):
+    p = pacer()
+    assert [p.done('idle') for _ in range(6)] == [60, 120, 240, 300, 300, 300]
+    # Work resets the delay
+    assert p.done('busy') == 30
+    assert p.done('idle') == 60
+
+def test_backoff_doubles_with_jitter_up_to_the_limit(db, moves):
+    p = pacer()
+    for streak in range(1, 10):
+        delay = p.done('backoff')
+        base = min(1800, 30 * 2 ** streak)
+        assert base * 0.5 <= delay <= base * 1.5
+
+def test_unknown_state(db, moves):
+    with pytest.raises(ValueError):
+        pacer().done('sleepy')
+
+def test_backlog_pulls_the_run_forward(db, moves):
+    p = pacer()
+    p.done('idle')
+    p.set_backlog(99)
+    assert len(moves) == 1
+    p.set_backlog(100)
+    assert len(moves) == 2
+    assert moves[-1][1] == p.next_run <= time.time()
+    assert p.status()['backlog'] == 100
+
+def test_backlog_waits_out_a_backoff(db, moves):
+    p = pacer()
+    p.done('backoff')
+    p.set_backlog(1000)
+    assert len(moves) == 1
+
+def test_backlog_ignored_until_the_job_has_run_here(db, moves):
+    p = pacer()
+    p.set_backlog(1000)
+    assert moves == []
+    assert p.backlog == 1000
+
+def test_count_backlog_includes_the_outbox(db):
+    records.add_barcodes([('b0', '0001', 0), ('b1', '0002', 0)])
+    with db:
+        db.execute("INSERT INTO Outbox (outbox_id, kind, payload, created) VALUES('o', 'weight', '{}', 0)")
+    assert pacing.count_backlog() == 3
+
+def test_watcher_counts_rows_committed_elsewhere(db):
+    counts = []
+    class Recorder:
+        def set_backlog(self, n):
+            counts.append(n)
+    pacing.BacklogWatcher(Recorder(), poll=0.02).start()
+    deadline = time.monotonic() + 2
+    while not counts and time.monotonic() < deadline:
+        time.sleep(0.01)
+    other = storage.connect()
+    with other:
+        other.execute("INSERT INTO Outbox (outbox_id, kind, payload, created) VALUES('o', 'weight', '{}', 0)")
+    other.close()
+    while counts[-1] != 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert counts[0] == 0
+    assert counts[-1] == 1
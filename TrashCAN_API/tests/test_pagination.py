@@ -0,0 +1,57 @@
+import json
+import pytest
+import app
+import records
+
+# 7 rows over 3 timestamps, so pages have to break ties on the id
+ROWS = [('w%d' % i, '2026-01-01 00:00:0%d' % (i // 3), float(i)) for i in (6, 0, 4, 2, 5, 1, 3)]
+ORDER = ['w0', 'w1', 'w2', 'w3', 'w4', 'w5', 'w6']
+
+@pytest.fixture
+def weights(db):
+    with db:
+        db.executemany("INSERT INTO Weight (weight_id, timestamp, weight, weight_raw, scale) VALUES(?, ?, ?, NULL, 0)", ROWS)
+
+@pytest.fixture
+def client(db):
+    return app.create_api().test_client()
+
+def test_pages_walk_every_row_once(weights):
+    seen = []
+    after = None
+    while True:
+        rows, after = records.list_page('Weight', after, limit=3)
+        seen += [row['weight_id'] for row in rows]
+        if after is None:
+            break
+    assert seen == ORDER
+
+def test_last_full_page_has_no_cursor(weights):
+    rows, after = records.list_page('Weight', limit=7)
+    assert len(rows) == 7
+    assert after is None
+
+def test_since_is_exclusive(weights):
+    rows, after = records.list_page('Weight', since='2026-01-01 00:00:00', limit=10)
+    assert [row['weight_id'] for row in rows] == ORDER[3:]
+
+def test_iter_rows_streams_everything_after_the_cursor(weights):
+    assert [row['weight_id'] for row in records.iter_rows('Weight', after=('2026-01-01 00:00:01', 'w3'))] == ORDER[4:]
+
+def test_api_pages(weights, client):
+    r = client.get('/api/weight?limit=4')
+    page = r.get_json()
+    assert [row['weight_id'] for row in page['items']] == ORDER[:4]
+    assert page['next'] == '2026-01-01 00:00:01,w3'
+    page = client.get('/api/weight', query_string={'limit': 4, 'after': page['next']}).get_json()
+    assert [row['weight_id'] for row in page['items']] == ORDER[4:]
+    assert page['next'] is None
+
+def test_api_ndjson(weights, client):
+    r = client.get('/api/weight?format=ndjson')
+    assert r.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['weight_id'] for line in r.get_data(as_text=True).splitlines()] == ORDER
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=1001', 'limit=ten', 'after=w3'])
+def test_api_bad_arguments(weights, client, query):
+    assert client.get('/api/weight?' + query).status_code == 400
@@ -0,0 +1,71 @@
+import sqlite3
+import pytest
+import requests
+import records
+import sync
+
+def add_barcodes(n):
+    records.add_barcodes([('b%d' % i, '0001%d' % i, 0) for i in range(n)])
+
+def barcode_ids(db):
+    return [row[0] for row in db.execute("SELECT barcode_id FROM Barcode ORDER BY rowid")]
+
+@pytest.fixture
+def uploads(monkeypatch):
+    batches = []
+    def upload_batch(table, rows, timeout=0.5):
+        batches.append([row[1] for row in rows])
+        return [row[1] for row in rows]
+    monkeypatch.setattr(sync, 'upload_batch', upload_batch)
+    return batches
+
+def test_syncs_in_batches_and_deletes_acked_rows(db, uploads):
+    add_barcodes(5)
+    assert sync.sync_table(db, 'Barcode', batch_size=2) == (5, True)
+    assert uploads == [['b0', 'b1'], ['b2', 'b3'], ['b4']]
+    assert barcode_ids(db) == []
+    assert sync.get_watermark(db, 'Barcode') == 0
+
+def test_unacked_rows_are_kept_for_the_next_pass(db, monkeypatch):
+    add_barcodes(4)
+    # The server acks the odd rows, and an id that was never sent
+    monkeypatch.setattr(sync, 'upload_batch', lambda table, rows, timeout=0.5: [row[1] for row in rows if row[1] in ('b1', 'b3')] + ['b9'])
+    assert sync.sync_table(db, 'Barcode', batch_size=2) == (2, True)
+    assert barcode_ids(db) == ['b0', 'b2']
+    # The watermark is reset at the end so the next pass starts over
+    assert sync.get_watermark(db, 'Barcode') == 0
+
+def test_failed_uploads_abort_at_the_watermark(db, monkeypatch):
+    add_barcodes(6)
+    calls = []
+    def upload_batch(table, rows, timeout=0.5):
+        calls.append(rows[0][1])
+        if len(calls) > 1:
+            raise requests.exceptions.ConnectionError('down')
+        return [row[1] for row in rows]
+    monkeypatch.setattr(sync, 'upload_batch', upload_batch)
+    assert sync.sync_table(db, 'Barcode', batch_size=2, failure_limit=2) == (2, False)
+    assert calls == ['b0', 'b2', 'b2']
+    watermark = sync.get_watermark(db, 'Barcode')
+    assert watermark == db.execute("SELECT MIN(rowid) FROM Barcode").fetchone()[0] - 1
+    # The next run resumes after the watermark
+    batches = []
+    monkeypatch.setattr(sync, 'upload_batch', lambda table, rows, timeout=0.5: batches.append(rows[0][1]) or [row[1] for row in rows])
+    assert sync.sync_table(db, 'Barcode', batch_size=2) == (4, True)
+    assert batches == ['b2', 'b4']
+    assert barcode_ids(db) == []
+
+def test_commit_batch_rolls_back_together(db, monkeypatch):
+    add_barcodes(2)
+    def set_watermark(conn, table, rowid):
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(sync, 'set_watermark', set_watermark)
+    with pytest.raises(sqlite3.OperationalError):
+        sync.commit_batch(db, 'Barcode', ['b0', 'b1'], 2)
+    assert barcode_ids(db) == ['b0', 'b1']
+    assert sync.get_watermark(db, 'Barcode') == 0
+
+def test_pending_counts_every_table(db):
+    add_barcodes(3)
+    records.add_weight('w0', None, weight=1.5)
+    assert sync.pending() == 4
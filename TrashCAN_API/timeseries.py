@@ -0,0 +1,79 @@
+import time
+import config
+import metrics
+import storage
+
+# Fill-level history of each scale. Every reading is kept in Weight_Series as typed (timestamp, weight,
+# scale) rows, and per-minute, per-hour and per-day rollups in Weight_Rollup are updated in the same
+# transaction, so history is read straight from the rollups without scanning readings. Unlike the
+# Weight table, nothing here is removed by sync; apply_retention() thins and expires it.
+
+RESOLUTIONS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400
+}
+
+DOWNSAMPLE_INTERVAL = 60 #Old readings are thinned to the last one in each interval
+
+UPSERT_ROLLUP = """INSERT INTO Weight_Rollup (resolution, scale, bucket, samples, weight_min, weight_max, weight_sum) VALUES(?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT (resolution, scale, bucket) DO UPDATE SET samples = samples + 1, weight_min = MIN(weight_min, excluded.weight_min),
+weight_max = MAX(weight_max, excluded.weight_max), weight_sum = weight_sum + excluded.weight_sum"""
+
+# Store [(weight, timestamp, scale), ...] and fold them into the rollups in one transaction
+def record_many(readings):
+    conn = storage.get_db()
+    with conn, metrics.timer('sqlite'):
+        add_many(conn, readings)
+
+# As record_many, in the caller's transaction on conn, so the readings commit with the caller's own writes
+def add_many(conn, readings):
+    raw = [(float(timestamp), float(weight), int(scale)) for weight, timestamp, scale in readings]
+    rollups = [(seconds, scale, int(timestamp // seconds) * seconds, weight, weight, weight)
+               for timestamp, weight, scale in raw for seconds in RESOLUTIONS.values()]
+    conn.executemany("INSERT INTO Weight_Series (timestamp, weight, scale) VALUES(?, ?, ?)", raw)
+    conn.executemany(UPSERT_ROLLUP, rollups)
+
+# One scale's buckets of one resolution between since (inclusive) and until (exclusive), oldest first.
+# Without since, the latest `limit` buckets.
+def history(resolution='hour', since=None, until=None, limit=100, scale=0):
+    if resolution not in RESOLUTIONS:
+        raise ValueError('resolution must be one of ' + ', '.join(RESOLUTIONS))
+    sql = "SELECT bucket, samples, weight_min, weight_max, weight_sum FROM Weight_Rollup WHERE resolution = ? AND scale = ?"
+    params = [RESOLUTIONS[resolution], scale]
+    if since is not None:
+        sql += " AND bucket >= ?"
+        params.append(int(since // RESOLUTIONS[resolution]) * RESOLUTIONS[resolution])
+    if until is not None:
+        sql += " AND bucket < ?"
+        params.append(until)
+    sql += " ORDER BY bucket" + (" DESC" if since is None else "") + " LIMIT ?"
+    params.append(limit)
+    rows = storage.query(sql, params)
+    if since is None:
+        rows.reverse()
+    return [{'timestamp': bucket, 'count': samples, 'min': low, 'max': high, 'mean': total / samples}
+            for bucket, samples, low, high, total in rows]
+
+# Thin each scale's readings older than WEIGHT_DOWNSAMPLE_AFTER seconds to one per DOWNSAMPLE_INTERVAL,
+# delete readings and minute rollups older than WEIGHT_RAW_RETENTION, and hour rollups older than
+# WEIGHT_HOUR_RETENTION. Day rollups are kept. Returns the number of rows removed.
+def apply_retention(now=None):
+    now = now or time.time()
+    raw_cutoff = now - config.conf['WEIGHT_RAW_RETENTION']
+    downsample_cutoff = int((now - config.conf['WEIGHT_DOWNSAMPLE_AFTER']) // DOWNSAMPLE_INTERVAL) * DOWNSAMPLE_INTERVAL
+    conn = storage.get_db()
+    with conn, metrics.timer('sqlite'):
+        # Readings before the previous run's cutoff were already thinned
+        done = storage.get_state(conn, 'timeseries.downsampled', 0)
+        removed = conn.execute("""DELETE FROM Weight_Series WHERE timestamp >= ? AND timestamp < ? AND rowid NOT IN (
+            SELECT MAX(rowid) FROM Weight_Series WHERE timestamp >= ? AND timestamp < ? GROUP BY scale, CAST(timestamp / ? AS INTEGER))""",
+                               (done, downsample_cutoff, done, downsample_cutoff, DOWNSAMPLE_INTERVAL)).rowcount
+        storage.set_state(conn, 'timeseries.downsampled', downsample_cutoff)
+        removed += conn.execute("DELETE FROM Weight_Series WHERE timestamp < ?", (raw_cutoff,)).rowcount
+        removed += conn.execute("DELETE FROM Weight_Rollup WHERE resolution = ? AND bucket < ?",
+                                (RESOLUTIONS['minute'], raw_cutoff)).rowcount
+        removed += conn.execute("DELETE FROM Weight_Rollup WHERE resolution = ? AND bucket < ?",
+                                (RESOLUTIONS['hour'], now - config.conf['WEIGHT_HOUR_RETENTION'])).rowcount
+    metrics.inc('timeseries.removed', removed)
+    return removed
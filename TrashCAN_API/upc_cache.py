@@ -0,0 +1,108 @@
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+import config
+import metrics
+import storage
+
+# Home server /barcode-lookup results by UPC, so a product this bin has seen before resolves without
+# the network. Lookups check an in-memory LRU first, then the Upc_Cache table. Entries older than
+# UPC_CACHE_TTL seconds are misses. The LRU holds at most UPC_CACHE_SIZE entries and the table
+# UPC_CACHE_MAX_ROWS rows.
+
+SEED_ENDPOINT = '/barcode-lookup/bulk'
+
+_entries = OrderedDict() #upc -> (result, fetched)
+_lock = Lock()
+
+def _remember(upc, result, fetched):
+    with _lock:
+        _entries[upc] = (result, fetched)
+        _entries.move_to_end(upc)
+        while len(_entries) > config.conf['UPC_CACHE_SIZE']:
+            _entries.popitem(last=False)
+
+def _forget(upc):
+    with _lock:
+        _entries.pop(upc, None)
+
+# The cached lookup result for upc, or None
+def lookup(upc):
+    expires = time.time() - config.conf['UPC_CACHE_TTL']
+    with _lock:
+        entry = _entries.get(upc)
+        if entry is not None:
+            _entries.move_to_end(upc)
+    if entry is None:
+        row = storage.query("SELECT result, fetched FROM Upc_Cache WHERE upc = ?", (upc,))
+        if row:
+            entry = (json.loads(row[0][0]), row[0][1])
+            _remember(upc, *entry)
+    if entry is None:
+        metrics.inc('upc_cache.miss')
+        return None
+    if entry[1] < expires:
+        metrics.inc('upc_cache.expired')
+        _forget(upc)
+        return None
+    metrics.inc('upc_cache.hit')
+    return entry[0]
+
+def store(upc, result, fetched=None):
+    store_many([(upc, result)], fetched)
+
+# Store [(upc, result), ...] in one transaction
+def store_many(items, fetched=None):
+    fetched = fetched or time.time()
+    rows = [(upc, json.dumps(result), fetched) for upc, result in items]
+    storage.insert_many('Upc_Cache', ('upc', 'result', 'fetched'), rows, conflict='OR REPLACE')
+    for upc, result in items:
+        _remember(upc, result, fetched)
+
+# Cache the body of a successful /barcode-lookup response. Bodies that aren't JSON are ignored.
+def store_response(upc, response):
+    try:
+        result = response.json()
+    except ValueError:
+        return
+    store(upc, result)
+
+# Drop expired rows and the oldest rows beyond UPC_CACHE_MAX_ROWS
+def prune():
+    expires = time.time() - config.conf['UPC_CACHE_TTL']
+    removed = storage.execute("DELETE FROM Upc_Cache WHERE fetched < ?", (expires,))
+    removed += storage.execute("DELETE FROM Upc_Cache WHERE upc IN (SELECT upc FROM Upc_Cache ORDER BY fetched DESC LIMIT -1 OFFSET ?)",
+                               (config.conf['UPC_CACHE_MAX_ROWS'],))
+    return removed
+
+# Bulk load the lookups the server has added or changed since the last seed. The server answers
+# {"items": [{"upc": ..., "result": ...}, ...], "next": <cursor>}; the cursor is kept in the State table.
+def seed(session, timeout=0.5):
+    import requests
+    conn = storage.get_db()
+    since = storage.get_state(conn, 'upc_cache.cursor', 0)
+    try:
+        r = session.get(config.conf['HOME_SERVER_URL'] + SEED_ENDPOINT, params={'since': since}, timeout=timeout)
+        r.raise_for_status()
+        body = r.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.debug('UPC cache seed failed: %s', e)
+        return 0
+    items = [(item['upc'], item['result']) for item in body.get('items', []) if 'upc' in item]
+    try:
+        if items:
+            store_many(items)
+        with conn:
+            storage.set_state(conn, 'upc_cache.cursor', body.get('next', since))
+        prune()
+    except sqlite3.Error as e:
+        logging.error('UPC cache seed failed: %s', e)
+        return 0
+    metrics.inc('upc_cache.seeded', len(items))
+    return len(items)
+
+metrics.gauge('upc_cache.memory', lambda: len(_entries))
+metrics.gauge('upc_cache.rows', lambda: storage.query("SELECT COUNT(*) FROM Upc_Cache")[0][0])
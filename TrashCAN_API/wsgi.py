@@ -0,0 +1,18 @@
+import os
+import config
+
+# Entry point for the production web workers, e.g.
+#   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+# Each /api/events stream holds a worker thread while it is open; see EVENT_STREAMS_MAX in app.py.
+# The workers never touch the hardware. They call the hardware owner (python owner.py) over
+# HARDWARE_SOCKET and read and write local storage directly.
+os.environ.setdefault('TRASHCAN_HARDWARE_SOCKET', config.conf['HARDWARE_SOCKET'])
+
+import app as api
+
+app = api.create_api()
+
+# Keep this worker's config snapshot in step with changes made by the owner and the other workers.
+# No listeners: the jobs and devices that react to changes live in the owner. Gunicorn imports this
+# module in each worker after forking, so every worker gets its own watcher thread.
+config.start_watcher()